@@ -57,16 +57,56 @@ if not settings.IS_TEST:
                     'expires': int(settings.DBBACKUP_INTERVAL*24*3600),
                     },
             },
+            'reconcile-unseen-calculations': {
+                'task': 'frontend.tasks.reconcile_unseen_calculations',
+                'schedule': crontab(minute='*/15'),
+                'options': {
+                    'expires': 15*60,
+                    },
+            },
+            'feed-fairshare': {
+                'task': 'frontend.tasks.feed_fairshare',
+                'schedule': crontab(minute='*'),
+                'options': {
+                    'expires': 60,
+                    },
+            },
+            'requeue-lost-fairshare': {
+                'task': 'frontend.tasks.requeue_lost_fairshare',
+                'schedule': crontab(minute='*/10'),
+                'options': {
+                    'expires': 10*60,
+                    },
+            },
+            'evict-scratch': {
+                'task': 'frontend.tasks.evict_scratch',
+                'schedule': crontab(minute=15),
+                'options': {
+                    'expires': 3600,
+                    },
+            },
+            'train-runtime-model': {
+                'task': 'frontend.tasks.train_runtime_model',
+                'schedule': crontab(minute=45),
+                'options': {
+                    'expires': 3600,
+                    },
+            },
+            'migrate-results': {
+                'task': 'frontend.tasks.migrate_results',
+                'schedule': crontab(minute='*/10'),
+                'options': {
+                    'expires': 10*60,
+                    },
+            },
     }
 
 
 if not settings.IS_TEST and settings.PING_SATELLITE.lower() == "true":
-    app.conf.beat_schedule = {
-            'ping-satellite': {
+    app.conf.beat_schedule['ping-satellite'] = {
                 'task': 'frontend.tasks.ping_satellite',
                 'schedule': crontab(minute=(datetime.now().minute+1)%60),
                 'options': {
                     'expires': 3600,
                 }
-            },
-    }
+            }
@@ -0,0 +1,254 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import os
+import json
+import logging
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+if os.getenv("CALCUS_DOCKER", "false").lower() == "true":
+    pool = redis.ConnectionPool(host='redis', port=6379, db=2)
+else:
+    pool = redis.ConnectionPool(host='localhost', port=6379, db=2)
+
+RELATED_PROFILES_KEY = "related_profiles_{}"
+RELATED_PROFILES_TIMEOUT = 24*3600
+
+def get_connection():
+    return redis.Redis(connection_pool=pool)
+
+def get_related_profiles(profile_id):
+    try:
+        ids = get_connection().smembers(RELATED_PROFILES_KEY.format(profile_id))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the cached permissions: {}".format(str(e)))
+        return None
+
+    if len(ids) == 0:
+        return None
+    return set(int(i) for i in ids)
+
+def set_related_profiles(profile_id, ids):
+    key = RELATED_PROFILES_KEY.format(profile_id)
+    try:
+        pipe = get_connection().pipeline()
+        pipe.delete(key)
+        pipe.sadd(key, *ids)
+        pipe.expire(key, RELATED_PROFILES_TIMEOUT)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not cache the permissions: {}".format(str(e)))
+
+def invalidate_related_profiles():
+    # Group changes are rare, so all the cached relations are simply dropped
+    try:
+        connection = get_connection()
+        keys = list(connection.scan_iter(RELATED_PROFILES_KEY.format('*')))
+        if len(keys) > 0:
+            connection.delete(*keys)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not invalidate the cached permissions: {}".format(str(e)))
+
+DELETED_ORDERS_KEY = "deleted_orders_{}"
+DELETED_ORDERS_RETENTION = 24*3600
+
+def add_deleted_order(author_id, order_id, timestamp):
+    # Kept long enough for the lists polling for changes to remove the order
+    key = DELETED_ORDERS_KEY.format(author_id)
+    try:
+        pipe = get_connection().pipeline()
+        pipe.zadd(key, {order_id: timestamp})
+        pipe.zremrangebyscore(key, '-inf', timestamp - DELETED_ORDERS_RETENTION)
+        pipe.expire(key, DELETED_ORDERS_RETENTION)
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not record the deletion of order {}: {}".format(order_id, str(e)))
+
+def get_deleted_orders(author_id, since):
+    try:
+        ids = get_connection().zrangebyscore(DELETED_ORDERS_KEY.format(author_id), since, '+inf')
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the deleted orders: {}".format(str(e)))
+        return []
+    return [int(i) for i in ids]
+
+ENSEMBLE_MAP_KEY = "ensemble_map_{}"
+ENSEMBLE_MAP_TIMEOUT = 3600
+
+def get_ensemble_map(molecule_id):
+    try:
+        return get_connection().get(ENSEMBLE_MAP_KEY.format(molecule_id))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the cached ensemble map: {}".format(str(e)))
+        return None
+
+def set_ensemble_map(molecule_id, payload):
+    try:
+        get_connection().set(ENSEMBLE_MAP_KEY.format(molecule_id), payload, ex=ENSEMBLE_MAP_TIMEOUT)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not cache the ensemble map: {}".format(str(e)))
+
+def invalidate_ensemble_map(molecule_id):
+    if molecule_id is None:
+        return
+    try:
+        get_connection().delete(ENSEMBLE_MAP_KEY.format(molecule_id))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not invalidate the cached ensemble map: {}".format(str(e)))
+
+FRAGMENT_KEY = "fragment_{}_{}_{}"
+FRAGMENT_VERSION_KEY = "fragment_version_{}"
+FRAGMENT_TIMEOUT = 3600
+
+def get_fragment_version(molecule_id):
+    try:
+        version = get_connection().get(FRAGMENT_VERSION_KEY.format(molecule_id))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the fragment version: {}".format(str(e)))
+        return None
+
+    if version is None:
+        return 0
+    return int(version)
+
+def bump_fragment_version(molecule_id):
+    # The fragments of the old version are never read again and simply expire
+    if molecule_id is None:
+        return
+    try:
+        get_connection().incr(FRAGMENT_VERSION_KEY.format(molecule_id))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not bump the fragment version: {}".format(str(e)))
+
+def get_fragment(molecule_id, version, key):
+    try:
+        html = get_connection().get(FRAGMENT_KEY.format(molecule_id, version, key))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the cached fragment: {}".format(str(e)))
+        return None
+
+    if html is None:
+        return None
+    return html.decode('utf-8')
+
+def set_fragment(molecule_id, version, key, html):
+    try:
+        get_connection().set(FRAGMENT_KEY.format(molecule_id, version, key), html, ex=FRAGMENT_TIMEOUT)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not cache the fragment: {}".format(str(e)))
+
+EXP_SPECTRUM_KEY = "exp_spectrum_{}"
+EXP_SPECTRUM_TIMEOUT = 24*3600
+
+def get_cached_spectrum(digest):
+    try:
+        return get_connection().get(EXP_SPECTRUM_KEY.format(digest))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the cached experimental spectrum: {}".format(str(e)))
+        return None
+
+def set_cached_spectrum(digest, payload):
+    try:
+        get_connection().set(EXP_SPECTRUM_KEY.format(digest), payload, ex=EXP_SPECTRUM_TIMEOUT)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not cache the experimental spectrum: {}".format(str(e)))
+
+INPUT_TEMPLATE_KEY = "input_template_{}"
+INPUT_TEMPLATE_TIMEOUT = 24*3600
+
+def get_input_template(key):
+    try:
+        template = get_connection().get(INPUT_TEMPLATE_KEY.format(key))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the cached input template: {}".format(str(e)))
+        return None
+
+    if template is None:
+        return None
+    return json.loads(template)
+
+def set_input_template(key, template):
+    try:
+        get_connection().set(INPUT_TEMPLATE_KEY.format(key), json.dumps(template), ex=INPUT_TEMPLATE_TIMEOUT)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not cache the input template: {}".format(str(e)))
+
+RUNTIME_MODEL_KEY = "runtime_model"
+
+def get_runtime_model():
+    try:
+        model = get_connection().get(RUNTIME_MODEL_KEY)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the runtime model: {}".format(str(e)))
+        return None
+
+    if model is None:
+        return None
+    return json.loads(model)
+
+def set_runtime_model(model):
+    # Kept until the next training, which rebuilds it from the database if it is lost
+    try:
+        get_connection().set(RUNTIME_MODEL_KEY, json.dumps(model))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not save the runtime model: {}".format(str(e)))
+
+RESULTS_MIGRATION_KEY = "results_migration_cursor"
+
+def get_results_migration_cursor():
+    try:
+        cursor = get_connection().get(RESULTS_MIGRATION_KEY)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not read the progress of the results migration: {}".format(str(e)))
+        return 0
+
+    if cursor is None:
+        return 0
+    return int(cursor)
+
+def set_results_migration_cursor(calc_id):
+    # Compressing results is idempotent, so losing the cursor only repeats some work
+    try:
+        get_connection().set(RESULTS_MIGRATION_KEY, calc_id)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not save the progress of the results migration: {}".format(str(e)))
+
+ORDER_ESTIMATE_KEY = "order_estimate_{}"
+ORDER_ESTIMATE_INTERVAL = 30
+
+def claim_order_estimate(order_id, force=False):
+    '''
+        Returns whether the estimate of the order should be updated now
+
+        Transitions of the same order within the interval only update it once.
+    '''
+    key = ORDER_ESTIMATE_KEY.format(order_id)
+    try:
+        if force:
+            get_connection().set(key, 1, ex=ORDER_ESTIMATE_INTERVAL)
+            return True
+        return bool(get_connection().set(key, 1, ex=ORDER_ESTIMATE_INTERVAL, nx=True))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not throttle the estimate of order {}: {}".format(order_id, str(e)))
+        return True
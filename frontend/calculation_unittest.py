@@ -107,3 +107,15 @@ class CalculationUnitTest(TestCase):
                 return False
         return True
 
+
+    def cb_has_frequencies(self, calc):
+        if calc.result_ensemble is None:
+            print("The result ensemble is none")
+            return False
+
+        for s in calc.result_ensemble.structure_set.all():
+            prop = s.properties.filter(parameters=calc.parameters).first()
+            if prop is None or prop.freq != calc.id:
+                print("The optimised structure has no frequencies")
+                return False
+        return True
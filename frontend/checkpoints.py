@@ -0,0 +1,449 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import os
+import re
+import shutil
+import logging
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Calculation
+from .environment_variables import CALCUS_SCR_HOME
+
+logger = logging.getLogger(__name__)
+
+# Files left in the scratch directory of local calculations which allow them to restart
+# from their last geometry and wavefunction instead of from scratch.
+CHECKPOINT_FILES = {
+        'ORCA': ['calc.gbw', 'restart.gbw', 'calc.opt', 'calc_trj.xyz'],
+        'Gaussian': ['calc.chk'],
+        'xtb': ['xtbrestart', 'xtbopt.log'],
+    }
+
+# Steps which can continue from the last geometry of the interrupted run
+GEOMETRY_STEPS = ['opt', 'constr_opt', 'optts', 'opt_freq']
+
+# Steps which compute the Hessian of their final geometry
+FREQUENCY_STEPS = ['freq', 'opt_freq']
+
+ORCA_RESTART_GBW = 'restart.gbw'
+
+# Files of the parent calculation staged in the scratch directory of the next step
+PARENT_GBW = 'parent.gbw'
+PARENT_HESS = 'parent.hess'
+PARENT_CHK = 'parent.chk'
+
+# Files of finished calculations which can be staged for the next steps
+REUSED_FILES = ['calc.gbw', 'calc.hess', 'calc.chk', 'xtbrestart']
+
+# Age (seconds) after which the files of finished calculations are removed if no calculation can use
+# them, and after which they are removed anyway
+SCRATCH_GRACE = 24*3600
+SCRATCH_TTL = 7*24*3600
+
+# Size (MB) of the files kept in the scratch space, without limit if 0
+SCRATCH_MAX_SIZE = int(os.environ.get("CALCUS_SCRATCH_MAX_SIZE", 0))
+
+def checkpoint_files(software):
+    return CHECKPOINT_FILES.get(software, [])
+
+def remove_files(workdir, keep):
+    for name in os.listdir(workdir):
+        if name in keep:
+            continue
+
+        path = os.path.join(workdir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+def clear_scratch(workdir, software):
+    '''
+        Removes the content of a scratch directory, except the checkpoint files
+    '''
+    if not os.path.isdir(workdir):
+        return
+
+    remove_files(workdir, checkpoint_files(software))
+
+def release_scratch(calc, workdir):
+    '''
+        Cleans up the scratch directory of a calculation once its results have been saved
+
+        Only the files which can be reused by the next steps are kept, as well as the checkpoint
+        files of calculations which did not succeed. The directory is removed if nothing is left.
+    '''
+    if not os.path.isdir(workdir) or os.path.islink(workdir):
+        return
+
+    keep = list(REUSED_FILES)
+    if calc.status != 2:
+        keep += checkpoint_files(calc.parameters.software)
+
+    remove_files(workdir, keep)
+
+    if len(os.listdir(workdir)) == 0:
+        os.rmdir(workdir)
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+def kept_scratch():
+    '''
+        Returns the scratch directories left by finished calculations, oldest first
+
+        Each entry is (calc_id, path, size, calculation or None if it was deleted).
+    '''
+    if not os.path.isdir(CALCUS_SCR_HOME):
+        return []
+
+    dirs = {}
+    for name in os.listdir(CALCUS_SCR_HOME):
+        path = os.path.join(CALCUS_SCR_HOME, name)
+        if name.isdigit() and os.path.isdir(path) and not os.path.islink(path):
+            dirs[int(name)] = path
+
+    calcs = Calculation.objects.filter(pk__in=list(dirs.keys())).select_related('parameters', 'step', 'order', 'structure').in_bulk()
+
+    entries = []
+    for calc_id, path in dirs.items():
+        calc = calcs.get(calc_id)
+        # The calculation still uses its directory
+        if calc is not None and calc.status in [0, 1]:
+            continue
+        entries.append((calc_id, path, directory_size(path), calc))
+
+    def finished(entry):
+        calc = entry[3]
+        if calc is None or calc.date_finished is None:
+            return 0
+        return calc.date_finished.timestamp()
+    return sorted(entries, key=finished)
+
+def awaited_parents(calcs):
+    '''
+        Returns the ids of the calculations which queued or running local calculations can use as parent
+
+        This is looser than find_parent, which only looks at the last candidates.
+    '''
+    structures = set()
+    ensembles = set()
+    for structure_id, ensemble_id, number, software in Calculation.objects.filter(status__in=[0, 1], local=True, structure__isnull=False).values_list('structure_id', 'structure__parent_ensemble_id', 'structure__number', 'parameters__software'):
+        structures.add((structure_id, software))
+        ensembles.add((ensemble_id, number, software))
+
+    awaited = set()
+    for calc in calcs:
+        if calc.parameters is None:
+            continue
+        software = calc.parameters.software
+        if (calc.structure_id, software) in structures:
+            awaited.add(calc.id)
+        elif calc.step is not None and calc.step.creates_ensemble and calc.order is not None and calc.order.result_ensemble_id is not None:
+            if (calc.order.result_ensemble_id, calc.structure.number if calc.structure else None, software) in ensembles:
+                awaited.add(calc.id)
+    return awaited
+
+def evict_scratch(now=None):
+    '''
+        Removes the scratch directories of finished calculations which are no longer worth keeping
+
+        The files of successful calculations are kept for SCRATCH_GRACE in case the next steps are
+        launched, and as long as a queued or running calculation can use them, but never longer
+        than SCRATCH_TTL. The oldest are also removed while the scratch space exceeds SCRATCH_MAX_SIZE.
+        Returns the number of directories removed and their size.
+    '''
+    if now is None:
+        now = timezone.now()
+
+    entries = kept_scratch()
+    awaited = awaited_parents([calc for calc_id, path, size, calc in entries if calc is not None and calc.status == 2])
+    total = sum(size for calc_id, path, size, calc in entries)
+
+    def expired(calc):
+        if calc is None or calc.date_finished is None:
+            return True
+
+        age = (now - calc.date_finished).total_seconds()
+        if age > SCRATCH_TTL:
+            return True
+        return calc.status == 2 and age > SCRATCH_GRACE and calc.id not in awaited
+
+    removed = [entry for entry in entries if expired(entry[3])]
+    remaining = [entry for entry in entries if not expired(entry[3])]
+
+    if SCRATCH_MAX_SIZE > 0:
+        total -= sum(size for calc_id, path, size, calc in removed)
+
+        # The files nobody waits for go first, the oldest first
+        remaining.sort(key=lambda entry: entry[0] in awaited)
+        while total > SCRATCH_MAX_SIZE*1024**2 and len(remaining) > 0:
+            entry = remaining.pop(0)
+            removed.append(entry)
+            total -= entry[2]
+
+    for calc_id, path, size, calc in removed:
+        shutil.rmtree(path, ignore_errors=True)
+
+    return len(removed), sum(size for calc_id, path, size, calc in removed)
+
+def last_frame(path):
+    '''
+        Returns the last structure of an xyz trajectory, or None if it has no complete frame
+    '''
+    with open(path) as f:
+        lines = f.readlines()
+
+    frame = None
+    ind = 0
+    while ind < len(lines):
+        try:
+            num = int(lines[ind].strip())
+        except ValueError:
+            break
+
+        if ind + 2 + num > len(lines):
+            break
+
+        frame = lines[ind+2:ind+2+num]
+        ind += 2 + num
+
+    if frame is None:
+        return None
+    return ''.join(frame)
+
+def xyz_coordinates(xyz):
+    return [i.strip() for i in xyz.strip().split('\n') if len(i.split()) == 4]
+
+def restart_orca_input(input_file, xyz=None, gbw=ORCA_RESTART_GBW):
+    '''
+        Makes an ORCA input read the orbitals of a previous run and start from the given coordinates
+    '''
+    lines = input_file.split('\n')
+
+    if xyz is not None:
+        start = None
+        for ind, line in enumerate(lines):
+            if start is None and line.strip().lower().startswith('*xyz'):
+                start = ind
+            elif start is not None and line.strip() == '*':
+                lines = lines[:start+1] + xyz_coordinates(xyz) + lines[ind:]
+                break
+
+    return '!MORead\n%moinp "{}"\n'.format(gbw) + '\n'.join(lines)
+
+def read_orca_hessian(input_file, hess):
+    return input_file.rstrip('\n') + '\n%geom\ninhess read\ninhessname "{}"\nend\n'.format(hess)
+
+def add_gaussian_option(route, keyword, value):
+    '''
+        Adds an option to a keyword of a Gaussian route, merging it with the options already given
+    '''
+    match = re.search(r"\b{}\s*(?:=\s*\(([^)]*)\)|\(([^)]*)\)|=\s*([^\s,()]+))".format(keyword), route, re.IGNORECASE)
+    if match is None:
+        return route.rstrip() + " {}={}".format(keyword, value)
+
+    options = [o.strip() for o in next(g for g in match.groups() if g is not None).split(',')]
+    if value.lower() in [o.lower() for o in options]:
+        return route
+
+    return route[:match.start()] + "{}=({})".format(keyword, ','.join(options + [value])) + route[match.end():]
+
+def restart_gaussian_input(input_file, read_geometry, oldchk=None, read_fc=False):
+    '''
+        Makes a Gaussian input read the guess (and optionally the geometry) from a checkpoint file
+
+        By default, the checkpoint of the calculation itself is read.
+    '''
+    lines = input_file.split('\n')
+
+    route = None
+    for ind, line in enumerate(lines):
+        if line.startswith('#'):
+            route = ind
+            break
+
+    if route is None:
+        return input_file
+
+    lines[route] = add_gaussian_option(lines[route], 'guess', 'read')
+    if read_geometry and not re.search(r"\ballcheck\b", lines[route], re.IGNORECASE):
+        lines[route] = add_gaussian_option(lines[route], 'geom', 'check')
+
+    if read_fc:
+        lines[route] = lines[route].replace('CalcFC', 'ReadFC')
+
+    if read_geometry:
+        # Route, blank line, title, blank line, charge and multiplicity, then the coordinates
+        ind = route + 1
+        while ind < len(lines) and lines[ind].strip() != '':
+            ind += 1
+        ind += 1
+        while ind < len(lines) and lines[ind].strip() != '':
+            ind += 1
+        charge_line = ind + 1
+
+        end = charge_line + 1
+        while end < len(lines) and lines[end].strip() != '':
+            end += 1
+        lines = lines[:charge_line+1] + lines[end:]
+
+    if oldchk is not None:
+        lines.insert(0, '%oldchk={}'.format(oldchk))
+
+    return '\n'.join(lines)
+
+def prepare_restart(calc, workdir, in_file):
+    '''
+        Sets up a calculation to continue from the checkpoint files of a previous run, if any
+
+        Returns True if the calculation will restart.
+    '''
+    software = calc.parameters.software
+    geometry = calc.step.short_name in GEOMETRY_STEPS
+
+    if software == 'ORCA':
+        gbw = os.path.join(workdir, 'calc.gbw')
+        restart_gbw = os.path.join(workdir, ORCA_RESTART_GBW)
+
+        # ORCA overwrites the orbitals of the current run as soon as it starts
+        if os.path.isfile(gbw):
+            os.replace(gbw, restart_gbw)
+        elif not os.path.isfile(restart_gbw):
+            return False
+
+        xyz = None
+        trajectory = os.path.join(workdir, 'calc_trj.xyz')
+        if geometry and os.path.isfile(trajectory):
+            xyz = last_frame(trajectory)
+
+        calc.input_file = restart_orca_input(calc.input_file, xyz)
+        return True
+    elif software == 'Gaussian':
+        if not os.path.isfile(os.path.join(workdir, 'calc.chk')):
+            return False
+
+        calc.input_file = restart_gaussian_input(calc.input_file, geometry)
+        return True
+    elif software == 'xtb' and calc.step.short_name not in ['mep', 'optts']:
+        # xtb reads xtbrestart from its working directory by itself
+        restart = os.path.isfile(os.path.join(workdir, 'xtbrestart'))
+
+        trajectory = os.path.join(workdir, 'xtbopt.log')
+        if geometry and os.path.isfile(trajectory):
+            xyz = last_frame(trajectory)
+            if xyz is not None:
+                coords = xyz_coordinates(xyz)
+                with open(in_file, 'w') as out:
+                    out.write("{}\n\n{}\n".format(len(coords), '\n'.join(coords)))
+                restart = True
+        return restart
+    return False
+
+def orca_driven(calc):
+    # Some xtb steps are run through ORCA
+    return calc.parameters.software == 'ORCA' or (calc.parameters.software == 'xtb' and calc.step.short_name in ['mep', 'optts'])
+
+def find_parent(calc):
+    '''
+        Returns the last local calculation which gave the structure of a calculation, or None
+
+        This is either the calculation which created the structure or one which ran on it,
+        with the same software, charge and multiplicity.
+    '''
+    s = calc.structure
+    if s is None:
+        return None
+
+    origin = Q(structure=s)
+    if s.parent_ensemble_id is not None:
+        origin |= Q(order__result_ensemble_id=s.parent_ensemble_id, structure__number=s.number, step__creates_ensemble=True)
+
+    candidates = Calculation.objects.filter(origin, status=2, local=True, parameters__software=calc.parameters.software,
+            parameters__charge=calc.parameters.charge, parameters__multiplicity=calc.parameters.multiplicity).exclude(pk=calc.pk).select_related('step').order_by('-date_finished')[:10]
+
+    candidates = list(candidates)
+    if len(candidates) == 0:
+        return None
+
+    # A Hessian is worth more than orbitals for transition state searches
+    if calc.step.short_name == 'optts':
+        for c in candidates:
+            if c.step.short_name in FREQUENCY_STEPS:
+                return c
+    return candidates[0]
+
+def stage_file(parent_dir, name, workdir, staged_name):
+    path = os.path.join(parent_dir, name)
+    if not os.path.isfile(path):
+        return False
+
+    shutil.copyfile(path, os.path.join(workdir, staged_name))
+    return True
+
+def stage_parent(calc, workdir):
+    '''
+        Copies the wavefunction and Hessian of the parent calculation in the scratch directory and
+        makes the input read them
+
+        Returns True if anything was staged.
+    '''
+    parent = find_parent(calc)
+    if parent is None:
+        return False
+
+    parent_dir = os.path.join(CALCUS_SCR_HOME, str(parent.id))
+    software = calc.parameters.software
+    staged = False
+
+    if orca_driven(calc):
+        if not orca_driven(parent):
+            return False
+
+        if software == 'ORCA' and stage_file(parent_dir, 'calc.gbw', workdir, PARENT_GBW):
+            calc.input_file = restart_orca_input(calc.input_file, gbw=PARENT_GBW)
+            staged = True
+
+        if calc.step.short_name == 'optts' and stage_file(parent_dir, 'calc.hess', workdir, PARENT_HESS):
+            calc.input_file = read_orca_hessian(calc.input_file, PARENT_HESS)
+            staged = True
+    elif software == 'Gaussian':
+        if stage_file(parent_dir, 'calc.chk', workdir, PARENT_CHK):
+            read_fc = calc.step.short_name == 'optts' and parent.step.short_name in FREQUENCY_STEPS
+            calc.input_file = restart_gaussian_input(calc.input_file, False, oldchk=PARENT_CHK, read_fc=read_fc)
+            staged = True
+    elif software == 'xtb' and not orca_driven(parent):
+        # Read by xtb from its working directory
+        staged = stage_file(parent_dir, 'xtbrestart', workdir, 'xtbrestart')
+
+    if staged:
+        logger.info("Calc {} starts from the results of calc {}".format(calc.id, parent.id))
+    return staged
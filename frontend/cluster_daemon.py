@@ -84,6 +84,7 @@ if not is_test:
 from frontend.models import *
 from frontend.environment_variables import *
 from frontend import tasks
+from frontend.events import publish, calculation_channel
 
 class ClusterDaemon:
 
@@ -298,9 +299,7 @@ class ClusterDaemon:
                     # Special case where the resource has been deleted.
                     # As such, no thread will ever process the kill signal.
                     logger.info(f"Resource is null for calculation {calc.id}, cancelling directly")
-                    calc.status = 3
-                    calc.error_message = "Job cancelled"
-                    calc.save()
+                    calc.transition(3, error_message="Job cancelled")
                 return
 
             access = calc.order.resource
@@ -316,8 +315,7 @@ class ClusterDaemon:
             if cmd == "launch":
                 if calc.id in self.cancelled:
                     self.cancelled.remove(calc.id)
-                    calc.status = 3
-                    calc.save()
+                    calc.transition(3)
                     return
                 pid = threading.get_ident()
                 tasks.connections[pid] = self.connections
@@ -336,6 +334,7 @@ class ClusterDaemon:
                         logger.warning("Cannot load log: invalid access")
 
                     tasks.sftp_get("/home/{}/scratch/calcus/{}/calc.log".format(access.cluster_username, calc.id), os.path.join(CALCUS_SCR_HOME, str(calc.id), "calc.log"), remote_conn, self.locks[access.id])
+                    publish([calculation_channel(calc.id)], {'type': 'remote_log', 'calc': calc.id})
 
                 else:
                     logger.warning("Cannot load log: unknown calculation")
@@ -0,0 +1,87 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import json
+import logging
+
+import redis
+
+from .cache import get_connection
+
+logger = logging.getLogger(__name__)
+
+def profile_channel(profile_id):
+    return "events_profile_{}".format(profile_id)
+
+def calculation_channel(calc_id):
+    return "events_calc_{}".format(calc_id)
+
+def publish(channels, event):
+    msg = json.dumps(event)
+    try:
+        connection = get_connection()
+        for channel in channels:
+            connection.publish(channel, msg)
+    except redis.exceptions.RedisError as e:
+        # Events only spare the clients from polling, they must never make a calculation fail
+        logger.warning("Could not publish event: {}".format(str(e)))
+
+def publish_calculation(calc):
+    order = calc.order
+    event = {
+            'type': 'calculation',
+            'calc': calc.id,
+            'status': calc.status,
+            'order': order.id,
+            'order_status': order.status,
+            'new_status': order.new_status,
+            'queued': order.num_queued,
+            'running': order.num_running,
+            'done': order.num_done,
+            'error': order.num_error,
+        }
+    publish([profile_channel(order.author_id), calculation_channel(calc.id)], event)
+
+def publish_frames(calc, num_frames):
+    event = {
+            'type': 'frames',
+            'calc': calc.id,
+            'num_frames': num_frames,
+        }
+    publish([calculation_channel(calc.id)], event)
+
+def subscribe(channels):
+    connection = get_connection()
+    pubsub = connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*channels)
+    return pubsub
+
+def abort_channel(calc_id):
+    return "abort_calc_{}".format(calc_id)
+
+def publish_abort(calc_id):
+    publish([abort_channel(calc_id)], {'type': 'abort', 'calc': calc_id})
+
+def subscribe_abort(calc_id, handler):
+    connection = get_connection()
+    pubsub = connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**{abort_channel(calc_id): handler})
+    return pubsub
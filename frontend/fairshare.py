@@ -0,0 +1,292 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import os
+import json
+import logging
+
+from django.utils import timezone
+from django.db.models import Q
+
+from .models import Calculation, Profile, ResearchGroup
+from .cache import get_connection
+from .environment_variables import PAL
+from .prediction import RuntimePredictor
+from .routing import QUEUES, INTERACTIVE, BATCH, HEAVY
+from .scheduler import node_budget
+
+logger = logging.getLogger(__name__)
+
+# The local calculations are held back and only sent to the comp workers when a worker is
+# free. At that point, the next calculation is taken from the research group which used
+# the least computing time recently, and within it from the member who used the least.
+# Every research group has the same share of the node, which is split evenly between its
+# members. Users without a group are treated as a group of their own.
+
+PENDING_KEY = "fairshare_pending_{}_{}"
+PROFILES_KEY = "fairshare_profiles_{}"
+INFLIGHT_KEY = "fairshare_inflight_{}"
+USAGE_KEY = "fairshare_usage"
+FEED_LOCK = "fairshare_feed"
+
+USAGE_TIMEOUT = 60
+
+# Usage older than the window is forgotten and recent usage weighs more
+USAGE_WINDOW = 14*24*3600
+USAGE_HALF_LIFE = 2*24*3600
+
+# Cost (core-seconds) added to the usage of a user for each calculation sent when no prediction is available
+DEFAULT_COST = 3600
+
+# Age (seconds) from which queued calculations missing from the lines are considered lost
+RECOVERY_DELAY = 5*60
+
+def capacity(queue):
+    '''
+        Number of calculations which can be sent to the workers of a queue
+    '''
+    cores, mem = node_budget()
+    slots = {
+            QUEUES[INTERACTIVE]: cores,
+            QUEUES[BATCH]: int(os.environ.get("BATCH_WORKERS", cores)),
+            QUEUES[HEAVY]: int(os.environ.get("HEAVY_WORKERS", 1)),
+        }
+    return slots.get(queue, cores)
+
+def profile_groups():
+    '''
+        Returns the key of the group of every profile
+    '''
+    groups = {}
+    for pk, group_id in Profile.objects.values_list('id', 'member_of_id'):
+        if group_id is not None:
+            groups[pk] = "g{}".format(group_id)
+        else:
+            groups[pk] = "p{}".format(pk)
+
+    for group_id, pi_id in ResearchGroup.objects.filter(PI__isnull=False).order_by('-id').values_list('id', 'PI_id'):
+        groups[pi_id] = "g{}".format(group_id)
+    return groups
+
+def compute_usage():
+    '''
+        Returns the recent usage (core-seconds) of every profile, with an exponential decay
+    '''
+    now = timezone.now()
+    since = now - timezone.timedelta(seconds=USAGE_WINDOW)
+
+    usage = {}
+    calcs = Calculation.objects.filter(local=True, date_started__gte=since).values_list('order__author_id', 'date_started', 'date_finished', 'nproc')
+    for author, started, finished, nproc in calcs:
+        if author is None:
+            continue
+        if finished is None:
+            finished = now
+
+        cost = (finished - started).total_seconds()*(nproc or int(PAL))
+        weight = 0.5**((now - finished).total_seconds()/USAGE_HALF_LIFE)
+        usage[author] = usage.get(author, 0) + max(cost, 0)*weight
+    return usage
+
+def get_usage(connection):
+    cached = connection.get(USAGE_KEY)
+    if cached is not None:
+        return {int(k): v for k, v in json.loads(cached).items()}
+
+    usage = compute_usage()
+    connection.set(USAGE_KEY, json.dumps(usage), ex=USAGE_TIMEOUT)
+    return usage
+
+def submit(profile_id, calc_ids, queue):
+    '''
+        Adds calculations to the line of their author
+    '''
+    if len(calc_ids) == 0:
+        return
+
+    pipe = get_connection().pipeline()
+    pipe.rpush(PENDING_KEY.format(queue, profile_id), *calc_ids)
+    pipe.sadd(PROFILES_KEY.format(queue), profile_id)
+    pipe.execute()
+
+def finished(calc_id, queue):
+    get_connection().srem(INFLIGHT_KEY.format(queue), calc_id)
+
+def clean_inflight(connection, queue):
+    # Calculations which were cancelled before starting never report back
+    key = INFLIGHT_KEY.format(queue)
+    ids = [int(i) for i in connection.smembers(key)]
+    active = set(Calculation.objects.filter(pk__in=ids, status__in=[0, 1]).values_list('id', flat=True))
+
+    gone = [i for i in ids if i not in active]
+    if len(gone) > 0:
+        connection.srem(key, *gone)
+    return len(active)
+
+def next_profile(profiles, usage, groups):
+    def priority(profile):
+        group = groups.get(profile, "p{}".format(profile))
+        group_usage = sum(u for p, u in usage.items() if groups.get(p) == group)
+        return (group_usage, usage.get(profile, 0), profile)
+    return min(profiles, key=priority)
+
+def feed_queue(connection, queue, usage, groups, predictor):
+    '''
+        Takes the next calculations of a queue, as many as its workers can take
+
+        Returns them as (calculation, profile) pairs. They are already counted as sent.
+    '''
+    free = capacity(queue) - clean_inflight(connection, queue)
+
+    profiles = set(int(i) for i in connection.smembers(PROFILES_KEY.format(queue)))
+    taken = []
+    while free > 0 and len(profiles) > 0:
+        profile = next_profile(profiles, usage, groups)
+        pending_key = PENDING_KEY.format(queue, profile)
+
+        calc_id = connection.lpop(pending_key)
+        if calc_id is None:
+            connection.srem(PROFILES_KEY.format(queue), profile)
+            # Calculations submitted in the meantime
+            if connection.llen(pending_key) > 0:
+                connection.sadd(PROFILES_KEY.format(queue), profile)
+            else:
+                profiles.remove(profile)
+            continue
+
+        # Cancelled while waiting
+        calc = Calculation.objects.filter(pk=int(calc_id), status=0).select_related('parameters', 'step', 'structure', 'order__resource').first()
+        if calc is None:
+            continue
+
+        connection.sadd(INFLIGHT_KEY.format(queue), calc.id)
+        taken.append((calc, profile))
+        free -= 1
+
+        # The next calculations go to the others first
+        usage[profile] = usage.get(profile, 0) + (predictor.core_seconds(calc) or DEFAULT_COST)
+    return taken
+
+def put_back(connection, batch):
+    '''
+        Returns calculations which could not be sent to the head of the line of their author
+    '''
+    pipe = connection.pipeline()
+    for calc, queue, profile in reversed(batch):
+        pipe.lpush(PENDING_KEY.format(queue, profile), calc.id)
+        pipe.sadd(PROFILES_KEY.format(queue), profile)
+        pipe.srem(INFLIGHT_KEY.format(queue), calc.id)
+    pipe.execute()
+
+def feed(launch):
+    '''
+        Sends the next calculations to the comp workers which are free
+
+        The calculations are given all at once to launch() as a list of (calculation, queue).
+        If it fails, they are put back in their line. Returns the number of calculations sent.
+    '''
+    connection = get_connection()
+    with connection.lock(FEED_LOCK, timeout=60):
+        usage = get_usage(connection)
+        groups = profile_groups()
+        predictor = RuntimePredictor()
+
+        batch = []
+        for queue in QUEUES.values():
+            batch += [(calc, queue, profile) for calc, profile in feed_queue(connection, queue, usage, groups, predictor)]
+
+        if len(batch) == 0:
+            return 0
+
+        try:
+            launch([(calc, queue) for calc, queue, profile in batch])
+        except Exception:
+            put_back(connection, batch)
+            raise
+
+        # Until the next refresh, the calculations just sent count in the usage of their author
+        ttl = connection.ttl(USAGE_KEY)
+        if ttl > 0:
+            connection.set(USAGE_KEY, json.dumps(usage), ex=ttl)
+        return len(batch)
+
+def tracked_calcs(connection):
+    '''
+        Returns the ids of the calculations waiting in a line or sent to the workers
+    '''
+    ids = set()
+    for queue in QUEUES.values():
+        ids |= set(int(i) for i in connection.smembers(INFLIGHT_KEY.format(queue)))
+        for profile in connection.smembers(PROFILES_KEY.format(queue)):
+            ids |= set(int(i) for i in connection.lrange(PENDING_KEY.format(queue, int(profile)), 0, -1))
+    return ids
+
+def lost_calcs():
+    '''
+        Returns the queued local calculations which are in no line, e.g. after Redis lost its data
+    '''
+    connection = get_connection()
+
+    # Calculations which were just created might not be in their line yet
+    since = timezone.now() - timezone.timedelta(seconds=RECOVERY_DELAY)
+    calcs = Calculation.objects.filter(Q(date_submitted__lt=since) | Q(date_submitted__isnull=True), local=True, status=0)
+
+    # No calculation is between its line and the workers while the lock is held
+    with connection.lock(FEED_LOCK, timeout=60):
+        return list(calcs.exclude(pk__in=tracked_calcs(connection)).select_related('order', 'parameters', 'step', 'structure'))
+
+def summary():
+    '''
+        Returns the recent usage and share of the research groups and users
+    '''
+    connection = get_connection()
+    usage = get_usage(connection)
+    groups = profile_groups()
+
+    pending = {}
+    for queue in QUEUES.values():
+        for profile in connection.smembers(PROFILES_KEY.format(queue)):
+            profile = int(profile)
+            pending[profile] = pending.get(profile, 0) + connection.llen(PENDING_KEY.format(queue, profile))
+
+    active = set(p for p, u in usage.items() if u > 0) | set(p for p, n in pending.items() if n > 0)
+    if len(active) == 0:
+        return []
+
+    active_groups = set(groups.get(p, "p{}".format(p)) for p in active)
+    total = sum(usage.values()) or 1
+
+    profiles = Profile.objects.in_bulk(list(active))
+    group_names = dict(ResearchGroup.objects.values_list('id', 'name'))
+
+    rows = []
+    for p in active:
+        group = groups.get(p, "p{}".format(p))
+        members = [i for i in active if groups.get(i, "p{}".format(i)) == group]
+        rows.append({
+            'username': profiles[p].username if p in profiles else p,
+            'group': group_names.get(int(group[1:])) if group.startswith('g') else None,
+            'core_hours': usage.get(p, 0)/3600,
+            'usage': 100*usage.get(p, 0)/total,
+            'share': 100/len(active_groups)/len(members),
+            'pending': pending.get(p, 0),
+        })
+    return sorted(rows, key=lambda r: (r['group'] or '', str(r['username'])))
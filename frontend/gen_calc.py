@@ -71,7 +71,7 @@ def gen_param(params):
 
     software = params['software']
 
-    p = Parameters.objects.create(charge=charge, multiplicity=multiplicity, solvent=solvent, solvation_model=solvation_model, solvation_radii=solvation_radii, basis_set=basis_set, theory_level=theory_level, method=method, custom_basis_sets=custom_basis_sets, density_fitting=density_fitting, specifications=specifications, software=software)
+    p = Parameters.objects.get_or_create_by_hash(charge=charge, multiplicity=multiplicity, solvent=solvent, solvation_model=solvation_model, solvation_radii=solvation_radii, basis_set=basis_set, theory_level=theory_level, method=method, custom_basis_sets=custom_basis_sets, density_fitting=density_fitting, specifications=specifications, software=software)
     return p
 
 def gen_calc(params, profile):
@@ -0,0 +1,125 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import os
+import time
+import random
+import tempfile
+
+from django.core.management.base import BaseCommand
+from frontend.environment_variables import CALCUS_RESULTS_HOME
+from frontend.storage import write_compressed, open_compressed, copy_result, compressed_path, COMPRESSED_EXT, MIN_COMPRESSED_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Measures the compression ratio and read latency of the compressed results on a sample of result files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=50, help='Number of result files to sample')
+        parser.add_argument('--reads', type=int, default=100, help='Number of random reads per file')
+        parser.add_argument('--read-size', type=int, default=4096, help='Size of the random reads in bytes')
+
+    def handle(self, *args, **options):
+        paths = self.sample(options['files'])
+        if len(paths) == 0:
+            self.stdout.write("No result file to benchmark")
+            return
+
+        size = 0
+        compressed_size = 0
+        compression_time = 0
+        full_reads = {'plain': [], 'compressed': []}
+        random_reads = {'plain': [], 'compressed': []}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for ind, path in enumerate(paths):
+                # Both versions are read from the same filesystem
+                plain = os.path.join(tmpdir, str(ind))
+                copy_result(path, plain)
+
+                start = time.perf_counter()
+                write_compressed(plain, plain)
+                compression_time += time.perf_counter() - start
+
+                file_size = os.path.getsize(plain)
+                size += file_size
+                compressed_size += os.path.getsize(compressed_path(plain))
+
+                openers = {
+                        'plain': lambda: open(plain, 'rb'),
+                        'compressed': lambda: open_compressed(plain, 'rb'),
+                    }
+                for name, opener in openers.items():
+                    start = time.perf_counter()
+                    with opener() as f:
+                        f.read()
+                    full_reads[name].append(time.perf_counter() - start)
+
+                    with opener() as f:
+                        for i in range(options['reads']):
+                            offset = random.randrange(max(file_size - options['read_size'], 1))
+                            start = time.perf_counter()
+                            f.seek(offset)
+                            f.read(options['read_size'])
+                            random_reads[name].append(time.perf_counter() - start)
+
+        self.stdout.write("Files: {} ({:.1f} MB)".format(len(paths), size/1024**2))
+        self.stdout.write("Compression ratio: {:.2f} ({:.1f} MB compressed)".format(size/max(compressed_size, 1), compressed_size/1024**2))
+        self.stdout.write("Compression speed: {:.1f} MB/s".format(size/1024**2/max(compression_time, 1e-9)))
+        for name in ['plain', 'compressed']:
+            self.stdout.write("Full read ({}): {:.2f} ms per file on average".format(name, 1000*sum(full_reads[name])/len(full_reads[name])))
+            self.stdout.write("Random read of {} bytes ({}): {}".format(options['read_size'], name, self.latency(random_reads[name])))
+
+    def sample(self, num_files):
+        '''
+            Picks result files from random calculations, compressed or not
+        '''
+        if not os.path.isdir(CALCUS_RESULTS_HOME):
+            return []
+
+        dirs = os.listdir(CALCUS_RESULTS_HOME)
+        random.shuffle(dirs)
+
+        paths = []
+        for d in dirs:
+            directory = os.path.join(CALCUS_RESULTS_HOME, d)
+            if not os.path.isdir(directory):
+                continue
+
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if not os.path.isfile(path) or name.endswith('.part'):
+                    continue
+
+                if name.endswith(COMPRESSED_EXT):
+                    path = path[:-len(COMPRESSED_EXT)]
+                elif os.path.getsize(path) < MIN_COMPRESSED_SIZE:
+                    continue
+                paths.append(path)
+                if len(paths) == num_files:
+                    return paths
+        return paths
+
+    def latency(self, times):
+        if len(times) == 0:
+            return "-"
+        times = sorted(times)
+        return "{:.3f} ms on average, {:.3f} ms at the 95th percentile".format(1000*sum(times)/len(times), 1000*times[int(0.95*(len(times)-1))])
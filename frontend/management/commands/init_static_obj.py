@@ -71,6 +71,8 @@ class Command(BaseCommand):
 
         self.add_step("Frequency Calculation", "freq", creates_ensemble=False, avail_xtb=True, avail_Gaussian=True, avail_ORCA=True)
 
+        self.add_step("Optimisation and Frequency Calculation", "opt_freq", creates_ensemble=True, avail_xtb=True, avail_Gaussian=True, avail_ORCA=True)
+
         self.add_step("TS Optimisation", "optts", creates_ensemble=True, avail_xtb=True, avail_Gaussian=True, avail_ORCA=True)
 
         self.add_step("UV-Vis Calculation", "uvvis", creates_ensemble=False, avail_xtb=True, avail_Gaussian=True, avail_ORCA=False)
@@ -0,0 +1,90 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from frontend.models import *
+
+
+class Command(BaseCommand):
+    help = 'Computes the stored hash of all parameters and merges the duplicate parameters into a single object'
+
+    MERGED_PROPERTY_FIELDS = ['energy', 'free_energy', 'homo_lumo_gap', 'uvvis', 'nmr', 'mo', 'freq', 'simple_nmr', 'charges', 'geom']
+
+    def handle(self, *args, **options):
+        # Also run before the migrations, since the unique index on the hash cannot be created while duplicates exist
+        tables = connection.introspection.table_names()
+        if Parameters._meta.db_table not in tables or 'md5' not in self.columns(Parameters._meta.db_table):
+            self.stdout.write("The parameters have no stored hash yet")
+            return
+
+        groups = {}
+        stored = {}
+        for p in Parameters.objects.only('id', 'md5', *Parameters.HASHED_FIELDS).order_by('id').iterator():
+            md5 = p.compute_md5()
+            groups.setdefault(md5, []).append(p.id)
+            stored[p.id] = p.md5
+
+        # Every reference to the parameters, including the ones added after this command
+        relations = [rel for rel in Parameters._meta.related_objects if rel.related_model._meta.db_table in tables]
+
+        num_merged = 0
+        for md5, ids in groups.items():
+            if len(ids) < 2:
+                continue
+
+            main_id, others = ids[0], ids[1:]
+            with transaction.atomic():
+                for rel in relations:
+                    rel.related_model.objects.filter(**{'{}__in'.format(rel.field.name): others}).update(**{rel.field.name: main_id})
+
+                self.merge_properties(main_id)
+
+                Parameters.objects.filter(id__in=others).delete()
+                num_merged += len(others)
+
+        # Only the remaining parameters get their hash, which is unique
+        to_update = []
+        for md5, ids in groups.items():
+            if stored[ids[0]] != md5:
+                to_update.append(Parameters(id=ids[0], md5=md5))
+        Parameters.objects.bulk_update(to_update, ['md5'], batch_size=1000)
+
+        self.stdout.write("Merged {} duplicate parameters".format(num_merged))
+
+    def columns(self, table):
+        with connection.cursor() as cursor:
+            return [c.name for c in connection.introspection.get_table_description(cursor, table)]
+
+    def merge_properties(self, params_id):
+        # Structures now have one property per set of parameters: keep the latest and fill its blanks with the older ones
+        structures = Property.objects.filter(parameters=params_id).values('parent_structure').annotate(num=Count('id')).filter(num__gt=1)
+
+        for s in structures:
+            props = list(Property.objects.filter(parameters=params_id, parent_structure=s['parent_structure']).only('id', *self.MERGED_PROPERTY_FIELDS).order_by('-id'))
+            main = props[0]
+            for prop in props[1:]:
+                for field in self.MERGED_PROPERTY_FIELDS:
+                    if not getattr(main, field) and getattr(prop, field):
+                        setattr(main, field, getattr(prop, field))
+            main.save(update_fields=self.MERGED_PROPERTY_FIELDS)
+            Property.objects.filter(id__in=[prop.id for prop in props[1:]]).delete()
@@ -18,88 +18,56 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 
-import glob
-import os
 from django.core.management.base import BaseCommand
+from django.db.models import Count, F, Case, When, IntegerField
 from frontend.models import *
 
 
 class Command(BaseCommand):
     help = 'Refreshes the cached information about projects and molecules, such as the calculation statistics'
 
-
     def handle(self, *args, **options):
-        for profile in Profile.objects.all():
-            profile.unseen_calculations = 0
-            for o in profile.calculationorder_set.all():
-                if o.new_status:
-                    profile.unseen_calculations += 1
-            profile.save()
-
-        for proj in Project.objects.all():
-
-            dnum = {}
-            dcompleted = {}
-            dqueued = {}
-            drunning = {}
-
-            molecules = proj.molecule_set.all()
-            num = 0
-            completed = 0
-            queued = 0
-            running = 0
-
-            for mol in molecules:
-                dnum[mol.id] = 0
-                dcompleted[mol.id] = 0
-                dqueued[mol.id] = 0
-                drunning[mol.id] = 0
-
-            for o in proj.calculationorder_set.all():
-                num += o.calculation_set.count()
-                for c in o.calculation_set.all():
-                    s = c.status
-                    if s == 0:
-                        queued += 1
-                    elif s == 1:
-                        running += 1
-                    else:
-                        completed += 1
-                if o.ensemble != None:
-                    mol = o.ensemble.parent_molecule
-                    if mol is not None:
-                        dnum[mol.id] += o.calculation_set.count()
-                        for c in o.calculation_set.all():
-                            s = c.status
-                            if s == 0:
-                                dqueued[mol.id] += 1
-                            elif s == 1:
-                                drunning[mol.id] += 1
-                            else:
-                                dcompleted[mol.id] += 1
-                elif o.structure != None:
-                    mol = o.structure.parent_ensemble.parent_molecule
-                    if mol is not None:
-                        dnum[mol.id] += o.calculation_set.count()
-                        for c in o.calculation_set.all():
-                            s = c.status
-                            if s == 0:
-                                dqueued[mol.id] += 1
-                            elif s == 1:
-                                drunning[mol.id] += 1
-                            else:
-                                dcompleted[mol.id] += 1
-
-            proj.num_calc = num
-            proj.num_calc_queued = queued
-            proj.num_calc_running = running
-            proj.num_calc_completed = completed
-            proj.save()
-
-            for mol in molecules:
-                mol.num_calc = dnum[mol.id]
-                mol.num_calc_queued = dqueued[mol.id]
-                mol.num_calc_running = drunning[mol.id]
-                mol.num_calc_completed = dcompleted[mol.id]
-                mol.save()
-
+        counts = {}
+        for entry in Calculation.objects.values('order', 'status').annotate(num=Count('id')):
+            if entry['order'] not in counts:
+                counts[entry['order']] = {i: 0 for i in range(4)}
+            counts[entry['order']][entry['status']] = entry['num']
+
+        orders = []
+        for o in CalculationOrder.objects.only('id', *CalculationOrder.COUNTER_FIELDS).iterator():
+            res = counts.get(o.id, {i: 0 for i in range(4)})
+            for status, field in CalculationOrder.STATUS_COUNTERS.items():
+                setattr(o, field, res[status])
+            o.status = o._status(*o.get_all_calcs)
+            orders.append(o)
+        CalculationOrder.objects.bulk_update(orders, CalculationOrder.COUNTER_FIELDS, batch_size=1000)
+
+        Profile.reconcile_unseen()
+
+        project_counts = Calculation.objects.values('status', key=F('order__project')).annotate(num=Count('id'))
+        self.refresh_counters(Project, project_counts)
+
+        molecule = Case(
+                When(order__ensemble__isnull=False, then=F('order__ensemble__parent_molecule')),
+                default=F('order__structure__parent_ensemble__parent_molecule'),
+                output_field=IntegerField(),
+            )
+        molecule_counts = Calculation.objects.values('status', key=molecule).annotate(num=Count('id'))
+        self.refresh_counters(Molecule, molecule_counts)
+
+    def refresh_counters(self, model, entries):
+        counts = {}
+        for entry in entries:
+            if entry['key'] is None:
+                continue
+            if entry['key'] not in counts:
+                counts[entry['key']] = {f: 0 for f in CalculationCounters.COUNTER_FIELDS}
+            counts[entry['key']]['num_calc'] += entry['num']
+            counts[entry['key']][CalculationCounters.STATUS_COUNTERS[entry['status']]] += entry['num']
+
+        objs = []
+        for obj in model.objects.only('id', *CalculationCounters.COUNTER_FIELDS).iterator():
+            for field, num in counts.get(obj.id, {f: 0 for f in CalculationCounters.COUNTER_FIELDS}).items():
+                setattr(obj, field, num)
+            objs.append(obj)
+        model.objects.bulk_update(objs, CalculationCounters.COUNTER_FIELDS, batch_size=1000)
@@ -18,24 +18,30 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 
-from django.db import models, transaction
+from django.db import models, transaction, IntegrityError
+from django.db.models.functions import Greatest
 from django.db.models.signals import pre_save
 from django.utils import timezone
 from django.contrib.auth.models import User, Group
-from django.db.models.signals import post_save, post_init
+from django.db.models.signals import post_save, post_init, post_delete
 from django.dispatch import receiver
 from django import template
 import random, string
 import numpy as np
 import os
 import hashlib
+from collections import Counter
 
 from .constants import *
+from .events import publish_calculation
+from .cache import invalidate_related_profiles, invalidate_ensemble_map, bump_fragment_version, add_deleted_order, claim_order_estimate
 
 register = template.Library()
 
 STATUS_COLORS = {0: '#AAAAAA', 1: '#FFE515', 2: '#1EE000', 3: '#FD1425'}
 
+BULK_BATCH_SIZE = 500
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
@@ -57,6 +63,31 @@ class Profile(models.Model):
 
     INV_UNITS = {v: k for k, v in UNITS.items()}
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_group = (instance.__dict__.get('is_PI'), instance.__dict__.get('member_of_id'))
+        return instance
+
+    @property
+    def group_changed(self):
+        return getattr(self, '_loaded_group', None) != (self.is_PI, self.member_of_id)
+
+    def add_unseen(self, num):
+        # Atomic update, so that concurrent workers never wait on the profile row
+        Profile.objects.filter(pk=self.pk).update(unseen_calculations=Greatest(models.F('unseen_calculations') + num, 0))
+
+    @classmethod
+    def reconcile_unseen(cls):
+        counts = dict(CalculationOrder.objects.exclude(status=models.F('last_seen_status')).values('author').annotate(num=models.Count('id')).values_list('author', 'num'))
+
+        num_fixed = 0
+        for pk, unseen in cls.objects.values_list('id', 'unseen_calculations'):
+            if unseen != counts.get(pk, 0):
+                cls.objects.filter(pk=pk).update(unseen_calculations=counts.get(pk, 0))
+                num_fixed += 1
+        return num_fixed
+
     @property
     def pref_units_name(self):
         return self.UNITS[self.pref_units]
@@ -90,7 +121,7 @@ class Profile(models.Model):
     @property
     def group(self):
         if self.is_PI:
-            return self.researchgroup_PI.all()[0]
+            return self.researchgroup_PI.first()
         else:
             return self.member_of
 
@@ -112,12 +143,60 @@ class ResearchGroup(Group):
     def __repr__(self):
         return self.name
 
+@receiver(post_save, sender=Profile)
+def profile_group_changed(sender, instance, created, **kwargs):
+    if created or instance.group_changed:
+        invalidate_related_profiles()
+        instance._loaded_group = (instance.is_PI, instance.member_of_id)
+
+@receiver(post_save, sender=ResearchGroup)
+@receiver(post_delete, sender=ResearchGroup)
+@receiver(post_delete, sender=Profile)
+def research_group_changed(sender, instance, **kwargs):
+    invalidate_related_profiles()
+
 class PIRequest(models.Model):
     issuer = models.ForeignKey(Profile, on_delete=models.CASCADE, blank=True, null=True)
     group_name = models.CharField(max_length=100)
     date_issued = models.DateTimeField('date')
 
-class Project(models.Model):
+class CalculationCounters(models.Model):
+    num_calc = models.PositiveIntegerField(default=0)
+    num_calc_queued = models.PositiveIntegerField(default=0)
+    num_calc_running = models.PositiveIntegerField(default=0)
+    num_calc_completed = models.PositiveIntegerField(default=0)
+
+    COUNTER_FIELDS = ['num_calc', 'num_calc_queued', 'num_calc_running', 'num_calc_completed']
+    STATUS_COUNTERS = {0: 'num_calc_queued', 1: 'num_calc_running', 2: 'num_calc_completed', 3: 'num_calc_completed'}
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        # The counters are only modified through atomic updates (see CalculationOrder.update_counters)
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in self.COUNTER_FIELDS]
+        super(CalculationCounters, self).save(*args, **kwargs)
+
+    @classmethod
+    def counter_changes(cls, old_calc_status, new_calc_status, num=1):
+        changes = {}
+
+        if old_calc_status is None:
+            changes['num_calc'] = changes.get('num_calc', 0) + num
+        else:
+            field = cls.STATUS_COUNTERS[old_calc_status]
+            changes[field] = changes.get(field, 0) - num
+
+        if new_calc_status is None:
+            changes['num_calc'] = changes.get('num_calc', 0) - num
+        else:
+            field = cls.STATUS_COUNTERS[new_calc_status]
+            changes[field] = changes.get(field, 0) + num
+
+        return {field: Greatest(models.F(field) + num, 0) for field, num in changes.items() if num != 0}
+
+class Project(CalculationCounters):
     name = models.CharField(max_length=100)
     author = models.ForeignKey(Profile, on_delete=models.CASCADE, blank=True, null=True)
     private = models.PositiveIntegerField(default=0)
@@ -195,12 +274,17 @@ class Ensemble(models.Model):
     @property
     def get_node_color(self):
         orders = self.result_of.all()
-        if len(orders) == 0:
-            return STATUS_COLORS[2]
         statuses = [i.status for i in orders]
         orders2 = self.calculationorder_set.all()
         statuses += [i.status for i in orders2 if not i.step.creates_ensemble]
 
+        return Ensemble.node_color(len(orders) > 0, statuses)
+
+    @staticmethod
+    def node_color(has_result, statuses):
+        if not has_result:
+            return STATUS_COLORS[2]
+
         if len(statuses) == 0:
             return STATUS_COLORS[0]
 
@@ -215,6 +299,22 @@ class Ensemble(models.Model):
 
         return STATUS_COLORS[0]
 
+    @staticmethod
+    def with_node_statuses(queryset):
+        # Uses the denormalized status of the orders, so that the whole graph is fetched in one query
+        result_orders = CalculationOrder.objects.filter(result_ensemble=models.OuterRef('pk'))
+        step_orders = CalculationOrder.objects.filter(ensemble=models.OuterRef('pk'), step__creates_ensemble=False)
+
+        annotations = {'has_result': models.Exists(result_orders)}
+        for status in STATUS_COLORS.keys():
+            annotations['result_status_{}'.format(status)] = models.Exists(result_orders.filter(status=status))
+            annotations['step_status_{}'.format(status)] = models.Exists(step_orders.filter(status=status))
+        return queryset.annotate(**annotations)
+
+    @staticmethod
+    def annotated_node_color(e):
+        statuses = [status for status in STATUS_COLORS.keys() if getattr(e, 'result_status_{}'.format(status)) or getattr(e, 'step_status_{}'.format(status))]
+        return Ensemble.node_color(e.has_result, statuses)
 
     @property
     def unique_parameters(self):
@@ -338,7 +438,7 @@ class Ensemble(models.Model):
 
         ret = {}
         hashes = {}
-        for s in self.structure_set.prefetch_related('properties').order_by('number').all():
+        for s in self.structure_set.prefetch_related('properties__parameters').order_by('number').all():
             for prop in s.properties.all():
                 if prop.energy == 0:
                     continue
@@ -383,7 +483,7 @@ class Ensemble(models.Model):
 
         arr_e = {}
         arr_f_e = {}
-        for s in self.structure_set.prefetch_related('properties').all():
+        for s in self.structure_set.prefetch_related('properties__parameters').all():
             for prop in s.properties.all():
                 if prop.energy == 0:
                     continue
@@ -478,6 +578,12 @@ class Ensemble(models.Model):
                 shift.append((float(shift[2])-b)/m)
         return shifts
 
+@receiver(post_save, sender=Ensemble)
+@receiver(post_delete, sender=Ensemble)
+def ensemble_map_changed(sender, instance, **kwargs):
+    invalidate_ensemble_map(instance.parent_molecule_id)
+    bump_fragment_version(instance.parent_molecule_id)
+
 @receiver(pre_save, sender=Ensemble)
 def handle_folder(sender, instance, **kwargs):
     try:
@@ -521,6 +627,20 @@ class Structure(models.Model):
     number = models.PositiveIntegerField(default=1)
     degeneracy = models.PositiveIntegerField(default=1)
 
+def structure_molecule_id(structure_id):
+    return Structure.objects.filter(pk=structure_id).values_list('parent_ensemble__parent_molecule', flat=True).first()
+
+@receiver(post_save, sender=Structure)
+@receiver(post_delete, sender=Structure)
+def structure_changed(sender, instance, **kwargs):
+    molecule_id = Ensemble.objects.filter(pk=instance.parent_ensemble_id).values_list('parent_molecule', flat=True).first()
+    bump_fragment_version(molecule_id)
+
+@receiver(post_save, sender=Property)
+@receiver(post_delete, sender=Property)
+def property_changed(sender, instance, **kwargs):
+    bump_fragment_version(structure_molecule_id(instance.parent_structure_id))
+
 class CalculationFrame(models.Model):
     parent_calculation = models.ForeignKey('Calculation', on_delete=models.CASCADE, blank=True, null=True)
 
@@ -531,6 +651,23 @@ class CalculationFrame(models.Model):
 
     number = models.PositiveIntegerField(default=0)
 
+class ParametersManager(models.Manager):
+    def get_or_create_by_hash(self, **kwargs):
+        params = self.model(**kwargs)
+        params.md5 = params.compute_md5()
+
+        existing = self.filter(md5=params.md5).first()
+        if existing is not None:
+            return existing
+
+        try:
+            with transaction.atomic():
+                params.save()
+        except IntegrityError:
+            # Created by a concurrent request
+            return self.get(md5=params.md5)
+        return params
+
 class Parameters(models.Model):
     name = models.CharField(max_length=100, default="Nameless parameters")
     charge = models.IntegerField()
@@ -546,6 +683,15 @@ class Parameters(models.Model):
     density_fitting = models.CharField(max_length=1000, default='')
     custom_basis_sets = models.CharField(max_length=1000, default='')
 
+    md5 = models.CharField(max_length=32, blank=True, null=True, unique=True)
+
+    objects = ParametersManager()
+
+    HASHED_FIELDS = ['name', 'charge', 'multiplicity', 'solvent', 'solvation_model', 'solvation_radii', 'software', 'basis_set', 'theory_level', 'method', 'specifications', 'density_fitting', 'custom_basis_sets']
+
+    # Keywords which the programs read regardless of case, the other fields are kept as given
+    CASE_INSENSITIVE_FIELDS = ['solvent', 'solvation_model', 'solvation_radii', 'software', 'basis_set', 'theory_level', 'method', 'density_fitting']
+
     def __repr__(self):
         return "{} - {} ({})".format(self.software, self.method, self.solvent)
 
@@ -575,31 +721,38 @@ class Parameters(models.Model):
         return self.__repr__()
 
     def __eq__(self, other):
-        values = [(k,v) for k,v in self.__dict__.items() if k != '_state' and k != 'id']
-        other_values = [(k,v) for k,v in other.__dict__.items() if k != '_state' and k != 'id']
-
-        #Not sure
-        #values = [(k,v) for k,v in self.__dict__.items() if k not in ['_state', 'id', 'specifications']]
-        #other_values = [(k,v) for k,v in other.__dict__.items() if k not in ['_state', 'id', 'specifications']]
+        if not isinstance(other, Parameters):
+            return False
+        return self.compute_md5() == other.compute_md5()
 
-        return values == other_values
+    def field_values(self):
+        return {k: getattr(self, k) for k in self.HASHED_FIELDS}
 
-    @property
-    def md5(self):
-        values = [(k,v) for k,v in self.__dict__.items() if k != '_state' and k != 'id']
+    def compute_md5(self):
         params_str = ""
-        for k, v in values:
+        for k in self.HASHED_FIELDS:
+            v = self._meta.get_field(k).to_python(getattr(self, k))
             if isinstance(v, int):
                 params_str += "{}={};".format(k, v)
             elif isinstance(v, str):
-                params_str += "{}={};".format(k, v.lower())
+                if k in self.CASE_INSENSITIVE_FIELDS:
+                    v = v.lower()
+                params_str += "{}={};".format(k, v)
             else:
                 raise Exception("Unknown value type")
-        hash = hashlib.md5(bytes(params_str, 'UTF-8'))
-        return hash.digest()
+        return hashlib.md5(bytes(params_str, 'UTF-8')).hexdigest()
 
+    def derive(self, **kwargs):
+        values = self.field_values()
+        values.update(kwargs)
+        return Parameters.objects.get_or_create_by_hash(**values)
 
-class Molecule(models.Model):
+    def save(self, *args, **kwargs):
+        self.md5 = self.compute_md5()
+        super().save(*args, **kwargs)
+
+
+class Molecule(CalculationCounters):
     name = models.CharField(max_length=100)
     inchi = models.CharField(max_length=1000, default="", blank=True, null=True)
     project = models.ForeignKey(Project, on_delete=models.CASCADE, blank=True, null=True)
@@ -636,20 +789,60 @@ class CalculationOrder(models.Model):
 
     resource = models.ForeignKey('ClusterAccess', on_delete=models.SET_NULL, blank=True, null=True)
 
-    def see(self):
-        if self.last_seen_status != self.status:
-            self.last_seen_status = self.status
-            self.save()
+    # Resources chosen by the user for each calculation, estimated automatically if 0
+    nproc = models.PositiveIntegerField(default=0)
+    mem = models.PositiveIntegerField(default=0)
 
-            with transaction.atomic():
-                p = Profile.objects.select_for_update().get(id=self.author.id)
-                p.unseen_calculations = max(p.unseen_calculations-1, 0) # Glitches may screw up the count...
-                p.save()
-        else:
+    # Denormalized from the calculations, only modified through update_counters
+    num_queued = models.PositiveIntegerField(default=0)
+    num_running = models.PositiveIntegerField(default=0)
+    num_done = models.PositiveIntegerField(default=0)
+    num_error = models.PositiveIntegerField(default=0)
+    status = models.PositiveIntegerField(default=0, db_index=True)
+
+    last_update = models.DateTimeField(auto_now=True, null=True, blank=True, db_index=True)
+
+    # Predicted when the calculations of the order transition, so that listing the orders needs no prediction
+    estimated_end = models.DateTimeField(null=True, blank=True)
+
+    COUNTER_FIELDS = ['num_queued', 'num_running', 'num_done', 'num_error', 'status']
+    STATUS_COUNTERS = {0: 'num_queued', 1: 'num_running', 2: 'num_done', 3: 'num_error'}
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['author', 'hidden', 'date']),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Never overwrite the counters and the prediction with possibly outdated values
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in self.COUNTER_FIELDS + ['estimated_end']]
+        super(CalculationOrder, self).save(*args, **kwargs)
+
+    def mark_seen(self):
+        # Only one of concurrent requests can update the order and decrement the counter
+        num = CalculationOrder.objects.filter(pk=self.pk).exclude(last_seen_status=models.F('status')).update(last_seen_status=models.F('status'), last_update=timezone.now())
+        self.last_seen_status = self.status
+
+        if num == 1 and self.author_id is not None:
+            self.author.add_unseen(-1)
+        return num == 1
+
+    def see(self):
+        if not self.mark_seen():
             if not self.hidden and self.status in [2, 3]:
                 self.hidden = True
                 self.save()
 
+    @property
+    def eta(self):
+        '''
+            Predicted time (seconds) until the order is done, or None if unknown
+        '''
+        if self.estimated_end is None or self.num_queued + self.num_running == 0:
+            return None
+        return max((self.estimated_end - timezone.now()).total_seconds(), 0)
+
     @property
     def color(self):
         return STATUS_COLORS[self.status]
@@ -672,6 +865,13 @@ class CalculationOrder(models.Model):
             else:
                 return "Unknown"
 
+    def get_molecule_id(self):
+        if self.ensemble_id is not None:
+            return Ensemble.objects.filter(pk=self.ensemble_id).values_list('parent_molecule', flat=True).first()
+        elif self.structure_id is not None:
+            return Structure.objects.filter(pk=self.structure_id).values_list('parent_ensemble__parent_molecule', flat=True).first()
+        return None
+
     @property
     def molecule_name(self):
         if self.ensemble != None and self.ensemble.parent_molecule != None:
@@ -683,26 +883,61 @@ class CalculationOrder(models.Model):
         else:
             return "Unknown"
 
-    @property
-    def status(self):
-        return self._status(*self.get_all_calcs)
-
-    def update_unseen(self, old_status, old_unseen):
-        new_status = self.status
+    @staticmethod
+    def status_expression():
+        # SQL equivalent of _status
+        return models.Case(
+            models.When(num_running__gt=0, then=models.Value(1)),
+            models.When(num_queued__gt=0, then=models.Value(0)),
+            models.When(num_done__gt=0, then=models.Value(2)),
+            models.When(num_error__gt=0, then=models.Value(3)),
+            default=models.Value(0),
+            output_field=models.PositiveIntegerField(),
+        )
+
+    def update_counters(self, old_calc_status, new_calc_status, num=1):
+        changes = {}
+        if old_calc_status is not None:
+            field = self.STATUS_COUNTERS[old_calc_status]
+            changes[field] = Greatest(models.F(field) - num, 0)
+        if new_calc_status is not None:
+            field = self.STATUS_COUNTERS[new_calc_status]
+            changes[field] = models.F(field) + num
+
+        if len(changes) == 0:
+            return
+
+        with transaction.atomic():
+            orders = CalculationOrder.objects.filter(pk=self.pk)
+            old_status, last_seen_status = orders.select_for_update().values_list('status', 'last_seen_status').get()
+
+            orders.update(last_update=timezone.now(), **changes)
+            orders.update(status=self.status_expression())
+
+            molecule_id = self.get_molecule_id()
+            parent_changes = CalculationCounters.counter_changes(old_calc_status, new_calc_status, num)
+            if len(parent_changes) > 0:
+                if self.project_id is not None:
+                    Project.objects.filter(pk=self.project_id).update(**parent_changes)
+                if molecule_id is not None:
+                    Molecule.objects.filter(pk=molecule_id).update(**parent_changes)
+
+            self.refresh_from_db(fields=self.COUNTER_FIELDS + ['last_seen_status', 'last_update'])
+            self.update_unseen(old_status != last_seen_status)
+
+            if self.status != old_status:
+                transaction.on_commit(lambda: invalidate_ensemble_map(molecule_id))
+
+    def update_unseen(self, old_unseen):
         new_unseen = self.new_status
 
-        if old_unseen:
-            if not new_unseen:
-                with transaction.atomic():
-                    p = Profile.objects.select_for_update().get(id=self.author.id)
-                    p.unseen_calculations -= 1
-                    p.save()
+        if old_unseen == new_unseen or self.author_id is None:
+            return
+
+        if new_unseen:
+            self.author.add_unseen(1)
         else:
-            if new_unseen:
-                with transaction.atomic():
-                    p = Profile.objects.select_for_update().get(id=self.author.id)
-                    p.unseen_calculations += 1
-                    p.save()
+            self.author.add_unseen(-1)
 
     def _status(self, num_queued, num_running, num_done, num_error):
         if num_queued + num_running + num_done + num_error == 0:
@@ -721,27 +956,35 @@ class CalculationOrder(models.Model):
 
     @property
     def get_queued(self):
-        return len(self.calculation_set.filter(status=0))
+        return self.num_queued
 
     @property
     def get_running(self):
-        return len(self.calculation_set.filter(status=1))
+        return self.num_running
 
     @property
     def get_done(self):
-        return len(self.calculation_set.filter(status=2))
+        return self.num_done
 
     @property
     def get_error(self):
-        return len(self.calculation_set.filter(status=3))
+        return self.num_error
 
     @property
     def get_all_calcs(self):
+        return [self.num_queued, self.num_running, self.num_done, self.num_error]
+
+    def refresh_counters(self):
         res = {i: 0 for i in range(4)}
 
         for calc in self.calculation_set.all().values('status'):
             res[calc['status']] += 1
-        return [res[i] for i in range(4)]
+
+        for status, field in self.STATUS_COUNTERS.items():
+            setattr(self, field, res[status])
+        self.status = self._status(*self.get_all_calcs)
+
+        super(CalculationOrder, self).save(update_fields=self.COUNTER_FIELDS)
 
     @property
     def new_status(self):
@@ -751,13 +994,49 @@ class CalculationOrder(models.Model):
             return False
 
     def delete(self, *args, **kwargs):
-        if self.new_status:
-            with transaction.atomic():
-                p = Profile.objects.select_for_update().get(id=self.author.id)
-                p.unseen_calculations = max(0, p.unseen_calculations-1)
-                p.save()
+        if self.new_status and self.author_id is not None:
+            self.author.add_unseen(-1)
         super(CalculationOrder, self).delete(*args, **kwargs)
 
+def update_order_estimate(order_id, force=False):
+    '''
+        Saves when the order is predicted to be done, so that listing the orders needs no prediction
+
+        The prediction covers all the calculations of the order, so it is throttled unless forced.
+    '''
+    if not claim_order_estimate(order_id, force):
+        return
+
+    # The predictor needs the models
+    from .prediction import RuntimePredictor
+
+    try:
+        order = CalculationOrder.objects.get(pk=order_id)
+    except CalculationOrder.DoesNotExist:
+        return
+
+    remaining = RuntimePredictor().order_remaining(order)
+    if remaining is None:
+        estimated_end = None
+    else:
+        estimated_end = timezone.now() + timezone.timedelta(seconds=remaining)
+    CalculationOrder.objects.filter(pk=order_id).update(estimated_end=estimated_end)
+
+@receiver(post_save, sender=CalculationOrder)
+@receiver(post_delete, sender=CalculationOrder)
+def order_map_changed(sender, instance, **kwargs):
+    molecules = Ensemble.objects.filter(pk__in=[instance.ensemble_id, instance.result_ensemble_id]).values_list('parent_molecule', flat=True)
+    for molecule_id in set(molecules) | {instance.get_molecule_id()}:
+        invalidate_ensemble_map(molecule_id)
+
+@receiver(post_delete, sender=CalculationOrder)
+def order_deleted(sender, instance, **kwargs):
+    if instance.author_id is None:
+        return
+
+    author_id, order_id = instance.author_id, instance.id
+    transaction.on_commit(lambda: add_deleted_order(author_id, order_id, timezone.now().timestamp()))
+
 class Calculation(models.Model):
 
     CALC_STATUSES = {
@@ -797,6 +1076,10 @@ class Calculation(models.Model):
 
     task_id = models.CharField(max_length=100, default="")
 
+    # Resources allocated by the local scheduler (MB for the memory), 0 if not allocated
+    nproc = models.PositiveIntegerField(default=0)
+    mem = models.PositiveIntegerField(default=0)
+
     remote_id = models.PositiveIntegerField(default=0)
 
     def __str__(self):
@@ -814,23 +1097,98 @@ class Calculation(models.Model):
         else:
             print("Could not find molecule to update!")
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Calculation, cls).from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super(Calculation, self).refresh_from_db(*args, **kwargs)
+        self._loaded_status = self.__dict__.get('status')
+
+    @classmethod
+    def bulk_add(cls, order, calculations):
+        '''
+            Inserts new calculations of the same order, updating the counters once per status
+        '''
+        if len(calculations) == 0:
+            return calculations
+
+        with transaction.atomic():
+            calculations = cls.objects.bulk_create(calculations, batch_size=BULK_BATCH_SIZE)
+            for status, num in Counter([c.status for c in calculations]).items():
+                order.update_counters(None, status, num)
+            transaction.on_commit(lambda: update_order_estimate(order.id, force=True))
+
+        for c in calculations:
+            c._loaded_status = c.status
+
+        # bulk_create does not send the post_save signals
+        structure_ids = set([c.structure_id for c in calculations if c.structure_id is not None])
+        molecule_ids = Structure.objects.filter(pk__in=structure_ids).values_list('parent_ensemble__parent_molecule', flat=True).distinct()
+        for molecule_id in molecule_ids:
+            bump_fragment_version(molecule_id)
+
+        return calculations
+
     def save(self, *args, **kwargs):
-        old_status = self.order.status
-        old_unseen = self.order.new_status
+        if self._state.adding:
+            super(Calculation, self).save(*args, **kwargs)
+            self._loaded_status = self.status
+            self.order.update_counters(None, self.status)
+            return
+
+        # Plain saves never write the status, so they cannot overwrite a concurrent transition
+        if kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name != 'status']
+        else:
+            kwargs['update_fields'] = [f for f in kwargs['update_fields'] if f != 'status']
 
-        super(Calculation, self).save(*args, **kwargs)
-        self.order.update_unseen(old_status, old_unseen)
+        if self.status == getattr(self, '_loaded_status', None):
+            super(Calculation, self).save(*args, **kwargs)
+        else:
+            with transaction.atomic():
+                super(Calculation, self).save(*args, **kwargs)
+                # Unset dates are left to the transition
+                dates = {k: getattr(self, k) for k in ['date_started', 'date_finished'] if getattr(self, k) is not None}
+                self.transition(self.status, **dates)
+
+    def transition(self, new_status, **fields):
+        fields['status'] = new_status
+
+        now = timezone.now()
+        if new_status == 0:
+            fields.setdefault('date_started', None)
+            fields.setdefault('date_finished', None)
+        elif new_status == 1:
+            fields.setdefault('date_started', now)
+        else:
+            fields.setdefault('date_finished', now)
 
+        with transaction.atomic():
+            calcs = Calculation.objects.filter(pk=self.pk)
+            old_status = calcs.select_for_update().values_list('status', flat=True).get()
+            calcs.update(**fields)
 
-    def delete(self, *args, **kwargs):
-        old_status = self.order.status
-        old_unseen = self.order.new_status
+            if old_status != new_status:
+                self.order.update_counters(old_status, new_status)
+
+        for k, v in fields.items():
+            setattr(self, k, v)
+        self._loaded_status = new_status
 
-        super(Calculation, self).delete(*args, **kwargs)
+        transaction.on_commit(lambda: publish_calculation(self))
+        if old_status != new_status:
+            transaction.on_commit(lambda: update_order_estimate(self.order_id))
 
-        self.order.update_unseen(old_status, old_unseen)
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            old_status = Calculation.objects.select_for_update().values_list('status', flat=True).get(pk=self.pk)
+            super(Calculation, self).delete(*args, **kwargs)
+            self.order.update_counters(old_status, None)
 
-        if self.order.calculation_set.count() == 0:
+        if sum(self.order.get_all_calcs) == 0:
             self.order.delete()
 
     @property
@@ -854,11 +1212,46 @@ class Calculation(models.Model):
     def text_status(self):
         return self.INV_CALC_STATUSES[self.status]
 
+@receiver(post_save, sender=Calculation)
+def calculation_created(sender, instance, created, **kwargs):
+    # The ensemble table lists the steps run on the structures
+    if created and instance.structure_id is not None:
+        bump_fragment_version(structure_molecule_id(instance.structure_id))
+
 class Filter(models.Model):
     type = models.CharField(max_length=500)
     parameters = models.ForeignKey(Parameters, on_delete=models.CASCADE, null=True)
     value = models.CharField(max_length=500)
 
+class Workflow(models.Model):
+    name = models.CharField(max_length=100, default="Nameless workflow")
+    author = models.ForeignKey(Profile, on_delete=models.CASCADE, blank=True, null=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, blank=True, null=True)
+
+    date = models.DateTimeField('date', null=True, blank=True)
+
+class WorkflowStage(models.Model):
+    '''
+        Step of a workflow which runs on the results of its parent stage
+
+        The order of a stage is created once the first results of its parent are available.
+    '''
+    workflow = models.ForeignKey(Workflow, on_delete=models.CASCADE)
+    parent = models.ForeignKey('WorkflowStage', on_delete=models.CASCADE, blank=True, null=True, related_name='children')
+
+    name = models.CharField(max_length=100, default="", blank=True)
+    step = models.ForeignKey(BasicStep, on_delete=models.SET_NULL, null=True)
+    parameters = models.ForeignKey(Parameters, on_delete=models.SET_NULL, null=True)
+    filter = models.ForeignKey(Filter, on_delete=models.SET_NULL, blank=True, null=True)
+    resource = models.ForeignKey(ClusterAccess, on_delete=models.SET_NULL, blank=True, null=True)
+
+    order = models.OneToOneField(CalculationOrder, on_delete=models.SET_NULL, blank=True, null=True, related_name='workflow_stage')
+
+    @property
+    def streams(self):
+        # Filters on the energies need the whole ensemble of the parent stage
+        return self.filter is None or self.filter.type == "By Number"
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
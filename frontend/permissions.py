@@ -0,0 +1,150 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+from .models import Profile, ResearchGroup, Molecule, Ensemble, Structure, Property, CalculationOrder, Calculation
+from .cache import get_related_profiles, set_related_profiles
+
+PROJECT_PATHS = {
+        Molecule: 'project__',
+        Ensemble: 'parent_molecule__project__',
+        Structure: 'parent_ensemble__parent_molecule__project__',
+        Property: 'parent_structure__parent_ensemble__parent_molecule__project__',
+    }
+
+def compute_related_profiles(profile_id):
+    '''
+        Returns the ids of the profiles which can see the non-private projects of the given profile
+    '''
+    ids = {profile_id}
+
+    try:
+        is_PI, member_of = Profile.objects.values_list('is_PI', 'member_of').get(pk=profile_id)
+    except Profile.DoesNotExist:
+        return ids
+
+    pi_groups = []
+    if is_PI:
+        pi_groups = list(ResearchGroup.objects.filter(PI=profile_id).values_list('id', flat=True))
+        group = pi_groups[0] if len(pi_groups) > 0 else None
+    else:
+        group = member_of
+
+    if group is None:
+        return ids
+
+    ids.update(Profile.objects.filter(member_of__in=[group] + pi_groups).values_list('id', flat=True))
+
+    pi = ResearchGroup.objects.filter(pk=group).values_list('PI', flat=True).first()
+    if pi is not None:
+        ids.add(pi)
+
+    return ids
+
+class PermissionResolver:
+    '''
+        Resolves the permissions of one profile, memoizing the lookups
+
+        One resolver is attached to the profile object, so it lives as long as the request.
+    '''
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.related = {}
+        self.objects = {}
+
+    def related_profiles(self, profile_id):
+        if profile_id not in self.related:
+            ids = get_related_profiles(profile_id)
+            if ids is None:
+                ids = compute_related_profiles(profile_id)
+                set_related_profiles(profile_id, ids)
+            self.related[profile_id] = ids
+        return self.related[profile_id]
+
+    def intersects(self, profile1_id, profile2_id):
+        if profile1_id is None or profile2_id is None:
+            return False
+        if profile1_id == profile2_id:
+            return True
+        return profile2_id in self.related_profiles(profile1_id)
+
+    def can_view_author(self, author_id, private):
+        if author_id == self.profile.id:
+            return True
+        if not self.intersects(author_id, self.profile.id):
+            return False
+        if private and not self.profile.is_PI:
+            return False
+        return True
+
+    def lookup(self, model, pk, author_path, private_path):
+        key = (model, pk)
+        if key not in self.objects:
+            self.objects[key] = model.objects.filter(pk=pk).values_list(author_path, private_path).first()
+        return self.objects[key]
+
+    def can_view_project(self, proj):
+        if proj is None:
+            return False
+        return self.can_view_author(proj.author_id, proj.private)
+
+    def can_view_in_project(self, model, obj):
+        if obj is None:
+            return False
+
+        path = PROJECT_PATHS[model]
+        values = self.lookup(model, obj.pk, path + 'author', path + 'private')
+        if values is None:
+            return False
+        return self.can_view_author(*values)
+
+    def can_view_order(self, order):
+        if order is None:
+            return False
+        if order.author_id == self.profile.id:
+            return True
+
+        values = self.lookup(CalculationOrder, order.pk, 'author', 'project__private')
+        if values is None:
+            return False
+        return self.can_view_author(*values)
+
+    def can_view_calculation(self, calc):
+        if calc is None:
+            return False
+        return self.can_view_order(calc.order)
+
+    def can_view_parameters(self, params):
+        # Parameters are shared, so they are visible if any property or calculation using them is
+        candidates = self.related_profiles(self.profile.id)
+
+        path = PROJECT_PATHS[Property]
+        rows = Property.objects.filter(parameters=params, **{path + 'author__in': candidates}).values_list(path + 'author', path + 'private').distinct()
+        if any(self.can_view_author(*row) for row in rows):
+            return True
+
+        rows = Calculation.objects.filter(parameters=params, order__author__in=candidates).values_list('order__author', 'order__project__private').distinct()
+        return any(self.can_view_author(*row) for row in rows)
+
+def get_permissions(profile):
+    if not hasattr(profile, '_permissions'):
+        profile._permissions = PermissionResolver(profile)
+    return profile._permissions
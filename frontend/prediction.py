@@ -0,0 +1,222 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import math
+import logging
+
+import numpy as np
+from django.utils import timezone
+
+from .models import Calculation
+from .constants import ATOMIC_NUMBER
+from .environment_variables import PAL
+from .cache import get_runtime_model, set_runtime_model
+from .scheduler import theory_level, node_budget, estimate_resources, model_keys, basis_zeta
+
+logger = logging.getLogger(__name__)
+
+# Predicts the cost (core-seconds) of calculations with a log-linear regression on the
+# size of the system. One regression is fitted per software, step and level of theory,
+# with a coarser one per software and step for the rare combinations.
+
+# Number of finished calculations used for the training
+TRAINING_SIZE = 5000
+
+# Minimal number of calculations needed to fit a regression
+MIN_SAMPLES = 5
+
+# Regularisation of the coefficients, since the number of atoms and electrons are strongly correlated
+RIDGE = 1e-3
+
+def calc_features(calc):
+    if calc.structure is None:
+        return None
+
+    natoms = 0
+    electrons = -calc.parameters.charge
+    for line in calc.structure.xyz_structure.strip().split('\n'):
+        sline = line.split()
+        if len(sline) != 4:
+            continue
+
+        el = sline[0].capitalize()
+        if el not in ATOMIC_NUMBER:
+            continue
+
+        natoms += 1
+        electrons += ATOMIC_NUMBER[el]
+
+    if natoms == 0:
+        return None
+
+    return [1, math.log(natoms), math.log(max(electrons, 1)), math.log(basis_zeta(calc.parameters))]
+
+def calc_cores(calc):
+    '''
+        Number of cores used by a finished calculation
+    '''
+    if calc.nproc > 0:
+        return calc.nproc
+    if not calc.local and calc.order.resource is not None:
+        return int(calc.order.resource.pal)
+    return int(PAL)
+
+def fit(X, y, cores=None):
+    X = np.array(X)
+    y = np.array(y)
+
+    penalty = RIDGE*np.identity(X.shape[1])
+    penalty[0, 0] = 0
+
+    coefficients = np.linalg.solve(X.T @ X + penalty, X.T @ y)
+    residuals = y - X @ coefficients
+    rmse = float(np.sqrt(np.mean(residuals**2)))
+
+    model = {'coefficients': coefficients.tolist(), 'samples': len(y), 'rmse': rmse}
+
+    # How the cost grows with the number of cores, used to judge the parallel efficiency
+    if cores is not None and len(set(cores)) > 1:
+        A = np.array([[1, math.log(n)] for n in cores])
+        intercept, scaling = np.linalg.lstsq(A, residuals, rcond=None)[0]
+        model['scaling'] = min(max(float(scaling), 0), 1)
+    return model
+
+def train():
+    '''
+        Fits the regressions on the last finished calculations and saves them
+
+        Returns the number of regressions in the model.
+    '''
+    calcs = Calculation.objects.filter(status=2, date_started__isnull=False, date_finished__isnull=False, structure__isnull=False, parameters__isnull=False, step__isnull=False).select_related('parameters', 'step', 'structure', 'order__resource').order_by('-id')[:TRAINING_SIZE]
+
+    samples = {}
+    for calc in calcs:
+        duration = (calc.date_finished - calc.date_started).total_seconds()
+        if duration <= 0:
+            continue
+
+        features = calc_features(calc)
+        if features is None:
+            continue
+
+        cores = calc_cores(calc)
+        target = math.log(duration*cores)
+        for key in model_keys(calc.parameters.software, calc.step.short_name, theory_level(calc.parameters)):
+            X, y, nproc = samples.setdefault(key, ([], [], []))
+            X.append(features)
+            y.append(target)
+            nproc.append(cores)
+
+    model = {}
+    for key, (X, y, nproc) in samples.items():
+        if len(y) < MIN_SAMPLES:
+            continue
+        model[key] = fit(X, y, nproc)
+
+    set_runtime_model(model)
+    logger.info("Trained the runtime model on {} calculation(s) with {} regression(s)".format(len(calcs), len(model)))
+    return len(model)
+
+class RuntimePredictor:
+    '''
+        Predicts the runtime of calculations with the last trained model
+    '''
+    def __init__(self, model=None):
+        if model is None:
+            model = get_runtime_model() or {}
+        self.model = model
+
+    def core_seconds(self, calc):
+        '''
+            Returns the predicted cost of the calculation in core-seconds, or None if unknown
+        '''
+        if calc.parameters is None or calc.step is None:
+            return None
+
+        features = calc_features(calc)
+        if features is None:
+            return None
+
+        for key in model_keys(calc.parameters.software, calc.step.short_name, theory_level(calc.parameters)):
+            if key in self.model:
+                return math.exp(np.dot(self.model[key]['coefficients'], features))
+        return None
+
+    def runtime(self, calc, nproc=None):
+        '''
+            Returns the predicted wall time (seconds) of the calculation, or None if unknown
+        '''
+        cost = self.core_seconds(calc)
+        if cost is None:
+            return None
+
+        if nproc is None:
+            if calc.nproc > 0:
+                nproc = calc.nproc
+            elif not calc.local and calc.order.resource is not None:
+                nproc = int(calc.order.resource.pal)
+            else:
+                cores, mem = node_budget()
+                nproc, _ = estimate_resources(calc, cores, mem//cores, self.model)
+        return cost/nproc
+
+    def remaining(self, calc):
+        '''
+            Returns the predicted time (seconds) until the calculation is done, or None if unknown
+        '''
+        if calc.status not in (0, 1):
+            return None
+
+        runtime = self.runtime(calc)
+        if runtime is None:
+            return None
+
+        if calc.status == 1 and calc.date_started is not None:
+            elapsed = (timezone.now() - calc.date_started).total_seconds()
+            return max(runtime - elapsed, 0)
+        return runtime
+
+    def order_remaining(self, order):
+        '''
+            Returns the predicted time (seconds) until the order is done, or None if unknown
+
+            The queued calculations are assumed to run with the same parallelism as the running ones.
+        '''
+        if order.num_queued + order.num_running == 0:
+            return None
+
+        calcs = order.calculation_set.select_related('parameters', 'step', 'structure', 'order__resource')
+
+        running = [self.remaining(c) for c in calcs.filter(status=1)]
+        queued = calcs.filter(status=0).first()
+
+        remaining = 0
+        if len(running) > 0:
+            if None in running:
+                return None
+            remaining = max(running)
+
+        if queued is not None:
+            runtime = self.runtime(queued)
+            if runtime is None:
+                return None
+            remaining += math.ceil(order.num_queued/max(order.num_running, 1))*runtime
+        return remaining
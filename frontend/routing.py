@@ -0,0 +1,127 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import logging
+
+from django.db.models import F, Avg, DurationField, ExpressionWrapper
+
+from .models import Calculation
+from .prediction import RuntimePredictor
+from .scheduler import node_budget, calc_num_atoms, estimate_resources, theory_level, STEP_COST_FACTORS
+
+logger = logging.getLogger(__name__)
+
+# Each tier has its own queue and pool of comp workers, so that short calculations
+# never wait behind long ones. 'comp' is kept for the interactive tier so that
+# a single worker listening to it still runs the quick jobs.
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+HEAVY = 'heavy'
+
+QUEUES = {
+        INTERACTIVE: 'comp',
+        BATCH: 'comp_batch',
+        HEAVY: 'comp_heavy',
+    }
+
+# Upper bounds of the estimated wall time (seconds) of each tier
+TIER_LIMITS = [
+        (INTERACTIVE, 5*60),
+        (BATCH, 2*3600),
+    ]
+
+# Orders with a larger total wall time (seconds) never go to the interactive tier
+INTERACTIVE_ORDER_LIMIT = 3600
+
+# Rough wall time on one core (seconds) for one atom, and how it scales with the number of atoms
+BASE_RUNTIMES = {
+        'xtb': (0.02, 2),
+        'semi-empirical': (0.01, 2),
+        'hf': (0.05, 3),
+        'dft': (0.1, 3),
+        'ri-mp2': (0.005, 4),
+    }
+
+# Number of previous calculations considered for the historical runtimes
+HISTORY_SIZE = 50
+
+def historical_runtime(calc):
+    '''
+        Returns the average wall time (seconds) of the last similar calculations, or None
+    '''
+    duration = ExpressionWrapper(F('date_finished') - F('date_started'), output_field=DurationField())
+    similar = Calculation.objects.filter(status=2, step=calc.step, parameters__software=calc.parameters.software,
+            parameters__method=calc.parameters.method, parameters__basis_set=calc.parameters.basis_set,
+            date_started__isnull=False, date_finished__isnull=False).order_by('-id')[:HISTORY_SIZE]
+
+    avg = Calculation.objects.filter(pk__in=similar.values('pk')).annotate(duration=duration).aggregate(avg=Avg('duration'))['avg']
+    if avg is None:
+        return None
+    return avg.total_seconds()
+
+def estimate_runtime(calc):
+    '''
+        Estimates the wall time (seconds) of a calculation with the resources it will be given
+    '''
+    predictor = RuntimePredictor()
+
+    cores, mem = node_budget()
+    nproc, _ = estimate_resources(calc, cores, mem//cores, predictor.model)
+
+    predicted = predictor.runtime(calc, nproc)
+    if predicted is not None:
+        return predicted
+
+    history = historical_runtime(calc)
+    if history is not None:
+        return history
+
+    base, scaling = BASE_RUNTIMES[theory_level(calc.parameters)]
+    return base*calc_num_atoms(calc)**scaling*STEP_COST_FACTORS.get(calc.step.short_name, 1)/nproc
+
+def tier_of(runtime):
+    for tier, limit in TIER_LIMITS:
+        if runtime <= limit:
+            return tier
+    return HEAVY
+
+def route_calculations(calculations):
+    '''
+        Returns the queue to use for calculations of the same order
+
+        All the calculations of an order share their parameters and step, so the cost is
+        estimated once from the first one.
+    '''
+    if len(calculations) == 0:
+        return QUEUES[INTERACTIVE]
+
+    runtime = estimate_runtime(calculations[0])
+    tier = tier_of(runtime)
+
+    # Large orders of quick calculations would still monopolize the interactive workers
+    if tier == INTERACTIVE and runtime*len(calculations) > INTERACTIVE_ORDER_LIMIT:
+        tier = BATCH
+
+    logger.info("Routing {} calculation(s) to the {} queue (estimated {:.0f} s each)".format(len(calculations), tier, runtime))
+    return QUEUES[tier]
+
+def route_calculation(calc):
+    return route_calculations([calc])
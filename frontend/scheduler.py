@@ -0,0 +1,416 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import os
+import math
+import time
+import socket
+import logging
+
+import psutil
+
+from .cache import get_connection, get_runtime_model
+from .environment_variables import STACKSIZE
+
+logger = logging.getLogger(__name__)
+
+# Shares the cores and memory of the local node between the jobs of the comp worker.
+# Each job reserves the resources it needs before running. The jobs are started in the
+# order they arrive: a job which does not fit blocks the ones after it, so that large
+# jobs eventually get the whole node instead of being starved by small ones. Each
+# queue of comp workers waits in its own line, so quick jobs never wait behind heavy ones.
+# A heavy job which waited too long reserves the resources it needs on the node: the
+# other lines can then only use what it leaves free.
+
+# Containers get a new hostname when recreated, so a stable name can be given
+NODE_NAME = os.environ.get("CALCUS_NODE_NAME", socket.gethostname())
+DEFAULT_QUEUE = 'comp'
+
+NODE_KEY = "scheduler_node_{}"
+JOBS_KEY = "scheduler_jobs_{}"
+QUEUE_KEY = "scheduler_queue_{}_{}"
+HEARTBEAT_KEY = "scheduler_heartbeat_{}_{}"
+RELEASED_CHANNEL = "scheduler_released_{}"
+
+# Waiting jobs renew their place in the queue at this interval and are dropped if they stop doing so
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 3*HEARTBEAT_INTERVAL
+
+# Queues whose jobs can reserve the node (the heavy tier of the routing) and delay (seconds) before they do
+RESERVING_QUEUES = ['comp_heavy']
+RESERVATION_DELAY = 10*60
+
+# Number of atoms which can be efficiently handled per core
+ATOMS_PER_CORE = {
+        'xtb': 60,
+        'semi-empirical': 40,
+        'hf': 8,
+        'dft': 6,
+        'ri-mp2': 4,
+    }
+
+# Rough number of basis functions of hydrogen and of heavier atoms for each number of zeta
+BASIS_FUNCTIONS = {
+        1: (1, 5),
+        2: (5, 15),
+        3: (6, 31),
+        4: (30, 57),
+    }
+
+# Memory (MB) needed per core as a function of the number of basis functions: base + coefficient*N^exponent
+MEMORY_SCALING = {
+        'xtb': (1e-4, 2),
+        'semi-empirical': (1e-4, 2),
+        'hf': (4e-4, 2),
+        'dft': (5e-4, 2),
+        'ri-mp2': (8e-6, 3),
+    }
+BASE_MEMORY = 500
+
+# Analytical Hessians and NMR shieldings need more memory than energies and gradients
+STEP_MEMORY_FACTORS = {
+        'freq': 2,
+        'opt_freq': 2,
+        'nmr': 2,
+    }
+
+# More cores are not given to a calculation if they would run at a lower parallel efficiency
+MIN_PARALLEL_EFFICIENCY = 0.5
+
+STEP_COST_FACTORS = {
+        'freq': 2,
+        'opt_freq': 3,
+        'optts': 2,
+        'nmr': 2,
+        'mep': 4,
+        'conf_search': 4,
+        'constr_conf_search': 4,
+    }
+
+ACQUIRE_SCRIPT = '''
+local node, jobs, queue, heartbeat = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local calc_id, nproc, mem, now, timeout = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local reserve_after = tonumber(ARGV[7])
+
+for _, waiting in ipairs(redis.call('ZRANGE', queue, 0, -1)) do
+    local last = tonumber(redis.call('HGET', heartbeat, waiting) or 0)
+    if waiting ~= calc_id and now - last > timeout then
+        redis.call('ZREM', queue, waiting)
+        redis.call('HDEL', heartbeat, waiting)
+    end
+end
+
+local head = redis.call('ZRANGE', queue, 0, 0)[1]
+if head and head ~= calc_id then
+    return 0
+end
+
+local cores = tonumber(redis.call('HGET', node, 'cores'))
+local total_mem = tonumber(redis.call('HGET', node, 'mem'))
+local used_cores = tonumber(redis.call('HGET', node, 'used_cores') or 0)
+local used_mem = tonumber(redis.call('HGET', node, 'used_mem') or 0)
+
+local holder = redis.call('HGET', node, 'reserved_by')
+if holder and holder ~= calc_id and now - tonumber(redis.call('HGET', node, 'reserved_at')) > timeout then
+    redis.call('HDEL', node, 'reserved_by', 'reserved_at', 'reserved_cores', 'reserved_mem')
+    holder = false
+end
+
+local free_cores, free_mem = cores - used_cores, total_mem - used_mem
+if holder and holder ~= calc_id then
+    free_cores = free_cores - tonumber(redis.call('HGET', node, 'reserved_cores'))
+    free_mem = free_mem - tonumber(redis.call('HGET', node, 'reserved_mem'))
+end
+
+if nproc > free_cores or mem > free_mem then
+    if holder == calc_id then
+        redis.call('HSET', node, 'reserved_at', now)
+    elseif not holder and reserve_after >= 0 and now - tonumber(redis.call('ZSCORE', queue, calc_id)) > reserve_after then
+        redis.call('HSET', node, 'reserved_by', calc_id, 'reserved_at', now, 'reserved_cores', nproc, 'reserved_mem', mem)
+    end
+    return 0
+end
+
+if holder == calc_id then
+    redis.call('HDEL', node, 'reserved_by', 'reserved_at', 'reserved_cores', 'reserved_mem')
+end
+
+redis.call('HINCRBY', node, 'used_cores', nproc)
+redis.call('HINCRBY', node, 'used_mem', mem)
+redis.call('HSET', jobs, calc_id, ARGV[6])
+redis.call('ZREM', queue, calc_id)
+redis.call('HDEL', heartbeat, calc_id)
+return 1
+'''
+
+RELEASE_SCRIPT = '''
+local node, jobs = KEYS[1], KEYS[2]
+local job = redis.call('HGET', jobs, ARGV[1])
+if not job then
+    return 0
+end
+
+local nproc, mem = string.match(job, '(%d+) (%d+)')
+redis.call('HINCRBY', node, 'used_cores', -tonumber(nproc))
+redis.call('HINCRBY', node, 'used_mem', -tonumber(mem))
+redis.call('HDEL', jobs, ARGV[1])
+return 1
+'''
+
+CANCEL_RESERVATION_SCRIPT = '''
+if redis.call('HGET', KEYS[1], 'reserved_by') == ARGV[1] then
+    redis.call('HDEL', KEYS[1], 'reserved_by', 'reserved_at', 'reserved_cores', 'reserved_mem')
+    return 1
+end
+return 0
+'''
+
+def node_budget():
+    '''
+        Returns the number of cores and the memory (MB) available to the local calculations
+    '''
+    cores = int(os.environ.get("NUM_CPU", os.cpu_count() or 1))
+    return cores, cores*STACKSIZE
+
+def num_atoms(xyz):
+    lines = [i for i in xyz.strip().split('\n') if i.strip() != '']
+
+    # Skip the header of full xyz files
+    if len(lines) > 2 and lines[0].strip().isdigit():
+        return len(lines) - 2
+    return len(lines)
+
+def theory_level(params):
+    if params.software.lower() == 'xtb':
+        return 'xtb'
+
+    level = params.theory_level.lower()
+    if level not in ATOMS_PER_CORE:
+        return 'dft'
+    return level
+
+def calc_num_atoms(calc):
+    if calc.structure is not None:
+        return num_atoms(calc.structure.xyz_structure)
+    return 1
+
+def model_keys(software, step, level):
+    return ["{}/{}/{}".format(software.lower(), step, level), "{}/{}".format(software.lower(), step)]
+
+def basis_zeta(params):
+    '''
+        Rough size of the basis set per atom, in number of zeta
+    '''
+    basis_set = params.basis_set.lower()
+    if params.software.lower() == 'xtb' or basis_set == '':
+        return 1
+    if 'qz' in basis_set:
+        return 4
+    if 'tz' in basis_set or '6-311' in basis_set:
+        return 3
+    if 'sto' in basis_set or 'mini' in basis_set or '3-21' in basis_set:
+        return 1
+    return 2
+
+def num_basis_functions(calc):
+    if calc.structure is None:
+        return 1
+
+    light, heavy = BASIS_FUNCTIONS[basis_zeta(calc.parameters)]
+
+    num = 0
+    for line in calc.structure.xyz_structure.strip().split('\n'):
+        sline = line.split()
+        if len(sline) != 4:
+            continue
+        if sline[0].capitalize() in ['H', 'He']:
+            num += light
+        else:
+            num += heavy
+    return max(num, 1)
+
+def memory_per_core(calc):
+    '''
+        Estimates the memory (MB) needed per core by a calculation
+    '''
+    coefficient, exponent = MEMORY_SCALING[theory_level(calc.parameters)]
+    need = coefficient*num_basis_functions(calc)**exponent*STEP_MEMORY_FACTORS.get(calc.step.short_name, 1)
+    return BASE_MEMORY + int(math.ceil(need/100))*100
+
+def efficiency_limit(calc, model):
+    '''
+        Returns the largest number of cores which similar calculations used efficiently, or None if unknown
+
+        The cost in core-seconds of the calculations grows as nproc^scaling when they do not scale perfectly.
+    '''
+    if model is None:
+        return None
+
+    for key in model_keys(calc.parameters.software, calc.step.short_name, theory_level(calc.parameters)):
+        scaling = model.get(key, {}).get('scaling')
+        if scaling is not None:
+            if scaling <= 0:
+                return None
+            return max(int(MIN_PARALLEL_EFFICIENCY**(-1/scaling)), 1)
+    return None
+
+def estimate_resources(calc, cores, mem_per_core, model=None):
+    '''
+        Estimates the number of cores and memory (MB) to give to a calculation
+
+        The number of cores grows with the size of the system, but is limited by the parallel
+        efficiency of past calculations if a runtime model is given. The memory grows with the
+        number of basis functions. The values chosen when launching the calculation take precedence.
+    '''
+    order = calc.order if calc.order_id is not None else None
+
+    if order is not None and order.nproc > 0:
+        nproc = min(order.nproc, cores)
+    else:
+        atoms_per_core = ATOMS_PER_CORE[theory_level(calc.parameters)]
+
+        cost = calc_num_atoms(calc)*STEP_COST_FACTORS.get(calc.step.short_name, 1)
+        nproc = min(max(math.ceil(cost/atoms_per_core), 1), cores)
+
+        limit = efficiency_limit(calc, model)
+        if limit is not None:
+            nproc = min(nproc, limit)
+
+    if order is not None and order.mem > 0:
+        mem = order.mem
+    else:
+        mem = max(nproc*memory_per_core(calc), nproc*mem_per_core)
+
+    return nproc, min(mem, cores*mem_per_core)
+
+def keys(queue=DEFAULT_QUEUE, node=NODE_NAME):
+    return [NODE_KEY.format(node), JOBS_KEY.format(node), QUEUE_KEY.format(node, queue), HEARTBEAT_KEY.format(node, queue)]
+
+def job_alive(job):
+    fields = job.split()
+    pid = int(fields[2])
+    try:
+        process = psutil.Process(pid)
+    except psutil.NoSuchProcess:
+        return False
+
+    # The pid may have been reused by another process after a restart
+    if len(fields) > 3 and abs(process.create_time() - float(fields[3])) > 1:
+        return False
+    return True
+
+def release_dead_jobs(connection):
+    '''
+        Releases the reservations of the processes which died without releasing them (e.g. worker restart)
+
+        Returns the ids of the calculations which were running in these processes.
+    '''
+    released = []
+    for calc_id, job in connection.hgetall(JOBS_KEY.format(NODE_NAME)).items():
+        if not job_alive(job):
+            logger.warning("Releasing the resources of calculation {}: process {} is gone".format(calc_id.decode('utf-8'), job.split()[2].decode('utf-8')))
+            connection.eval(RELEASE_SCRIPT, 2, *keys()[:2], calc_id)
+            released.append(int(calc_id))
+    return released
+
+def running_calcs(connection):
+    '''
+        Returns the ids of the calculations holding resources on any node
+    '''
+    ids = set()
+    for key in connection.scan_iter(JOBS_KEY.format('*')):
+        ids |= set(int(i) for i in connection.hkeys(key))
+    return ids
+
+def acquire(calc, is_cancelled, queue=DEFAULT_QUEUE):
+    '''
+        Blocks until the resources needed by the calculation are available and reserves them
+
+        The calculation waits behind the ones received from the same queue. Calculations of
+        the reserving queues which waited for RESERVATION_DELAY keep the other queues from
+        taking the resources they need. The allocated resources are saved in the calculation.
+        Returns False if the calculation was cancelled while waiting.
+    '''
+    cores, mem = node_budget()
+    nproc, job_mem = estimate_resources(calc, cores, mem//cores, get_runtime_model())
+
+    connection = get_connection()
+    connection.hset(NODE_KEY.format(NODE_NAME), mapping={'cores': cores, 'mem': mem})
+
+    pubsub = connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(RELEASED_CHANNEL.format(NODE_NAME))
+
+    node_key, jobs_key, queue_key, heartbeat_key = keys(queue)
+    reserve_after = RESERVATION_DELAY if queue in RESERVING_QUEUES else -1
+
+    try:
+        now = time.time()
+        connection.zadd(queue_key, {calc.id: now}, nx=True)
+
+        while True:
+            now = time.time()
+            connection.hset(heartbeat_key, calc.id, now)
+
+            release_dead_jobs(connection)
+
+            job = "{} {} {} {}".format(nproc, job_mem, os.getpid(), psutil.Process().create_time())
+            if connection.eval(ACQUIRE_SCRIPT, 4, node_key, jobs_key, queue_key, heartbeat_key, calc.id, nproc, job_mem, now, HEARTBEAT_TIMEOUT, job, reserve_after):
+                break
+
+            # Wake up as soon as another job finishes
+            pubsub.get_message(timeout=HEARTBEAT_INTERVAL)
+
+            if is_cancelled():
+                connection.zrem(queue_key, calc.id)
+                connection.hdel(heartbeat_key, calc.id)
+                if connection.eval(CANCEL_RESERVATION_SCRIPT, 1, node_key, calc.id):
+                    connection.publish(RELEASED_CHANNEL.format(NODE_NAME), calc.id)
+                return False
+    finally:
+        pubsub.close()
+
+    calc.nproc = nproc
+    calc.mem = job_mem
+    calc.save(update_fields=['nproc', 'mem'])
+
+    logger.info("Calculation {} running with {} core(s) and {} MB".format(calc.id, nproc, job_mem))
+    return True
+
+def release(calc_id):
+    connection = get_connection()
+    connection.eval(RELEASE_SCRIPT, 2, *keys()[:2], calc_id)
+    connection.publish(RELEASED_CHANNEL.format(NODE_NAME), calc_id)
+
+def utilisation():
+    '''
+        Returns the usage of the resources of all the nodes running local calculations
+    '''
+    connection = get_connection()
+
+    nodes = []
+    for key in sorted(connection.scan_iter(NODE_KEY.format('*'))):
+        name = key.decode('utf-8')[len(NODE_KEY.format('')):]
+        node = {k.decode('utf-8'): int(float(v)) for k, v in connection.hgetall(key).items()}
+        node['name'] = name
+        node['running'] = connection.hlen(JOBS_KEY.format(name))
+        node['waiting'] = sum(connection.zcard(key) for key in connection.scan_iter(QUEUE_KEY.format(name, '*')))
+        nodes.append(node)
+    return nodes
@@ -0,0 +1,354 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import io
+import os
+import glob
+import time
+import bisect
+import struct
+import shutil
+import logging
+
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+COPY_BUFFER_SIZE = 1024*1024
+
+# Results are compressed in the seekable format of Zstandard (contrib/seekable_format in
+# the zstd repository): independent frames followed by a table of their sizes, so that
+# any part of a file can be read by decompressing only the frames which contain it.
+COMPRESSED_EXT = '.zst'
+COMPRESSION_LEVEL = 3
+FRAME_SIZE = 1024*1024
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')
+SEEK_TABLE_ENTRY = struct.Struct('<II')
+CHECKSUM_FLAG = 0x80
+
+# Smaller files occupy a single block of the filesystem either way
+MIN_COMPRESSED_SIZE = 4096
+
+class SeekableWriter:
+    '''
+        Compresses a stream into independent frames followed by a seek table
+    '''
+    def __init__(self, out, level=COMPRESSION_LEVEL, frame_size=FRAME_SIZE):
+        self.out = out
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.frame_size = frame_size
+        self.buffer = bytearray()
+        self.frames = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.frame_size:
+            self.write_frame(bytes(self.buffer[:self.frame_size]))
+            del self.buffer[:self.frame_size]
+        return len(data)
+
+    def write_frame(self, data):
+        frame = self.compressor.compress(data)
+        self.out.write(frame)
+        self.frames.append((len(frame), len(data)))
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.write_frame(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        table = b''.join(SEEK_TABLE_ENTRY.pack(*frame) for frame in self.frames)
+        table += SEEK_TABLE_FOOTER.pack(len(self.frames), 0, SEEKABLE_MAGIC)
+        self.out.write(struct.pack('<II', SKIPPABLE_MAGIC, len(table)))
+        self.out.write(table)
+
+def read_seek_table(f):
+    '''
+        Returns the compressed offset, compressed size, offset and size of each frame of a seekable file
+    '''
+    f.seek(-SEEK_TABLE_FOOTER.size, io.SEEK_END)
+    num_frames, descriptor, magic = SEEK_TABLE_FOOTER.unpack(f.read(SEEK_TABLE_FOOTER.size))
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError("Not a seekable Zstandard file")
+
+    entry_size = SEEK_TABLE_ENTRY.size
+    if descriptor & CHECKSUM_FLAG:
+        entry_size += 4
+
+    f.seek(-(SEEK_TABLE_FOOTER.size + num_frames*entry_size), io.SEEK_END)
+    table = f.read(num_frames*entry_size)
+
+    frames = []
+    compressed_offset = 0
+    offset = 0
+    for ind in range(num_frames):
+        compressed_size, size = SEEK_TABLE_ENTRY.unpack_from(table, ind*entry_size)
+        frames.append((compressed_offset, compressed_size, offset, size))
+        compressed_offset += compressed_size
+        offset += size
+    return frames
+
+class SeekableReader(io.RawIOBase):
+    '''
+        Reads a seekable compressed file as if it was uncompressed
+
+        Only the frames which contain the requested data are decompressed.
+    '''
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        try:
+            self.frames = read_seek_table(self.f)
+        except Exception:
+            self.f.close()
+            raise
+
+        self.starts = [frame[2] for frame in self.frames]
+        self.size = sum(frame[3] for frame in self.frames)
+        self.pos = 0
+        self.decompressor = zstandard.ZstdDecompressor()
+        self.cached_frame = None
+        self.cached_data = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self.pos = pos
+        return self.pos
+
+    def frame(self, ind):
+        if self.cached_frame != ind:
+            compressed_offset, compressed_size, offset, size = self.frames[ind]
+            self.f.seek(compressed_offset)
+            self.cached_data = self.decompressor.decompress(self.f.read(compressed_size), max_output_size=size)
+            self.cached_frame = ind
+        return self.cached_data
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+
+        ind = bisect.bisect_right(self.starts, self.pos) - 1
+        start = self.pos - self.starts[ind]
+        chunk = self.frame(ind)[start:start+len(b)]
+
+        b[:len(chunk)] = chunk
+        self.pos += len(chunk)
+        return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+        super().close()
+
+def compressed_path(path):
+    return path + COMPRESSED_EXT
+
+def result_exists(path):
+    return os.path.isfile(path) or os.path.isfile(compressed_path(path))
+
+def open_result(path, mode='r', encoding=None, errors=None):
+    '''
+        Opens a result file for reading, whether it has been compressed or not
+    '''
+    try:
+        if 'b' in mode:
+            return open(path, 'rb')
+        return open(path, 'r', encoding=encoding, errors=errors)
+    except FileNotFoundError:
+        # The file might have just been compressed
+        if not os.path.isfile(compressed_path(path)):
+            raise
+
+    return open_compressed(path, mode, encoding, errors)
+
+def open_compressed(path, mode='r', encoding=None, errors=None):
+    f = io.BufferedReader(SeekableReader(compressed_path(path)), COPY_BUFFER_SIZE)
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, errors=errors)
+
+def result_files(directory, pattern):
+    '''
+        Returns the paths of the result files matching a pattern, as if they were uncompressed
+    '''
+    paths = glob.glob(os.path.join(directory, pattern))
+    for path in glob.glob(os.path.join(directory, pattern + COMPRESSED_EXT)):
+        path = path[:-len(COMPRESSED_EXT)]
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+def copy_result(path, dest):
+    with open_result(path, 'rb') as f, open(dest, 'wb') as out:
+        shutil.copyfileobj(f, out, COPY_BUFFER_SIZE)
+
+def zip_result(zip, path, name):
+    '''
+        Adds a result file to a zip archive without loading it in memory
+    '''
+    with open_result(path, 'rb') as f, zip.open(name, 'w', force_zip64=True) as out:
+        shutil.copyfileobj(f, out, COPY_BUFFER_SIZE)
+
+def same_filesystem(path, directory):
+    try:
+        return os.stat(path).st_dev == os.stat(directory).st_dev
+    except OSError:
+        return False
+
+def write_compressed(src, dest):
+    '''
+        Compresses a file to the results in a single streamed pass
+
+        The compressed file is written next to its destination and renamed once complete,
+        so that partial files are never visible in the results.
+    '''
+    tmp = compressed_path(dest) + '.part'
+    with open(src, 'rb') as f, open(tmp, 'wb') as out:
+        writer = SeekableWriter(out)
+        shutil.copyfileobj(f, writer, COPY_BUFFER_SIZE)
+        writer.close()
+    os.replace(tmp, compressed_path(dest))
+
+def publish(src, dest):
+    '''
+        Copies a file to the results, compressed unless it is smaller than MIN_COMPRESSED_SIZE
+    '''
+    if os.path.getsize(src) >= MIN_COMPRESSED_SIZE:
+        write_compressed(src, dest)
+        return
+
+    tmp = dest + '.part'
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+def compress_file(path):
+    '''
+        Compresses a result file in place
+
+        Returns the size of the compressed file.
+    '''
+    write_compressed(path, path)
+    os.remove(path)
+    return os.path.getsize(compressed_path(path))
+
+def compress_directory(directory, min_age=0):
+    '''
+        Compresses the files of a results directory which are not compressed yet
+
+        Files modified less than min_age seconds ago are left alone, as they might still be written.
+        Returns the number of files compressed, their total size and their total compressed size.
+    '''
+    num_files = 0
+    size = 0
+    compressed_size = 0
+
+    if not os.path.isdir(directory):
+        return num_files, size, compressed_size
+
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(COMPRESSED_EXT) or name.endswith('.part') or not os.path.isfile(path):
+            continue
+
+        file_size = os.path.getsize(path)
+        if file_size < MIN_COMPRESSED_SIZE:
+            continue
+
+        if min_age > 0 and now - os.path.getmtime(path) < min_age:
+            continue
+
+        compressed_size += compress_file(path)
+        size += file_size
+        num_files += 1
+
+    return num_files, size, compressed_size
+
+def promote(src, dest):
+    '''
+        Moves a file from the scratch directory to the results
+
+        If both are on the same filesystem, the file is simply renamed (and compressed later
+        by compress_directory). Otherwise, it is compressed to the results in a single copy.
+        Returns True if the file was renamed.
+    '''
+    if same_filesystem(src, os.path.dirname(dest)):
+        os.replace(src, dest)
+        return True
+
+    publish(src, dest)
+    os.remove(src)
+    return False
+
+def log_files(workdir):
+    '''
+        Returns the logs of a calculation and their name in the results
+    '''
+    files = [(f, os.path.basename(f)) for f in glob.glob(os.path.join(workdir, '*.out'))]
+    files += [(f, os.path.basename(f).replace('.log', '.out')) for f in glob.glob(os.path.join(workdir, '*.log'))]
+    return files
+
+def promote_logs(workdir, res_dir, keep=()):
+    '''
+        Moves the logs of a finished calculation to its results directory
+
+        The logs named in keep (e.g. the checkpoints of failed calculations) are copied instead.
+        Returns the number of files, their total size in bytes, the number of files renamed
+        instead of copied and the time taken in seconds.
+    '''
+    start = time.time()
+
+    # Scratch directories linked to cached logs (during the tests) must stay intact
+    move = not os.path.islink(workdir)
+
+    files = log_files(workdir)
+    size = 0
+    renamed = 0
+    for src, name in files:
+        size += os.path.getsize(src)
+        dest = os.path.join(res_dir, name)
+        if move and os.path.basename(src) not in keep:
+            renamed += promote(src, dest)
+        else:
+            publish(src, dest)
+
+    return len(files), size, renamed, time.time() - start
@@ -24,7 +24,6 @@ from calcus.celery import app
 import string
 import signal
 import psutil
-import redis
 import requests
 import os
 import numpy as np
@@ -35,30 +34,47 @@ import shlex
 import glob
 import sys
 import shutil
+import hashlib
+import selectors
+import redis
+import json
 
 import invoke
 
 import threading
 from threading import Lock
 
-from shutil import copyfile, rmtree
+from shutil import rmtree
+from collections import namedtuple
 from time import time, sleep
-from celery.signals import task_prerun, task_postrun
+from celery.signals import task_prerun, task_postrun, worker_ready
 from django.utils import timezone
 from django.conf import settings
 from django.core import management
+from django.db import transaction
 from django.db.utils import IntegrityError
 from celery.contrib.abortable import AbortableTask, AbortableAsyncResult
 from celery import group
+from celery.utils import uuid
 
 from ccinput.wrapper import generate_calculation
 from ccinput.exceptions import CCInputException
+from ccinput.utilities import standardize_xyz, clean_xyz
 
 from .libxyz import *
 from .models import *
 from .xtb_calculation import XtbCalculation
 from .calculation_helper import *
 from .environment_variables import *
+from .events import publish_frames, publish_abort, subscribe_abort
+from .cache import get_connection, get_input_template, set_input_template, get_runtime_model, get_results_migration_cursor, set_results_migration_cursor
+from . import scheduler
+from . import prediction
+from . import fairshare
+from . import checkpoints
+from .routing import route_calculations, QUEUES
+from .checkpoints import prepare_restart, stage_parent, release_scratch
+from .storage import publish, promote_logs, open_result, result_exists, compress_directory
 
 import traceback
 import periodictable
@@ -72,6 +88,11 @@ tests_dir = os.path.join('/'.join(__file__.split('/')[:-1]), "tests/")
 
 
 REMOTE = False
+
+# The programs use more than the memory given in their input (executable, buffers, MPI), so the
+# allocation requested to SLURM leaves some headroom to avoid out-of-memory kills
+SLURM_MEM_FACTOR = 1.25
+
 connections = {}
 locks = {}
 remote_dirs = {}
@@ -196,9 +217,7 @@ def wait_until_done(calc, conn, lock, ind=0):
                 else:
                     status = _output[1].split()[4]
                     if status == "R" and calc.status == 0:
-                        calc.date_started = timezone.now()
-                        calc.status = 1
-                        calc.save()
+                        calc.transition(1)
 
         for i in range(DELAY[ind]):
             if pid in kill_sig:
@@ -228,10 +247,16 @@ def system(command, log_file="", force_local=False, software="xtb", calc_id=-1):
         remote_dir = remote_dirs[pid]
 
         if calc.status == 0 and calc.remote_id == 0:
+            # The options given to sbatch take precedence over the ones of the submission script
+            options = "--job-name={}".format(job_name)
+            if calc.nproc > 0:
+                options += " --ntasks={} --mem={}M".format(calc.nproc, int(calc.mem*SLURM_MEM_FACTOR))
+                command = "export OMP_NUM_THREADS={},1; {}".format(calc.nproc, command)
+
             if log_file != "":
-                output = direct_command("cd {}; cp /home/{}/calcus/submit_{}.sh .; echo '{} | tee {}' >> submit_{}.sh; sbatch --job-name={} submit_{}.sh | tee calcus".format(remote_dir, conn[0].cluster_username, software, command, log_file, software, job_name, software), conn, lock)
+                output = direct_command("cd {}; cp /home/{}/calcus/submit_{}.sh .; echo '{} | tee {}' >> submit_{}.sh; sbatch {} submit_{}.sh | tee calcus".format(remote_dir, conn[0].cluster_username, software, command, log_file, software, options, software), conn, lock)
             else:
-                output = direct_command("cd {}; cp /home/{}/calcus/submit_{}.sh .; echo '{}' >> submit_{}.sh; sbatch --job-name={} submit_{}.sh | tee calcus".format(remote_dir, conn[0].cluster_username, software, command, software, job_name, software), conn, lock)
+                output = direct_command("cd {}; cp /home/{}/calcus/submit_{}.sh .; echo '{}' >> submit_{}.sh; sbatch {} submit_{}.sh | tee calcus".format(remote_dir, conn[0].cluster_username, software, command, software, options, software), conn, lock)
 
             if output == ErrorCodes.CHANNEL_TIMED_OUT:
                 if calc_id != -1:
@@ -286,12 +311,10 @@ def system(command, log_file="", force_local=False, software="xtb", calc_id=-1):
                 ret = wait_until_done(calc, conn, lock, ind=6)
             return ret
     else:#Local
+        calc = None
         if calc_id != -1:
             calc = Calculation.objects.get(pk=calc_id)
-            calc.status = 1
-            calc.date_started = timezone.now()
-            calc.save()
-            res = AbortableAsyncResult(calc.task_id)
+            calc.transition(1)
 
         if log_file != "":
             stream = open(log_file, 'w')
@@ -301,41 +324,133 @@ def system(command, log_file="", force_local=False, software="xtb", calc_id=-1):
         if calc_id != -1 and is_test and setup_cached_calc(calc):
             return ErrorCodes.SUCCESS
 
+        # Listen for abort requests before the process starts, so that none can be missed
+        supervisor = LocalSupervisor(calc)
         try:
-            t = subprocess.Popen(shlex.split(command), stdout=stream, stderr=stream)
-        except FileNotFoundError:
-            logger.error('Could not run command "{}" - executable not found'.format(command))
-            calc.error_message = "{} is not found".format(command.split()[0])
-            calc.date_finished = timezone.now()
-            calc.save()
-            return ErrorCodes.FAILED_TO_RUN_LOCAL_SOFTWARE
-
-        while True:
-            poll = t.poll()
-
-            if not poll is None:
+            if supervisor.is_aborted():
+                logger.info(f"Calculation {calc_id} aborted before starting")
+                return ErrorCodes.JOB_CANCELLED
+
+            env = None
+            if calc is not None and calc.nproc != 0:
+                env = dict(os.environ, OMP_NUM_THREADS="{},1".format(calc.nproc), MKL_NUM_THREADS=str(calc.nproc))
+
+            try:
+                t = subprocess.Popen(shlex.split(command), stdout=stream, stderr=stream, env=env)
+            except FileNotFoundError:
+                logger.error('Could not run command "{}" - executable not found'.format(command))
+                calc.error_message = "{} is not found".format(command.split()[0])
+                calc.date_finished = timezone.now()
+                calc.save()
+                return ErrorCodes.FAILED_TO_RUN_LOCAL_SOFTWARE
+
+            if not supervisor.wait(t):
                 if t.returncode == 0:
                     return ErrorCodes.SUCCESS
                 else:
                     logger.info("Got returncode {}".format(t.returncode))
                     return ErrorCodes.UNKNOWN_TERMINATION
 
-            if calc_id != -1 and res.is_aborted() == True:
-                logger.info(f"Stopping calculation {calc_id}")
-                signal_to_send = signal.SIGTERM
+            logger.info(f"Stopping calculation {calc_id}")
 
-                parent = psutil.Process(t.pid)
-                children = parent.children(recursive=True)
-                for process in children:
-                    process.send_signal(signal.SIGTERM)
+            parent = psutil.Process(t.pid)
+            children = parent.children(recursive=True)
+            for process in children:
+                process.send_signal(signal.SIGTERM)
 
-                #t.kill()
-                t.send_signal(signal_to_send)
-                t.wait()
+            t.send_signal(signal.SIGTERM)
+            t.wait()
 
-                return ErrorCodes.JOB_CANCELLED
+            return ErrorCodes.JOB_CANCELLED
+        finally:
+            supervisor.close()
 
-            sleep(1)
+ABORT_WATCH_TIMEOUT = 5
+
+class LocalSupervisor:
+    '''
+        Waits for a local process to finish or for its calculation to be aborted
+
+        The process is watched through a pidfd and the abort requests are received through
+        Redis pub/sub, so that neither is polled.
+    '''
+
+    def __init__(self, calc):
+        self.calc = calc
+        self.abort_read, self.abort_write = os.pipe()
+        self.pubsub = None
+        self.watcher = None
+
+        # The watcher thread can still deliver a message after close, it must not write to a closed pipe
+        self.lock = threading.Lock()
+        self.closed = False
+
+        if calc is None:
+            return
+
+        try:
+            self.pubsub = subscribe_abort(calc.id, self.on_abort)
+            self.watcher = self.pubsub.run_in_thread(sleep_time=ABORT_WATCH_TIMEOUT, daemon=True)
+        except redis.exceptions.RedisError as e:
+            logger.warning("Could not listen for abort requests of calculation {}: {}".format(calc.id, str(e)))
+
+    def on_abort(self, message):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                os.write(self.abort_write, b'a')
+            except OSError:
+                # The pipe is full, the abort is already signalled
+                pass
+
+    def is_aborted(self):
+        return self.calc is not None and AbortableAsyncResult(self.calc.task_id).is_aborted()
+
+    def wait(self, process):
+        '''
+            Blocks until the process exits or the calculation is aborted
+
+            Returns True if the calculation was aborted.
+        '''
+        if hasattr(os, 'pidfd_open'):
+            process_fd = os.pidfd_open(process.pid)
+        else:
+            # Older kernels and Python versions: a thread waits for the process instead
+            process_fd, done_write = os.pipe()
+            def _wait():
+                process.wait()
+                try:
+                    os.write(done_write, b'd')
+                except OSError:
+                    pass
+                os.close(done_write)
+            threading.Thread(target=_wait, daemon=True).start()
+
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(process_fd, selectors.EVENT_READ, 'process')
+                selector.register(self.abort_read, selectors.EVENT_READ, 'abort')
+                ready = [key.data for key, mask in selector.select()]
+        finally:
+            os.close(process_fd)
+
+        if 'process' in ready:
+            process.wait()
+            return False
+        return True
+
+    def close(self):
+        # The thread notices it was stopped at its next poll, it is not waited for
+        if self.watcher is not None:
+            self.watcher.stop()
+        elif self.pubsub is not None:
+            self.pubsub.close()
+
+        with self.lock:
+            self.closed = True
+            os.close(self.abort_read)
+            os.close(self.abort_write)
 
 def files_are_equal(f, input_file):
     with open(f) as ff:
@@ -462,8 +577,8 @@ def launch_xtb_calc(in_file, calc, files):
 
     xtb = XtbCalculation(calc)
     calc.input_file = xtb.command
-    calc.parameters.custom_basis_sets = ''
-    calc.parameters.save()
+    if calc.parameters.custom_basis_sets != '':
+        calc.parameters = calc.parameters.derive(custom_basis_sets='')
     calc.save()
 
     if xtb.option_file != "":
@@ -528,13 +643,17 @@ def launch_xtb_calc(in_file, calc, files):
 
 
 def xtb_opt(in_file, calc):
-    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
-
     ret = launch_xtb_calc(in_file, calc, ['calc.out', 'xtbopt.xyz'])
 
     if ret != ErrorCodes.SUCCESS:
         return ret
 
+    ingest_xtb_opt(calc)
+    return ErrorCodes.SUCCESS
+
+def ingest_xtb_opt(calc):
+    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
+
     with open("{}/xtbopt.xyz".format(local_folder)) as f:
         lines = f.readlines()
 
@@ -558,7 +677,16 @@ def xtb_opt(in_file, calc):
     s.save()
     prop.save()
 
-    return ErrorCodes.SUCCESS
+    return s
+
+def xtb_opt_freq(in_file, calc):
+    ret = launch_xtb_calc(in_file, calc, ['calc.out', 'xtbopt.xyz', 'vibspectrum', 'g98.out'])
+
+    if ret != ErrorCodes.SUCCESS:
+        return ret
+
+    s = ingest_xtb_opt(calc)
+    return ingest_xtb_freq(calc, s)
 
 def xtb_mep(in_file, calc):
     folder = '/'.join(in_file.split('/')[:-1])
@@ -630,9 +758,9 @@ def xtb_sp(in_file, calc):
     return ErrorCodes.SUCCESS
 
 def get_or_create(params, struct):
-    for p in struct.properties.all():
-        if p.parameters == params:
-            return p
+    prop = struct.properties.filter(parameters__md5=params.md5).first()
+    if prop is not None:
+        return prop
     return Property.objects.create(parameters=params, parent_structure=struct)
 
 def xtb_ts(in_file, calc):
@@ -770,13 +898,16 @@ def xtb_scan(in_file, calc):
         return ret
 
 def xtb_freq(in_file, calc):
-    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
-
     ret = launch_xtb_calc(in_file, calc, ['calc.out', 'vibspectrum', 'g98.out'])
 
     if ret != ErrorCodes.SUCCESS:
         return ret
 
+    return ingest_xtb_freq(calc, calc.structure)
+
+def ingest_xtb_freq(calc, structure):
+    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
+
     a = save_to_results(os.path.join(local_folder, "vibspectrum"), calc)
 
     with open("{}/calc.out".format(local_folder)) as f:
@@ -823,13 +954,13 @@ def xtb_freq(in_file, calc):
                 for _x, i in sorted((zip(list(x), spectrum)), reverse=True):
                     out.write("-{:.1f},{:.5f}\n".format(_x, i))
 
-    prop = get_or_create(calc.parameters, calc.structure)
+    prop = get_or_create(calc.parameters, structure)
     prop.energy = E
     prop.free_energy = G
     prop.freq = calc.id
     prop.save()
 
-    lines = [i +'\n' for i in calc.structure.xyz_structure.split('\n')]
+    lines = [i +'\n' for i in structure.xyz_structure.split('\n')]
     num_atoms = int(lines[0].strip())
     lines = lines[2:]
     hess = []
@@ -1041,13 +1172,17 @@ def orca_opt(in_file, calc):
         add_input_to_calc(calc)
         return orca_sp(in_file, calc)
 
-    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
-
     ret = launch_orca_calc(in_file, calc, ['calc.out', 'calc.xyz'])
 
     if ret != ErrorCodes.SUCCESS:
         return ret
 
+    ingest_orca_opt(calc)
+    return ErrorCodes.SUCCESS
+
+def ingest_orca_opt(calc):
+    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
+
     with open("{}/calc.xyz".format(local_folder)) as f:
         lines = f.readlines()
 
@@ -1071,7 +1206,28 @@ def orca_opt(in_file, calc):
 
     parse_orca_charges(calc, s)
 
-    return ErrorCodes.SUCCESS
+    return s
+
+def orca_opt_freq(in_file, calc):
+    lines = [i + '\n' for i in clean_xyz(calc.structure.xyz_structure).split('\n')[2:] if i != '' ]
+
+    if len(lines) == 1:#Single atom
+        s = Structure.objects.get_or_create(parent_ensemble=calc.result_ensemble, xyz_structure=calc.structure.xyz_structure, number=calc.structure.number)[0]
+        s.degeneracy = calc.structure.degeneracy
+        s.save()
+        calc.structure = s
+        calc.step = BasicStep.objects.get(name="Frequency Calculation")
+        calc.save()
+        add_input_to_calc(calc)
+        return orca_freq(in_file, calc)
+
+    ret = launch_orca_calc(in_file, calc, ['calc.out', 'calc.xyz'])
+
+    if ret != ErrorCodes.SUCCESS:
+        return ret
+
+    s = ingest_orca_opt(calc)
+    return ingest_orca_freq(calc, s)
 
 def orca_sp(in_file, calc):
     local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
@@ -1129,13 +1285,16 @@ def orca_ts(in_file, calc):
     return ErrorCodes.SUCCESS
 
 def orca_freq(in_file, calc):
-    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
-
     ret = launch_orca_calc(in_file, calc, ['calc.out'])
 
     if ret != ErrorCodes.SUCCESS:
         return ret
 
+    return ingest_orca_freq(calc, calc.structure)
+
+def ingest_orca_freq(calc, structure):
+    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
+
     with open("{}/calc.out".format(local_folder)) as f:
         lines = f.readlines()
         ind = len(lines)-1
@@ -1181,13 +1340,13 @@ def orca_freq(in_file, calc):
             for _x, i in sorted((zip(list(x), spectrum)), reverse=True):
                 out.write("-{:.1f},{:.5f}\n".format(_x, i))
 
-    prop = get_or_create(calc.parameters, calc.structure)
+    prop = get_or_create(calc.parameters, structure)
     prop.energy = E
     prop.free_energy = G
     prop.freq = calc.id
     prop.save()
 
-    raw_lines = calc.structure.xyz_structure.split('\n')
+    raw_lines = structure.xyz_structure.split('\n')
     xyz_lines = []
     for line in raw_lines:
         if line.strip() != '':
@@ -1202,7 +1361,7 @@ def orca_freq(in_file, calc):
             a, x, y, z = line.strip().split()
             struct.append([a, float(x), float(y), float(z)])
 
-    parse_orca_charges(calc, calc.structure)
+    parse_orca_charges(calc, structure)
 
     if num_atoms == 1:
         return ErrorCodes.SUCCESS
@@ -1387,12 +1546,12 @@ def save_to_results(f, calc_obj, multiple=False, out_name=""):
             if multiple:
                 a = system("obabel {}/{} -O {}/conf.xyz -m".format(os.path.join(CALCUS_SCR_HOME, str(calc_obj.id)), f, os.path.join(CALCUS_RESULTS_HOME, str(calc_obj.id))), force_local=True)
             else:
-                copyfile(os.path.join(CALCUS_SCR_HOME, str(calc_obj.id), fname), os.path.join(CALCUS_RESULTS_HOME, str(calc_obj.id), out_name))
+                publish(os.path.join(CALCUS_SCR_HOME, str(calc_obj.id), fname), os.path.join(CALCUS_RESULTS_HOME, str(calc_obj.id), out_name))
         else:
-            copyfile(f, os.path.join(CALCUS_RESULTS_HOME, str(calc_obj.id), out_name))
+            publish(f, os.path.join(CALCUS_RESULTS_HOME, str(calc_obj.id), out_name))
     elif len(s) == 1:
         name = s
-        copyfile(f, os.path.join(CALCUS_RESULTS_HOME, str(calc_obj.id), out_name))
+        publish(f, os.path.join(CALCUS_RESULTS_HOME, str(calc_obj.id), out_name))
     else:
         logger.error("Invalid file")
         return ErrorCodes.INVALID_FILE
@@ -1503,7 +1662,16 @@ def xtb_stda(in_file, calc):#TO OPTIMIZE
 
     return ErrorCodes.SUCCESS
 
-def calc_to_ccinput(calc):
+# Steps whose name is not understood by ccinput
+CCINPUT_TYPES = {
+        'opt_freq': 'opt+freq',
+    }
+
+def calc_to_ccinput(calc, software=None):
+    # The input can be written for another software than the one of the parameters (e.g. xtb through ORCA)
+    if software is None:
+        software = calc.parameters.software
+
     if calc.parameters.method != "":
         _method = calc.parameters.method
     elif calc.parameters.theory_level.lower() == "hf":
@@ -1514,9 +1682,8 @@ def calc_to_ccinput(calc):
         raise Exception("No method specified; theory level is {}".format(calc.parameters.theory_level))
 
     _specifications = calc.parameters.specifications
-    software = calc.parameters.software.lower()
-    if software in ['gaussian', 'orca']:
-        _specifications += ' ' + getattr(calc.order.author, "default_" + software)
+    if software.lower() in ['gaussian', 'orca']:
+        _specifications += ' ' + getattr(calc.order.author, "default_" + software.lower())
 
     PAL = int(os.environ.get("NUM_CPU", 1))
     MEM = int(os.environ.get("OMP_STACKSIZE", "1G")[:-1])*1024*PAL
@@ -1524,17 +1691,20 @@ def calc_to_ccinput(calc):
     if is_test:
         _nproc = min(4, PAL)
         _mem = 2000
+    elif calc.nproc > 0:
+        # Allocated by the local scheduler or sized for the cluster
+        _nproc = calc.nproc
+        _mem = calc.mem
+    elif calc.local:
+        _nproc = PAL
+        _mem = MEM
     else:
-        if calc.local:
-            _nproc = PAL
-            _mem = MEM
-        else:
-            _nproc = calc.order.resource.pal
-            _mem = calc.order.resource.memory
+        _nproc = calc.order.resource.pal
+        _mem = calc.order.resource.memory
 
     params = {
-            "software": calc.parameters.software,
-            "type": calc.step.name,
+            "software": software,
+            "type": CCINPUT_TYPES.get(calc.step.short_name, calc.step.name),
             "method": _method,
             "basis_set": calc.parameters.basis_set,
             "solvent": calc.parameters.solvent,
@@ -1552,11 +1722,58 @@ def calc_to_ccinput(calc):
             "aux_name": "struct2",
             "name": "calc",
     }
+
+    return generate_input(params)
+
+INPUT_TEMPLATE_PLACEHOLDER = "__CALCUS_XYZ__"
+
+CachedInput = namedtuple('CachedInput', ['input_file', 'confirmed_specifications'])
+
+def input_xyz_block(xyz):
+    # The coordinates as written in the input files by ccinput
+    return ''.join([i + '\n' for i in clean_xyz(standardize_xyz(xyz)).split('\n') if i != ''])
+
+def input_template_key(params, xyz_block):
+    '''
+        Returns the key of the input template, which depends on all the parameters except the coordinates
+    '''
+    elements = [line.split()[0] for line in xyz_block.split('\n') if line.strip() != '']
+    _params = {k: v for k, v in params.items() if k != 'xyz'}
+    return hashlib.md5(json.dumps([_params, elements], sort_keys=True).encode('utf-8')).hexdigest()
+
+def generate_input(params):
+    '''
+        Generates the input with ccinput, reusing the input of a previous structure with the same parameters if possible
+
+        Structures of an ensemble only differ by their coordinates, so the generated input is
+        cached as a template with a placeholder instead of the coordinates.
+    '''
+    # Scans can start from the current value of the coordinate, so the input depends on the geometry
+    cacheable = 'scan' not in (params['constraints'] or '').lower()
+
+    if cacheable:
+        try:
+            xyz_block = input_xyz_block(params['xyz'])
+        except CCInputException:
+            cacheable = False
+
+    if cacheable:
+        key = input_template_key(params, xyz_block)
+        template = get_input_template(key)
+        if template is not None:
+            return CachedInput(template['input_file'].replace(INPUT_TEMPLATE_PLACEHOLDER, xyz_block), template['confirmed_specifications'])
+
     try:
         inp = generate_calculation(**params)
     except CCInputException as e:
         return e
 
+    if cacheable and inp.input_file.count(xyz_block) == 1:
+        set_input_template(key, {
+            'input_file': inp.input_file.replace(xyz_block, INPUT_TEMPLATE_PLACEHOLDER),
+            'confirmed_specifications': inp.confirmed_specifications,
+        })
+
     return inp
 
 def launch_gaussian_calc(in_file, calc, files):
@@ -1896,15 +2113,29 @@ def gaussian_td(in_file, calc):
     return ErrorCodes.SUCCESS
 
 def gaussian_opt(in_file, calc):
-    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
-
     ret = launch_gaussian_calc(in_file, calc, ['calc.log'])
 
     if ret != ErrorCodes.SUCCESS:
         return ret
 
+    ingest_gaussian_opt(calc)
+    return ErrorCodes.SUCCESS
+
+def ingest_gaussian_opt(calc, link=None):
+    '''
+        Creates the optimised structure from the log
+
+        With compound jobs, only the log up to the end of the given link is read.
+    '''
+    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
+
     with open("{}/calc.log".format(local_folder)) as f:
         lines = f.readlines()
+
+        if link is not None:
+            end = [i for i, line in enumerate(lines) if line.find("Normal termination") != -1][link]
+            lines = lines[:end+1]
+
         ind = len(lines)-1
 
         while lines[ind].find("SCF Done") == -1:
@@ -1935,16 +2166,29 @@ def gaussian_opt(in_file, calc):
     prop.save()
 
     parse_gaussian_charges(calc, s)
-    return ErrorCodes.SUCCESS
+    return s
 
-def gaussian_freq(in_file, calc):
-    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
+def gaussian_opt_freq(in_file, calc):
+    ret = launch_gaussian_calc(in_file, calc, ['calc.log'])
+
+    if ret != ErrorCodes.SUCCESS:
+        return ret
+
+    # The frequencies are calculated in a second link, on the optimised geometry
+    s = ingest_gaussian_opt(calc, link=0)
+    return ingest_gaussian_freq(calc, s)
 
+def gaussian_freq(in_file, calc):
     ret = launch_gaussian_calc(in_file, calc, ['calc.log'])
 
     if ret != ErrorCodes.SUCCESS:
         return ret
 
+    return ingest_gaussian_freq(calc, calc.structure)
+
+def ingest_gaussian_freq(calc, structure):
+    local_folder = os.path.join(CALCUS_SCR_HOME, str(calc.id))
+
     with open("{}/calc.log".format(local_folder)) as f:
         outlines = f.readlines()
         ind = len(outlines)-1
@@ -1961,7 +2205,7 @@ def gaussian_freq(in_file, calc):
 
     SCF = outlines[ind].split()[4]
 
-    prop = get_or_create(calc.parameters, calc.structure)
+    prop = get_or_create(calc.parameters, structure)
     prop.energy = SCF
     prop.free_energy = float(0.0030119 + float(G) + float(SCF))
     prop.freq = calc.id
@@ -1975,7 +2219,7 @@ def gaussian_freq(in_file, calc):
     except IndexError:#"Standard orientation" is not in all Gaussian output files, apparently
         ind = 0
 
-        raw_lines = calc.structure.xyz_structure.split('\n')
+        raw_lines = structure.xyz_structure.split('\n')
         xyz_lines = []
         for line in raw_lines:
             if line.strip() != '':
@@ -2057,7 +2301,7 @@ def gaussian_freq(in_file, calc):
         for _x, i in sorted((zip(list(x), spectrum)), reverse=True):
             out.write("-{:.1f},{:.5f}\n".format(_x, i))
 
-    parse_gaussian_charges(calc, calc.structure)
+    parse_gaussian_charges(calc, structure)
     return ErrorCodes.SUCCESS
 
 def gaussian_ts(in_file, calc):
@@ -2358,20 +2602,27 @@ def analyse_opt(calc_id):
 
     software = calc.parameters.software
 
-    return funcs[software](calc)
+    ret = funcs[software](calc)
+    publish_frames(calc, calc.calculationframe_set.count())
+    return ret
 
 def analyse_opt_ORCA(calc):
     prepath = os.path.join(CALCUS_SCR_HOME, str(calc.id))
 
+    if calc.status in [2, 3]:
+        calc_path = os.path.join(CALCUS_RESULTS_HOME, str(calc.id), "calc.out")
+    else:
+        calc_path = os.path.join(prepath, "calc.out")
+
     RMSDs = [0]
 
-    if not os.path.isfile(os.path.join(prepath, "calc.out")):
+    if not result_exists(calc_path):
         return
 
     if not os.path.isfile(os.path.join(prepath, "calc_trj.xyz")):
         return
 
-    with open(os.path.join(prepath, "calc.out")) as f:
+    with open_result(calc_path) as f:
         lines = f.readlines()
     ind = 0
     flag = False
@@ -2417,10 +2668,10 @@ def analyse_opt_xtb(calc):
         else:
             path = os.path.join(CALCUS_SCR_HOME, str(calc.id), 'xtbopt.log')
 
-    if not os.path.isfile(path):
+    if not result_exists(path):
         return
 
-    with open(path) as f:
+    with open_result(path) as f:
         lines = f.readlines()
 
     xyz = ''.join(lines)
@@ -2465,13 +2716,13 @@ def analyse_opt_Gaussian(calc):
     else:
         return None
 
-    if not os.path.isfile(calc_path):
+    if not result_exists(calc_path):
         return
 
     _calc = Calculation.objects.prefetch_related('calculationframe_set').get(pk=calc.id)
     frames = _calc.calculationframe_set
 
-    with open(calc_path, encoding="utf8", errors='ignore') as f:
+    with open_result(calc_path, encoding="utf8", errors='ignore') as f:
         lines = f.readlines()
 
     if not calc.step.creates_ensemble:
@@ -2572,6 +2823,7 @@ BASICSTEP_TABLE = {
                 'Conformational Search': crest,
                 'Constrained Optimisation': xtb_scan,
                 'Frequency Calculation': xtb_freq,
+                'Optimisation and Frequency Calculation': xtb_opt_freq,
                 'TS Optimisation': xtb_ts,
                 'UV-Vis Calculation': xtb_stda,
                 'Single-Point Energy': xtb_sp,
@@ -2585,6 +2837,7 @@ BASICSTEP_TABLE = {
                 'TS Optimisation': orca_ts,
                 'MO Calculation': orca_mo_gen,
                 'Frequency Calculation': orca_freq,
+                'Optimisation and Frequency Calculation': orca_opt_freq,
                 'Constrained Optimisation': orca_scan,
                 'Single-Point Energy': orca_sp,
             },
@@ -2594,6 +2847,7 @@ BASICSTEP_TABLE = {
                 'Geometrical Optimisation': gaussian_opt,
                 'TS Optimisation': gaussian_ts,
                 'Frequency Calculation': gaussian_freq,
+                'Optimisation and Frequency Calculation': gaussian_opt_freq,
                 'Constrained Optimisation': gaussian_scan,
                 'Single-Point Energy': gaussian_sp,
                 'UV-Vis Calculation': gaussian_td,
@@ -2657,10 +2911,6 @@ def dispatcher(drawing, order_id):
     order = CalculationOrder.objects.get(pk=order_id)
     ensemble = order.ensemble
 
-    local = True
-    if order.resource is not None:
-        local = False
-
     step = order.step
 
     mode = "e"#Mode for input structure (Ensemble/Structure)
@@ -2753,10 +3003,8 @@ def dispatcher(drawing, order_id):
         logger.error("Invalid calculation order: {}".format(order.id))
         return
 
-    group_order = []
-    calculations = []
-
     input_structures = filter(order, input_structures)
+    result_ensemble = None
     if step.creates_ensemble:
         if order.name.strip() == "":
             e = Ensemble.objects.create(name="{} Result".format(order.step.name), origin=ensemble, parent_molecule=molecule)
@@ -2765,65 +3013,193 @@ def dispatcher(drawing, order_id):
 
         order.result_ensemble = e
         order.save()
+        result_ensemble = e
+    elif mode == 'c':
+        order.result_ensemble = ensemble
+        order.save()
 
-        for s in input_structures:
-            c = Calculation.objects.create(structure=s, order=order, date_submitted=timezone.now(), step=step, parameters=order.parameters, result_ensemble=e, constraints=order.constraints, aux_structure=order.aux_structure)
-            c.save()
-            if local:
-                calculations.append(c)
-                if not is_test:
-                    group_order.append(run_calc.s(c.id).set(queue='comp'))
-                else:
-                    group_order.append(run_calc.s(c.id))
-            else:
-                calculations.append(c)
-                c.local = False
-                c.save()
-                cmd = "launch\n{}\n".format(c.id)
-                send_cluster_command(cmd)
+    calculations = add_calculations(order, input_structures, result_ensemble)
+    start_calculations(order, calculations)
+
+def add_calculations(order, structures, result_ensemble):
+    now = timezone.now()
+    calculations = [Calculation(structure=s, order=order, date_submitted=now, step=order.step, parameters=order.parameters, result_ensemble=result_ensemble, constraints=order.constraints, aux_structure=order.aux_structure, local=order.resource is None) for s in structures]
+    return Calculation.bulk_add(order, calculations)
+
+def start_calculations(order, calculations):
+    if len(calculations) == 0:
+        return
 
+    if order.resource is None:
+        if not is_test:
+            submit_local_calcs(order.author_id, calculations, route_calculations(calculations))
+        else:
+            res = group([run_calc.s(c.id) for c in calculations]).apply_async()
+            for c, r in zip(calculations, res.results):
+                c.task_id = r.id
+            Calculation.objects.bulk_update(calculations, ['task_id'], batch_size=BULK_BATCH_SIZE)
     else:
-        if mode == 'c':
-            order.result_ensemble = ensemble
-            order.save()
-        for s in input_structures:
-            c = Calculation.objects.create(structure=s, order=order, date_submitted=timezone.now(), parameters=order.parameters, step=step, constraints=order.constraints, aux_structure=order.aux_structure)
-            c.save()
-            if local:
-                calculations.append(c)
-                if not is_test:
-                    group_order.append(run_calc.s(c.id).set(queue='comp'))
-                else:
-                    group_order.append(run_calc.s(c.id))
-            else:
-                c.local = False
-                c.save()
+        send_cluster_commands(["launch\n{}\n".format(c.id) for c in calculations])
+
+# Steps which can give more than one structure per calculation
+MULTIPLE_OUTPUT_STEPS = ['conf_search', 'constr_conf_search', 'constr_opt', 'mep']
+
+def calculation_outputs(calc):
+    '''
+        Returns the structures given by a calculation to the next stages of its workflow
+    '''
+    if calc.status != 2:
+        return []
+
+    if not calc.step.creates_ensemble:
+        return [calc.structure]
+
+    if calc.result_ensemble is None:
+        return []
+
+    structures = calc.result_ensemble.structure_set.all()
+    if calc.step.short_name not in MULTIPLE_OUTPUT_STEPS:
+        structures = structures.filter(number=calc.structure.number)
+    return list(structures.order_by('number'))
+
+def order_outputs(order):
+    if order.step.creates_ensemble:
+        if order.result_ensemble is None:
+            return []
+        return list(order.result_ensemble.structure_set.order_by('number'))
+    return list(Structure.objects.filter(calculation__order=order, calculation__status=2).distinct().order_by('number'))
+
+def stage_order(stage, parent_order):
+    '''
+        Returns the order of a workflow stage, creating it if needed
+    '''
+    if stage.order is not None:
+        return stage.order
+
+    if parent_order.step.creates_ensemble:
+        ensemble = parent_order.result_ensemble
+    elif parent_order.ensemble is not None:
+        ensemble = parent_order.ensemble
+    elif parent_order.structure is not None:
+        ensemble = parent_order.structure.parent_ensemble
+    else:
+        ensemble = parent_order.result_ensemble
+
+    if stage.name.strip() != "":
+        name = stage.name
+    elif stage.step.creates_ensemble:
+        name = "{} Result".format(stage.step.name)
+    else:
+        name = ensemble.name
+
+    order = CalculationOrder.objects.create(name=name, date=timezone.now(), parameters=stage.parameters, author=stage.workflow.author, step=stage.step,
+            project=parent_order.project, ensemble=ensemble, filter=stage.filter, resource=stage.resource)
 
-                cmd = "launch\n{}\n".format(c.id)
-                send_cluster_command(cmd)
+    if stage.step.creates_ensemble:
+        order.result_ensemble = Ensemble.objects.create(name=name, origin=ensemble, parent_molecule=ensemble.parent_molecule)
+        order.save()
+
+    stage.order = order
+    stage.save()
+    return order
+
+def advance(calc):
+    '''
+        Launches the next stages of the workflow of a finished calculation
+
+        Stages without filter (or filtering by number) start right away on the results of each
+        calculation. The others wait until all the calculations of their parent stage are done.
+        Returns the new calculations of each order, which are not started yet.
+    '''
+    stage = WorkflowStage.objects.filter(order_id=calc.order_id).first()
+    if stage is None:
+        return []
+
+    parent_order = CalculationOrder.objects.get(pk=calc.order_id)
+    parent_done = parent_order.num_queued + parent_order.num_running == 0
+
+    new = []
+    for child in stage.children.select_related('filter', 'step', 'workflow'):
+        if child.streams:
+            structures = calculation_outputs(calc)
+        elif parent_done:
+            structures = order_outputs(parent_order)
+        else:
+            continue
+
+        if len(structures) == 0:
+            continue
+
+        # Calculations of the parent stage can finish at the same time
+        with transaction.atomic():
+            child = WorkflowStage.objects.select_for_update().select_related('filter', 'step', 'workflow', 'order').get(pk=child.pk)
+            order = stage_order(child, parent_order)
 
-    for task, c in zip(group_order, calculations):
-        res = task.apply_async()
-        c.task_id = res
-        c.save()
+            launched = set(order.calculation_set.values_list('structure_id', flat=True))
+            structures = [s for s in filter(order, structures) if s.id not in launched]
+            new.append((order, add_calculations(order, structures, order.result_ensemble if child.step.creates_ensemble else None)))
+    return new
 
-def add_input_to_calc(calc):
-    inp = calc_to_ccinput(calc)
+@app.task
+def advance_workflow(calc_id):
+    calc = Calculation.objects.select_related('step', 'structure', 'result_ensemble').get(pk=calc_id)
+    for order, calculations in advance(calc):
+        if len(calculations) > 0:
+            logger.info("Workflow: launching {} calculation(s) of order {}".format(len(calculations), order.id))
+        start_calculations(order, calculations)
+
+def launch_local_calcs(batch):
+    '''
+        Sends calculations to the comp workers as a single group, given as (calculation, queue) pairs
+    '''
+    calculations = [calc for calc, queue in batch]
+
+    # Saved before sending, so that the tasks can tell if they were superseded
+    for calc in calculations:
+        calc.task_id = uuid()
+    Calculation.objects.bulk_update(calculations, ['task_id'], batch_size=BULK_BATCH_SIZE)
+
+    try:
+        group([run_calc.s(calc.id).set(queue=queue, task_id=calc.task_id) for calc, queue in batch]).apply_async()
+    except Exception:
+        Calculation.objects.filter(pk__in=[calc.id for calc in calculations]).update(task_id='')
+        raise
+
+def submit_local_calcs(profile_id, calculations, queue):
+    '''
+        Queues local calculations behind the fair-share scheduler
+    '''
+    try:
+        fairshare.submit(profile_id, [c.id for c in calculations], queue)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not queue the calculations for fair-share, sending them directly: {}".format(str(e)))
+        launch_local_calcs([(c, queue) for c in calculations])
+        return
+
+    feed_local_calcs()
+
+def feed_local_calcs():
+    try:
+        fairshare.feed(launch_local_calcs)
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not send the next local calculations: {}".format(str(e)))
+
+def add_input_to_calc(calc, software=None):
+    inp = calc_to_ccinput(calc, software)
     if isinstance(inp, CCInputException):
         msg = f"CCInput error: {str(inp)}"
         if is_test:
             print(msg)
-        calc.error_message = msg
-        calc.status = 3
-        calc.save()
+        calc.transition(3, error_message=msg)
         return ErrorCodes.FAILED_TO_CREATE_INPUT
 
     calc.input_file = inp.input_file
 
-    calc.parameters.specifications = inp.confirmed_specifications
+    # Parameters are shared between calculations, so they are never modified in place
+    if calc.parameters.specifications != inp.confirmed_specifications:
+        calc.parameters = calc.parameters.derive(specifications=inp.confirmed_specifications)
 
     calc.save()
-    calc.parameters.save()
 
 @app.task(base=AbortableTask)
 def run_calc(calc_id):
@@ -2849,6 +3225,51 @@ def run_calc(calc_id):
         logger.info(f"Could not get calculation {calc_id}")
         return ErrorCodes.UNKNOWN_TERMINATION
 
+    if not calc.local or is_test:
+        return _run_calc(calc)
+
+    # Sent again since, e.g. by the recovery after Redis lost its data
+    if run_calc.request.id is not None and calc.task_id != run_calc.request.id:
+        logger.warning("Calc {} was sent again with task {}, skipping task {}".format(calc_id, calc.task_id, run_calc.request.id))
+        return ErrorCodes.JOB_CANCELLED
+
+    def is_cancelled():
+        return Calculation.objects.filter(pk=calc.id, status=3).exists()
+
+    # The calculations of each queue wait for resources in their own line
+    queue = (run_calc.request.delivery_info or {}).get('routing_key') or scheduler.DEFAULT_QUEUE
+
+    try:
+        if not scheduler.acquire(calc, is_cancelled, queue):
+            logger.info(f"Calc {calc_id} cancelled while waiting for resources")
+            return ErrorCodes.JOB_CANCELLED
+
+        try:
+            return _run_calc(calc)
+        finally:
+            scheduler.release(calc.id)
+    finally:
+        # Make room for the next calculation
+        try:
+            fairshare.finished(calc.id, queue)
+        except redis.exceptions.RedisError as e:
+            logger.warning("Could not release the fair-share slot of calc {}: {}".format(calc.id, str(e)))
+        feed_local_calcs()
+
+def size_remote_calc(calc):
+    '''
+        Chooses the number of cores and memory of a calculation within the limits of its cluster access
+    '''
+    resource = calc.order.resource
+    pal = max(int(resource.pal), 1)
+    calc.nproc, calc.mem = scheduler.estimate_resources(calc, pal, int(resource.memory)//pal, get_runtime_model())
+    calc.save(update_fields=['nproc', 'mem'])
+
+    logger.info("Calculation {} will use {} core(s) and {} MB on {}".format(calc.id, calc.nproc, calc.mem, resource.cluster_address))
+
+def _run_calc(calc):
+    calc_id = calc.id
+
     f = BASICSTEP_TABLE[calc.parameters.software][calc.step.name]
 
     res_dir = os.path.join(CALCUS_RESULTS_HOME, str(calc.id))
@@ -2858,15 +3279,17 @@ def run_calc(calc_id):
         logger.info(f"Calc {calc_id} already revoked")
         return ErrorCodes.JOB_CANCELLED
 
+    if not calc.local and calc.status == 0 and calc.remote_id == 0 and not is_test:
+        size_remote_calc(calc)
+
     if calc.parameters.software != "xtb": # xtb currently not directly supported by ccinput
         ret = add_input_to_calc(calc)
         if isinstance(ret, ErrorCodes):
             return ret
     else:
         if calc.step.short_name in ['mep', 'optts']:
-            calc.parameters.software = "ORCA"
-            ret = add_input_to_calc(calc)
-            calc.parameters.software = "xtb"
+            # ORCA drives xtb for these steps, the parameters stay those of xtb
+            ret = add_input_to_calc(calc, "ORCA")
             if isinstance(ret, ErrorCodes):
                 return ret
         else:
@@ -2889,6 +3312,13 @@ def run_calc(calc_id):
         with open(in_file, 'w') as out:
             out.write(clean_xyz(calc.structure.xyz_structure))
 
+        if calc.local:
+            if prepare_restart(calc, workdir, in_file):
+                logger.info(f"Restarting calc {calc_id} from its checkpoint files")
+                calc.save()
+            elif not is_test and stage_parent(calc, workdir):
+                calc.save()
+
     if not calc.local and calc.remote_id == 0:
         logger.debug(f"Preparing remote folder for calc {calc_id}")
         pid = int(threading.get_ident())
@@ -2910,59 +3340,107 @@ def run_calc(calc_id):
         traceback.print_exc()
 
         calc.refresh_from_db()
-        calc.date_finished = timezone.now()
-
-        calc.status = 3
-        calc.error_message = "Incorrect termination ({})".format(str(e))
-        calc.save()
+        calc.transition(3, error_message="Incorrect termination ({})".format(str(e)))
         logger.info(f"Error while running calc {calc_id}: '{str(e)}'")
     else:
         calc.refresh_from_db()
-        calc.date_finished = timezone.now()
 
         if ret == ErrorCodes.JOB_CANCELLED:
             pid = int(threading.get_ident())
             if pid in kill_sig:
                 kill_sig.remove(pid)
-            calc.status = 3
-            calc.error_message = "Job cancelled"
+            calc.transition(3, error_message="Job cancelled")
             logger.info("Job {} cancelled".format(calc.id))
         elif ret == ErrorCodes.SERVER_DISCONNECTED:
             return ret
         elif ret == ErrorCodes.SUCCESS:
-            calc.status = 2
+            calc.transition(2)
         elif ret == ErrorCodes.FAILED_TO_RUN_LOCAL_SOFTWARE:
-            calc.status = 3
             if calc.error_message == "":
-                calc.error_message = "Failed to execute the relevant command"
+                calc.transition(3, error_message="Failed to execute the relevant command")
+            else:
+                calc.transition(3)
         else:
-            calc.status = 3
-            calc.error_message = "Unknown termination"
-
-        calc.save()
+            calc.transition(3, error_message="Unknown termination")
 
     logger.info(f"Calc {calc_id} finished")
 
-    #just calc.out/calc.log?
-    for f in glob.glob("{}/*.out".format(workdir)):
-        fname = f.split('/')[-1]
-        copyfile(f, "{}/{}".format(res_dir, fname))
-
-    for f in glob.glob("{}/*.log".format(workdir)):
-        fname = f.split('/')[-1].replace('.log', '.out')
-        copyfile(f, "{}/{}".format(res_dir, fname))
-
-    if calc.step.creates_ensemble:
-        analyse_opt(calc.id)
-
     if is_test and os.getenv("CAN_USE_CACHED_LOGS") == "true" and os.getenv("USE_CACHED_LOGS") == "true" and not calc_is_cached(calc):
         test_name = os.environ['TEST_NAME']
         shutil.copytree(os.path.join(tests_dir, "scr", str(calc.id)), os.path.join(tests_dir, "cache", test_name), dirs_exist_ok=True)
         with open(os.path.join(tests_dir, "cache", test_name+'.input'), 'w') as out:
             out.write(calc.input_file)
 
+    # The checkpoints of failed calculations stay in the scratch directory for their restart
+    keep = checkpoints.checkpoint_files(calc.parameters.software) if calc.status != 2 else []
+    num_files, size, renamed, duration = promote_logs(workdir, res_dir, keep)
+    logger.info("Saved {} log(s) of calc {} ({:.1f} MB, {} renamed) in {:.2f} s".format(num_files, calc_id, size/1024**2, renamed, duration))
+
+    if calc.step.creates_ensemble:
+        analyse_opt(calc.id)
+
+    # The next stages of the workflow start as soon as their input is ready
+    if WorkflowStage.objects.filter(order_id=calc.order_id, children__isnull=False).exists():
+        if is_test:
+            advance_workflow(calc.id)
+        else:
+            advance_workflow.delay(calc.id)
+
+    release_scratch(calc, workdir)
+
+    if is_test:
+        compress_results(calc.id)
+    else:
+        compress_results.delay(calc.id)
+
     return ret
 
+@app.task
+def compress_results(calc_id):
+    num_files, size, compressed_size = compress_directory(os.path.join(CALCUS_RESULTS_HOME, str(calc_id)))
+    if num_files > 0:
+        logger.info("Compressed {} result file(s) of calc {} from {:.1f} to {:.1f} MB".format(num_files, calc_id, size/1024**2, compressed_size/1024**2))
+
+@app.task
+def evict_scratch():
+    num, size = checkpoints.evict_scratch()
+    if num > 0:
+        logger.info("Removed the scratch files of {} finished calculation(s), {:.1f} MB".format(num, size/1024**2))
+
+RESULTS_MIGRATION_BATCH = 500
+
+# Results modified more recently might belong to a relaunched calculation which is running
+RESULTS_MIGRATION_MIN_AGE = 3600
+
+@app.task
+def migrate_results():
+    '''
+        Compresses the results of the calculations which finished before results were stored compressed
+
+        Each run handles a batch of calculations and remembers where it stopped.
+    '''
+    cursor = get_results_migration_cursor()
+    ids = list(Calculation.objects.filter(pk__gt=cursor, status__in=[2, 3]).order_by('pk').values_list('pk', flat=True)[:RESULTS_MIGRATION_BATCH])
+    if len(ids) == 0:
+        return 0
+
+    total_files = 0
+    total_size = 0
+    total_compressed = 0
+    for calc_id in ids:
+        # The calculation might have been relaunched since the batch was selected
+        if not Calculation.objects.filter(pk=calc_id, status__in=[2, 3]).exists():
+            continue
+
+        num_files, size, compressed_size = compress_directory(os.path.join(CALCUS_RESULTS_HOME, str(calc_id)), RESULTS_MIGRATION_MIN_AGE)
+        total_files += num_files
+        total_size += size
+        total_compressed += compressed_size
+
+    set_results_migration_cursor(ids[-1])
+    logger.info("Compressed {} result file(s) of {} calculation(s) from {:.1f} to {:.1f} MB".format(total_files, len(ids), total_size/1024**2, total_compressed/1024**2))
+    return len(ids)
+
 @app.task
 def del_order(order_id):
     _del_order(order_id)
@@ -3039,14 +3517,12 @@ def _del_structure(s):
     s.delete()
 
 def send_cluster_command(cmd):
-    if docker:
-        connection = redis.Redis(host='redis', port=6379, db=2)
-    else:
-        connection = redis.Redis(host='localhost', port=6379, db=2)
+    send_cluster_commands([cmd])
 
-    _cmd = cmd.replace('\n', '&')
-    connection.rpush('cluster', _cmd)
-    connection.close()
+def send_cluster_commands(cmds):
+    # A single push for all the commands, through the shared connection pool
+    connection = get_connection()
+    connection.rpush('cluster', *[cmd.replace('\n', '&') for cmd in cmds])
 
 @app.task
 def cancel(calc_id):
@@ -3060,17 +3536,17 @@ def kill_calc(calc):
             if calc.status == 1:
                 res = AbortableAsyncResult(calc.task_id)
                 res.abort()
-                calc.status = 3
-                calc.error_message = "Job cancelled"
-                calc.save()
+                publish_abort(calc.id)
+                calc.transition(3, error_message="Job cancelled")
             elif calc.status == 2:
                 logger.warning("Cannot cancel calculation which is already done")
                 return
             else:
                 app.control.revoke(calc.task_id)
-                calc.status = 3
-                calc.error_message = "Job cancelled"
-                calc.save()
+                calc.transition(3, error_message="Job cancelled")
+        elif calc.status == 0:
+            # Not yet sent by the fair-share scheduler, which skips cancelled calculations
+            calc.transition(3, error_message="Job cancelled")
         else:
             logger.error("Cannot cancel calculation without task id")
     else:
@@ -3087,6 +3563,72 @@ def backup_db():
     logger.info("Backup up database")
     management.call_command('dbbackup', clean=True, interactive=False)
 
+@app.task
+def reconcile_unseen_calculations():
+    num = Profile.reconcile_unseen()
+    if num > 0:
+        logger.warning("Corrected the unseen calculations count of {} profile(s)".format(num))
+
+@worker_ready.connect
+def recover_interrupted_calcs(**kwargs):
+    '''
+        Requeues the local calculations interrupted by the restart of a comp worker
+
+        They continue from the checkpoint files left in their scratch directory.
+    '''
+    if is_test:
+        return
+
+    try:
+        connection = get_connection()
+        with connection.lock("recover_interrupted_calcs", timeout=300):
+            scheduler.release_dead_jobs(connection)
+            running = scheduler.running_calcs(connection)
+
+            calcs = list(Calculation.objects.filter(local=True, status=1).exclude(pk__in=running).select_related('order', 'parameters', 'step', 'structure'))
+            for calc in calcs:
+                logger.warning("Requeuing interrupted calc {}".format(calc.id))
+                for queue in QUEUES.values():
+                    fairshare.finished(calc.id, queue)
+                calc.transition(0)
+                submit_local_calcs(calc.order.author_id, [calc], route_calculations([calc]))
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not recover the interrupted calculations: {}".format(str(e)))
+
+    requeue_lost_calcs()
+
+def requeue_lost_calcs():
+    '''
+        Queues again the local calculations which are missing from the fair-share lines
+
+        The lines only exist in Redis, so they are lost if Redis restarts without persistence.
+    '''
+    try:
+        calcs = fairshare.lost_calcs()
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not look for lost calculations: {}".format(str(e)))
+        return
+
+    orders = {}
+    for calc in calcs:
+        orders.setdefault(calc.order_id, []).append(calc)
+
+    for calculations in orders.values():
+        logger.warning("Requeuing {} lost calc(s) of order {}".format(len(calculations), calculations[0].order_id))
+        submit_local_calcs(calculations[0].order.author_id, calculations, route_calculations(calculations))
+
+@app.task
+def feed_fairshare():
+    feed_local_calcs()
+
+@app.task
+def requeue_lost_fairshare():
+    requeue_lost_calcs()
+
+@app.task
+def train_runtime_model():
+    prediction.train()
+
 @app.task
 def ping_satellite():
     r = requests.post("https://calcus-satellite-tg3y3xrnxq-uc.a.run.app/ping", data={'code': settings.PING_CODE})
@@ -26,3 +26,16 @@ register = template.Library()
 def get_calcus_version():
     return settings.CALCUS_VERSION_HASH
 
+
+@register.filter
+def duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return "< 1 min"
+
+    hours, minutes = divmod(seconds//60, 60)
+    if hours == 0:
+        return "{} min".format(minutes)
+    if hours < 48:
+        return "{} h {} min".format(hours, minutes)
+    return "{} days".format(round(hours/24))
@@ -62,6 +62,10 @@ class XtbCalculationTests(CalculationUnitTest):
         self.assertTrue(self.run_test(type="Frequency Calculation",
             in_file="carbo_cation.mol", charge=1))
 
+    def test_opt_freq(self):
+        self.assertTrue(self.run_test(type="Optimisation and Frequency Calculation",
+            in_file="carbo_cation.mol", charge=1, callback=self.cb_has_frequencies))
+
     def test_freq_solv_GBSA(self):
         self.assertTrue(self.run_test(type="Frequency Calculation",
             in_file="carbo_cation.mol", charge=1, solvent="Chloroform", solvation_model="GBSA"))
@@ -209,6 +213,15 @@ class OrcaCalculationTests(CalculationUnitTest):
         self.assertTrue(self.run_test(type="Frequency Calculation", theory_level="DFT",
                 method="M062X", in_file="Cl.xyz", charge=-1))
 
+    def test_opt_freq_HF(self):
+        self.assertTrue(self.run_test(type="Optimisation and Frequency Calculation", in_file="carbo_cation.mol",
+                charge=1, callback=self.cb_has_frequencies))
+
+    def test_opt_freq_DFT_single_atom(self):
+        self.assertTrue(self.run_test(type="Optimisation and Frequency Calculation", theory_level="DFT",
+                method="M062X", in_file="Cl.xyz", charge=-1,
+                callback=partial(self.cb_has_n_conformers, 1)))
+
     def test_ts_SE(self):
         self.assertTrue(self.run_test(theory_level="Semi-empirical", method="AM1",
                 type="TS Optimisation", in_file="mini_ts.xyz",
@@ -379,6 +392,15 @@ class GaussianCalculationTests(CalculationUnitTest):
         self.assertTrue(self.run_test(type="Frequency Calculation", theory_level="DFT",
                 method="M062X", in_file="Cl.xyz", charge=-1))
 
+    def test_opt_freq_HF(self):
+        self.assertTrue(self.run_test(type="Optimisation and Frequency Calculation", in_file="carbo_cation.mol",
+                charge=1, callback=self.cb_has_frequencies))
+
+    def test_opt_freq_DFT_single_atom(self):
+        self.assertTrue(self.run_test(type="Optimisation and Frequency Calculation", theory_level="DFT",
+                method="M062X", in_file="Cl.xyz", charge=-1,
+                callback=partial(self.cb_has_n_conformers, 1)))
+
     def test_ts_SE(self):
         self.assertTrue(self.run_test(theory_level="Semi-empirical", method="AM1",
                 type="TS Optimisation", in_file="mini_ts.xyz",
@@ -0,0 +1,288 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import os
+import shutil
+import tempfile
+import datetime
+
+from .models import *
+from .checkpoints import clear_scratch, release_scratch, last_frame, restart_orca_input, restart_gaussian_input, prepare_restart, find_parent, stage_parent, evict_scratch, SCRATCH_GRACE, SCRATCH_TTL
+from .environment_variables import CALCUS_SCR_HOME
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+ORCA_INPUT = """!OPT B3LYP Def2-SVP
+*xyz 0 1
+H    0.00000000   0.00000000   0.00000000
+H    0.00000000   0.00000000   0.74000000
+*
+%pal
+nprocs 4
+end
+"""
+
+GAUSSIAN_INPUT = """%chk=calc.chk
+%nproc=4
+%mem=4000MB
+#p opt(modredundant) B3LYP/Def2SVP
+
+File created by ccinput
+
+0 1
+H    0.00000000   0.00000000   0.00000000
+H    0.00000000   0.00000000   0.74000000
+
+B 1 2 F
+
+"""
+
+TRAJECTORY = """2
+E -1.0
+H 0.0 0.0 0.0
+H 0.0 0.0 0.80
+2
+E -1.1
+H 0.0 0.0 0.0
+H 0.0 0.0 0.75
+2
+truncated
+H 0.0 0.0 0.0
+"""
+
+class CheckpointTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.workdir = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def touch(self, name, content=""):
+        with open(os.path.join(self.workdir, name), 'w') as out:
+            out.write(content)
+
+    def get_calc(self, software, step, input_file=""):
+        params = Parameters(charge=0, multiplicity=1, software=software)
+        return Calculation(parameters=params, step=BasicStep(short_name=step), input_file=input_file)
+
+    def test_clear_scratch(self):
+        self.touch("calc.gbw")
+        self.touch("calc.out")
+        clear_scratch(self.workdir, "ORCA")
+
+        self.assertEqual(os.listdir(self.workdir), ["calc.gbw"])
+
+    def test_release_scratch(self):
+        self.touch("calc.gbw")
+        self.touch("calc_trj.xyz")
+        self.touch("calc.out")
+        calc = self.get_calc("ORCA", "opt")
+        calc.status = 2
+        release_scratch(calc, self.workdir)
+
+        self.assertEqual(os.listdir(self.workdir), ["calc.gbw"])
+
+    def test_release_scratch_failed(self):
+        self.touch("calc_trj.xyz")
+        self.touch("calc.out")
+        calc = self.get_calc("ORCA", "opt")
+        calc.status = 3
+        release_scratch(calc, self.workdir)
+
+        self.assertEqual(os.listdir(self.workdir), ["calc_trj.xyz"])
+
+    def test_release_scratch_empty(self):
+        workdir = os.path.join(self.workdir, "1")
+        os.mkdir(workdir)
+        with open(os.path.join(workdir, "calc.out"), 'w') as out:
+            out.write("")
+
+        calc = self.get_calc("xtb", "sp")
+        calc.status = 2
+        release_scratch(calc, workdir)
+
+        self.assertFalse(os.path.isdir(workdir))
+
+    def test_last_frame(self):
+        self.touch("calc_trj.xyz", TRAJECTORY)
+        self.assertEqual(last_frame(os.path.join(self.workdir, "calc_trj.xyz")), "H 0.0 0.0 0.0\nH 0.0 0.0 0.75\n")
+
+    def test_orca_input(self):
+        inp = restart_orca_input(ORCA_INPUT, "H 0.0 0.0 0.0\nH 0.0 0.0 0.75\n")
+
+        self.assertIn("!MORead", inp)
+        self.assertIn('%moinp "restart.gbw"', inp)
+        self.assertIn("H 0.0 0.0 0.75\n*", inp)
+        self.assertNotIn("0.74000000", inp)
+
+    def test_gaussian_input(self):
+        inp = restart_gaussian_input(GAUSSIAN_INPUT, True)
+
+        self.assertIn("B3LYP/Def2SVP guess=read geom=check", inp)
+        self.assertIn("0 1\n\nB 1 2 F", inp)
+        self.assertNotIn("0.74000000", inp)
+
+    def test_gaussian_input_oldchk(self):
+        inp = restart_gaussian_input(GAUSSIAN_INPUT.replace("opt(modredundant)", "opt(ts, NoEigenTest, CalcFC)"), False, oldchk="parent.chk", read_fc=True)
+
+        self.assertTrue(inp.startswith("%oldchk=parent.chk\n%chk=calc.chk"))
+        self.assertIn("opt(ts, NoEigenTest, ReadFC)", inp)
+
+    def test_gaussian_input_guess_only(self):
+        inp = restart_gaussian_input(GAUSSIAN_INPUT, False)
+
+        self.assertIn("guess=read", inp)
+        self.assertNotIn("geom=check", inp)
+        self.assertIn("0.74000000", inp)
+
+    def test_gaussian_input_existing_options(self):
+        inp = restart_gaussian_input(GAUSSIAN_INPUT.replace("B3LYP/Def2SVP", "B3LYP/Def2SVP Guess=Mix geom=(check)"), True)
+
+        self.assertIn("B3LYP/Def2SVP guess=(Mix,read) geom=(check)", inp)
+        self.assertEqual(inp.lower().count("geom="), 1)
+
+    def test_orca_restart(self):
+        self.touch("calc.gbw")
+        self.touch("calc_trj.xyz", TRAJECTORY)
+        calc = self.get_calc("ORCA", "opt", ORCA_INPUT)
+
+        self.assertTrue(prepare_restart(calc, self.workdir, os.path.join(self.workdir, "in.xyz")))
+        self.assertTrue(os.path.isfile(os.path.join(self.workdir, "restart.gbw")))
+        self.assertIn("!MORead", calc.input_file)
+
+    def test_no_checkpoint(self):
+        calc = self.get_calc("ORCA", "opt", ORCA_INPUT)
+
+        self.assertFalse(prepare_restart(calc, self.workdir, os.path.join(self.workdir, "in.xyz")))
+        self.assertEqual(calc.input_file, ORCA_INPUT)
+
+    def test_xtb_restart(self):
+        in_file = os.path.join(self.workdir, "in.xyz")
+        self.touch("in.xyz", "2\n\nH 0.0 0.0 0.0\nH 0.0 0.0 0.74\n")
+        self.touch("xtbopt.log", TRAJECTORY)
+        calc = self.get_calc("xtb", "opt")
+
+        self.assertTrue(prepare_restart(calc, self.workdir, in_file))
+        with open(in_file) as f:
+            self.assertEqual(f.read(), "2\n\nH 0.0 0.0 0.0\nH 0.0 0.0 0.75\n")
+
+class StageParentTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+
+        self.proj = Project.objects.create(name="Test project", author=self.profile)
+        self.mol = Molecule.objects.create(name="Test molecule", project=self.proj)
+        self.ensemble = Ensemble.objects.create(name="Test ensemble", parent_molecule=self.mol)
+        self.result = Ensemble.objects.create(name="Result", parent_molecule=self.mol, origin=self.ensemble)
+
+        self.params = Parameters.objects.create(charge=0, multiplicity=1, software="ORCA")
+
+        opt = CalculationOrder.objects.create(author=self.profile, step=BasicStep.objects.get(short_name="opt"), result_ensemble=self.result)
+        start = Structure.objects.create(parent_ensemble=self.ensemble, number=1)
+        self.parent = Calculation.objects.create(order=opt, structure=start, step=opt.step, parameters=self.params, status=2, local=True)
+
+        self.structure = Structure.objects.create(parent_ensemble=self.result, number=1)
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.workdir = self.tmpdir.name
+        self.parent_dir = os.path.join(CALCUS_SCR_HOME, str(self.parent.id))
+        os.makedirs(self.parent_dir, exist_ok=True)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        shutil.rmtree(self.parent_dir, ignore_errors=True)
+
+    def get_calc(self, step, params=None):
+        order = CalculationOrder.objects.create(author=self.profile, step=BasicStep.objects.get(short_name=step))
+        return Calculation.objects.create(order=order, structure=self.structure, step=order.step, parameters=params or self.params, local=True, input_file=ORCA_INPUT)
+
+    def test_find_parent(self):
+        self.assertEqual(find_parent(self.get_calc("freq")), self.parent)
+
+    def test_find_parent_other_charge(self):
+        params = Parameters.objects.create(charge=1, multiplicity=2, software="ORCA")
+        self.assertIsNone(find_parent(self.get_calc("freq", params)))
+
+    def test_find_parent_hessian(self):
+        opt_freq = self.get_calc("opt_freq")
+        Calculation.objects.filter(pk=opt_freq.pk).update(status=2, date_finished=timezone.now()-datetime.timedelta(hours=1))
+        Calculation.objects.filter(pk=self.parent.pk).update(date_finished=timezone.now())
+
+        self.assertEqual(find_parent(self.get_calc("optts")), opt_freq)
+
+    def test_stage_orbitals(self):
+        with open(os.path.join(self.parent_dir, "calc.gbw"), 'w') as out:
+            out.write("orbitals")
+
+        calc = self.get_calc("freq")
+        self.assertTrue(stage_parent(calc, self.workdir))
+        self.assertTrue(os.path.isfile(os.path.join(self.workdir, "parent.gbw")))
+        self.assertIn('%moinp "parent.gbw"', calc.input_file)
+
+    def test_stage_hessian(self):
+        freq = self.get_calc("freq")
+        Calculation.objects.filter(pk=freq.pk).update(status=2)
+
+        freq_dir = os.path.join(CALCUS_SCR_HOME, str(freq.id))
+        os.makedirs(freq_dir, exist_ok=True)
+        with open(os.path.join(freq_dir, "calc.hess"), 'w') as out:
+            out.write("hessian")
+
+        try:
+            calc = self.get_calc("optts")
+            self.assertTrue(stage_parent(calc, self.workdir))
+            self.assertIn('inhessname "parent.hess"', calc.input_file)
+        finally:
+            shutil.rmtree(freq_dir, ignore_errors=True)
+
+    def test_nothing_to_stage(self):
+        calc = self.get_calc("freq")
+        self.assertFalse(stage_parent(calc, self.workdir))
+        self.assertEqual(calc.input_file, ORCA_INPUT)
+
+    def finish_parent(self, age):
+        Calculation.objects.filter(pk=self.parent.pk).update(date_finished=timezone.now()-datetime.timedelta(seconds=age))
+
+    def test_evict_scratch(self):
+        self.finish_parent(2*SCRATCH_GRACE)
+        evict_scratch()
+        self.assertFalse(os.path.isdir(self.parent_dir))
+
+    def test_evict_scratch_recent(self):
+        self.finish_parent(SCRATCH_GRACE/2)
+        evict_scratch()
+        self.assertTrue(os.path.isdir(self.parent_dir))
+
+    def test_evict_scratch_awaited(self):
+        self.finish_parent(2*SCRATCH_GRACE)
+        self.get_calc("freq")
+        evict_scratch()
+        self.assertTrue(os.path.isdir(self.parent_dir))
+
+    def test_evict_scratch_expired(self):
+        self.finish_parent(2*SCRATCH_TTL)
+        self.get_calc("freq")
+        evict_scratch()
+        self.assertFalse(os.path.isdir(self.parent_dir))
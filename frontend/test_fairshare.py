@@ -0,0 +1,151 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import datetime
+from unittest import mock
+
+from .models import *
+from .cache import get_connection
+from . import fairshare
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+
+class FairShareTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        self.profiles = []
+        for name in ["PI", "Student", "Loner"]:
+            User.objects.create_user(username=name, password="test1234")
+            self.profiles.append(Profile.objects.get(user__username=name))
+
+        self.group = ResearchGroup.objects.create(name="Test group", PI=self.profiles[0])
+        self.profiles[1].member_of = self.group
+        self.profiles[1].save()
+
+        self.clear_keys()
+
+    def tearDown(self):
+        self.clear_keys()
+
+    def clear_keys(self):
+        connection = get_connection()
+        keys = list(connection.scan_iter("fairshare_*"))
+        if len(keys) > 0:
+            connection.delete(*keys)
+
+    def create_calcs(self, profile, num, **kwargs):
+        order = CalculationOrder.objects.create(author=profile)
+        return [Calculation.objects.create(order=order, local=True, **kwargs) for i in range(num)]
+
+    def test_groups(self):
+        groups = fairshare.profile_groups()
+        self.assertEqual(groups[self.profiles[0].id], groups[self.profiles[1].id])
+        self.assertNotEqual(groups[self.profiles[0].id], groups[self.profiles[2].id])
+
+    def test_usage(self):
+        now = timezone.now()
+        self.create_calcs(self.profiles[0], 1, nproc=2, date_started=now-datetime.timedelta(hours=1), date_finished=now)
+        self.create_calcs(self.profiles[2], 1, nproc=2, date_started=now-datetime.timedelta(days=2, hours=1), date_finished=now-datetime.timedelta(days=2))
+
+        usage = fairshare.compute_usage()
+        self.assertAlmostEqual(usage[self.profiles[0].id], 7200, delta=1)
+        self.assertAlmostEqual(usage[self.profiles[2].id], 3600, delta=1)
+
+    def test_next_profile_group(self):
+        groups = fairshare.profile_groups()
+        usage = {self.profiles[0].id: 100}
+
+        # The student shares the usage of their group
+        self.assertEqual(fairshare.next_profile([self.profiles[1].id, self.profiles[2].id], usage, groups), self.profiles[2].id)
+
+    def test_next_profile_member(self):
+        groups = fairshare.profile_groups()
+        usage = {self.profiles[0].id: 100}
+
+        self.assertEqual(fairshare.next_profile([self.profiles[0].id, self.profiles[1].id], usage, groups), self.profiles[1].id)
+
+    def test_interleave(self):
+        sweep = self.create_calcs(self.profiles[1], 6)
+        other = self.create_calcs(self.profiles[2], 2)
+
+        fairshare.submit(self.profiles[1].id, [c.id for c in sweep], 'comp')
+        fairshare.submit(self.profiles[2].id, [c.id for c in other], 'comp')
+
+        launched = []
+        with mock.patch('frontend.fairshare.capacity', return_value=4):
+            num = fairshare.feed(lambda batch: launched.extend(calc.id for calc, queue in batch))
+
+        self.assertEqual(num, 4)
+        self.assertEqual(sorted(launched), sorted([c.id for c in sweep[:2]] + [c.id for c in other]))
+
+    def test_skip_cancelled(self):
+        calcs = self.create_calcs(self.profiles[2], 2)
+        calcs[0].transition(3)
+
+        fairshare.submit(self.profiles[2].id, [c.id for c in calcs], 'comp')
+
+        launched = []
+        with mock.patch('frontend.fairshare.capacity', return_value=4):
+            fairshare.feed(lambda batch: launched.extend(calc.id for calc, queue in batch))
+
+        self.assertEqual(launched, [calcs[1].id])
+
+    def test_capacity(self):
+        calcs = self.create_calcs(self.profiles[2], 3)
+        fairshare.submit(self.profiles[2].id, [c.id for c in calcs], 'comp')
+
+        launched = []
+        with mock.patch('frontend.fairshare.capacity', return_value=2):
+            fairshare.feed(lambda batch: launched.extend(calc.id for calc, queue in batch))
+            self.assertEqual(len(launched), 2)
+
+            calcs[0].transition(2)
+            fairshare.feed(lambda batch: launched.extend(calc.id for calc, queue in batch))
+
+        self.assertEqual(launched, [c.id for c in calcs])
+
+    def test_launch_failed(self):
+        calcs = self.create_calcs(self.profiles[2], 3)
+        fairshare.submit(self.profiles[2].id, [c.id for c in calcs], 'comp')
+
+        def fail(batch):
+            raise ConnectionError("Broker unavailable")
+
+        with mock.patch('frontend.fairshare.capacity', return_value=2):
+            with self.assertRaises(ConnectionError):
+                fairshare.feed(fail)
+
+            launched = []
+            fairshare.feed(lambda batch: launched.extend(calc.id for calc, queue in batch))
+
+        # The calculations are put back in their original order
+        self.assertEqual(launched, [c.id for c in calcs[:2]])
+
+    def test_lost_calcs(self):
+        calcs = self.create_calcs(self.profiles[2], 3, date_submitted=timezone.now()-datetime.timedelta(hours=1))
+        # Just submitted, possibly not in its line yet
+        self.create_calcs(self.profiles[2], 1, date_submitted=timezone.now())
+        fairshare.submit(self.profiles[2].id, [calcs[0].id], 'comp')
+        calcs[1].transition(1)
+
+        self.assertEqual([c.id for c in fairshare.lost_calcs()], [calcs[2].id])
@@ -25,6 +25,9 @@ from django.core.management import call_command
 from django.test import TestCase, Client
 from .xtb_calculation import XtbCalculation
 from .gen_calc import gen_calc
+from . import tasks
+from ccinput.wrapper import generate_calculation
+from ccinput.exceptions import CCInputException
 
 TESTS_DIR = os.path.join('/'.join(__file__.split('/')[:-1]), "tests/")
 
@@ -601,3 +604,51 @@ class XtbTests(TestCase):
 
         self.assertTrue(self.is_equivalent(REF, xtb.command))
 
+
+class InputTemplateTests(TestCase):
+    def get_params(self, xyz, **kwargs):
+        params = {
+                "software": "ORCA",
+                "type": "Single-Point Energy",
+                "method": "HF",
+                "basis_set": "Def2-SVP",
+                "solvent": "vacuum",
+                "solvation_model": "",
+                "solvation_radii": "",
+                "specifications": "",
+                "density_fitting": "",
+                "custom_basis_sets": "",
+                "xyz": xyz,
+                "constraints": "",
+                "nproc": 1,
+                "mem": 1000,
+                "charge": 0,
+                "multiplicity": 1,
+                "aux_name": "struct2",
+                "name": "calc",
+            }
+        params.update(kwargs)
+        return params
+
+    def test_same_as_generated(self):
+        tasks.generate_input(self.get_params("H 0.0 0.0 0.0\nH 0.0 0.0 0.74\n"))
+
+        params = self.get_params("H 0.0 0.0 0.0\nH 0.0 0.0 0.81\n")
+        inp = tasks.generate_input(params)
+        ref = generate_calculation(**params)
+
+        self.assertEqual(inp.input_file, ref.input_file)
+        self.assertEqual(inp.confirmed_specifications, ref.confirmed_specifications)
+
+    def test_different_elements(self):
+        tasks.generate_input(self.get_params("H 0.0 0.0 0.0\nH 0.0 0.0 0.74\n"))
+
+        params = self.get_params("Li 0.0 0.0 0.0\nH 0.0 0.0 1.60\n")
+        inp = tasks.generate_input(params)
+        ref = generate_calculation(**params)
+
+        self.assertEqual(inp.input_file, ref.input_file)
+
+    def test_invalid_xyz(self):
+        inp = tasks.generate_input(self.get_params("H 0.0 0.0\n"))
+        self.assertIsInstance(inp, CCInputException)
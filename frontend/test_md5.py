@@ -20,6 +20,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 
+from unittest import mock
+
 from .models import *
 from .gen_calc import gen_param
 from django.core.management import call_command
@@ -110,3 +112,105 @@ class ParametersMd5Tests(TestCase):
         p2 = gen_param(params2)
         self.assertEqual(p1.md5, p2.md5)
 
+
+    def test_case_insensitive(self):
+        params1 = {
+                'software': 'Gaussian',
+                'theory_level': 'Semi-empirical',
+                'method': 'AM1',
+                'solvent': 'Vacuum',
+                }
+        params2 = {
+                'software': 'gaussian',
+                'theory_level': 'semi-empirical',
+                'method': 'am1',
+                'solvent': 'vacuum',
+                }
+
+        p1 = gen_param(params1)
+        p2 = gen_param(params2)
+        self.assertEqual(p1.md5, p2.md5)
+
+    def test_case_sensitive(self):
+        p1 = Parameters.objects.get_or_create_by_hash(software='ORCA', method='HF', basis_set='Def2-SVP', charge=0, multiplicity=1, custom_basis_sets='I=Def2-TZVP;')
+        p2 = Parameters.objects.get_or_create_by_hash(software='ORCA', method='HF', basis_set='Def2-SVP', charge=0, multiplicity=1, custom_basis_sets='i=def2-tzvp;')
+        p3 = p1.derive(specifications='opt(MaxStep=5)')
+        p4 = p1.derive(specifications='opt(maxstep=5)')
+
+        self.assertNotEqual(p1.id, p2.id)
+        self.assertNotEqual(p3.id, p4.id)
+        self.assertEqual(Parameters.objects.get(pk=p2.id).custom_basis_sets, 'i=def2-tzvp;')
+
+    def test_stored_hash_updated(self):
+        params1 = {
+                'software': 'Gaussian',
+                'theory_level': 'Semi-empirical',
+                'method': 'AM1',
+                }
+
+        p1 = gen_param(params1)
+        old_md5 = p1.md5
+
+        p1.method = 'PM3'
+        p1.save()
+        self.assertNotEqual(p1.md5, old_md5)
+        self.assertEqual(Parameters.objects.get(pk=p1.id).md5, p1.md5)
+
+    def test_get_or_create_by_hash(self):
+        p1 = Parameters.objects.get_or_create_by_hash(software='Gaussian', method='AM1', charge=-1, multiplicity=1)
+        p2 = Parameters.objects.get_or_create_by_hash(software='Gaussian', method='AM1', charge='-1', multiplicity=1)
+        p3 = Parameters.objects.get_or_create_by_hash(software='Gaussian', method='PM3', charge=-1, multiplicity=1)
+
+        self.assertEqual(p1.id, p2.id)
+        self.assertNotEqual(p1.id, p3.id)
+        self.assertEqual(Parameters.objects.filter(md5=p1.md5).count(), 1)
+
+    def test_get_or_create_by_hash_concurrent(self):
+        p1 = Parameters.objects.get_or_create_by_hash(software='Gaussian', method='AM1', charge=-1, multiplicity=1)
+
+        # Another request created the parameters between the lookup and the insertion
+        with mock.patch.object(Parameters.objects, 'filter', return_value=Parameters.objects.none()):
+            p2 = Parameters.objects.get_or_create_by_hash(software='Gaussian', method='AM1', charge=-1, multiplicity=1)
+
+        self.assertEqual(p1.id, p2.id)
+        self.assertEqual(Parameters.objects.count(), 1)
+
+    def test_derive(self):
+        p1 = Parameters.objects.get_or_create_by_hash(software='ORCA', method='HF', basis_set='Def2-SVP', charge=0, multiplicity=1)
+        p2 = p1.derive(specifications='tightscf')
+
+        self.assertNotEqual(p1.id, p2.id)
+        self.assertEqual(Parameters.objects.get(pk=p1.id).specifications, '')
+        self.assertEqual(p2.derive(specifications='').id, p1.id)
+
+    def test_merge_duplicates(self):
+        params1 = {
+                'software': 'Gaussian',
+                'theory_level': 'Semi-empirical',
+                'method': 'AM1',
+                }
+
+        p1 = gen_param(params1)
+        p2 = gen_param(dict(params1, method='PM3'))
+
+        # Duplicates left by older versions have a stale hash
+        Parameters.objects.filter(pk=p2.id).update(method='am1')
+
+        s = Structure.objects.create()
+        Property.objects.create(parent_structure=s, parameters=p1, energy=-1.0)
+        Property.objects.create(parent_structure=s, parameters=p2, freq=1)
+
+        workflow = Workflow.objects.create(name="Test workflow")
+        stage = WorkflowStage.objects.create(workflow=workflow, parameters=p2)
+
+        call_command('merge_duplicate_parameters')
+
+        self.assertEqual(Parameters.objects.filter(md5=p1.md5).count(), 1)
+        self.assertFalse(Parameters.objects.filter(pk=p2.id).exists())
+        self.assertEqual(WorkflowStage.objects.get(pk=stage.id).parameters_id, p1.id)
+        self.assertEqual(s.properties.count(), 1)
+
+        prop = s.properties.first()
+        self.assertEqual(prop.parameters.id, p1.id)
+        self.assertEqual(prop.energy, -1.0)
+        self.assertEqual(prop.freq, 1)
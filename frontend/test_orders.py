@@ -0,0 +1,333 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+from .models import *
+from django.core.management import call_command
+from django.test import TestCase
+
+
+class OrderCountersTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+        self.order = CalculationOrder.objects.create(author=self.profile)
+
+    def create_calcs(self, num):
+        return [Calculation.objects.create(order=self.order) for i in range(num)]
+
+    def test_bulk_add(self):
+        calcs = Calculation.bulk_add(self.order, [Calculation(order=self.order) for i in range(4)])
+        self.order.refresh_from_db()
+
+        self.assertEqual(len(calcs), 4)
+        self.assertEqual(self.order.get_all_calcs, [4, 0, 0, 0])
+
+        calcs[0].transition(1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.get_all_calcs, [3, 1, 0, 0])
+
+    def test_bulk_add_empty(self):
+        self.assertEqual(Calculation.bulk_add(self.order, []), [])
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [0, 0, 0, 0])
+
+    def test_counters_created(self):
+        self.create_calcs(3)
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [3, 0, 0, 0])
+        self.assertEqual(self.order.status, 0)
+
+    def test_counters_running(self):
+        calcs = self.create_calcs(3)
+        calcs[0].transition(1)
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [2, 1, 0, 0])
+        self.assertEqual(self.order.status, 1)
+
+    def test_counters_done(self):
+        calcs = self.create_calcs(2)
+        calcs[0].transition(2)
+        calcs[1].transition(3)
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [0, 0, 1, 1])
+        self.assertEqual(self.order.status, 2)
+
+    def test_counters_error(self):
+        calcs = self.create_calcs(2)
+        for c in calcs:
+            c.transition(3, error_message="Failed")
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.status, 3)
+
+    def test_counters_not_overwritten(self):
+        calcs = self.create_calcs(2)
+        order = CalculationOrder.objects.get(pk=self.order.pk)
+
+        calcs[0].transition(2)
+
+        order.hidden = True
+        order.save()
+        order.refresh_from_db()
+
+        self.assertEqual(order.get_all_calcs, [1, 0, 1, 0])
+        self.assertTrue(order.hidden)
+
+    def test_counters_delete(self):
+        calcs = self.create_calcs(2)
+        calcs[0].delete()
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [1, 0, 0, 0])
+
+    def test_refresh_counters(self):
+        calcs = self.create_calcs(2)
+        Calculation.objects.filter(pk=calcs[0].pk).update(status=2)
+
+        call_command('refresh_cached_info')
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [1, 0, 1, 0])
+        self.assertEqual(self.order.status, 0)
+
+    def test_transition_fields(self):
+        calc = self.create_calcs(1)[0]
+
+        calc.transition(1)
+        calc.refresh_from_db()
+        self.assertEqual(calc.status, 1)
+        self.assertIsNotNone(calc.date_started)
+
+        calc.transition(3, error_message="Job cancelled")
+        calc.refresh_from_db()
+        self.assertEqual(calc.status, 3)
+        self.assertEqual(calc.error_message, "Job cancelled")
+        self.assertIsNotNone(calc.date_finished)
+
+    def test_transition_relaunch(self):
+        calc = self.create_calcs(1)[0]
+        calc.transition(3)
+        calc.transition(0)
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [1, 0, 0, 0])
+        self.assertIsNone(calc.date_finished)
+
+    def test_plain_save_keeps_status(self):
+        calc = self.create_calcs(1)[0]
+        stale = Calculation.objects.get(pk=calc.pk)
+
+        calc.transition(3, error_message="Job cancelled")
+
+        stale.remote_id = 5
+        stale.save()
+        stale.refresh_from_db()
+
+        self.assertEqual(stale.status, 3)
+        self.assertEqual(stale.remote_id, 5)
+
+    def test_save_with_status(self):
+        calc = self.create_calcs(1)[0]
+        calc.status = 2
+        calc.save()
+        self.order.refresh_from_db()
+
+        self.assertEqual(self.order.get_all_calcs, [0, 0, 1, 0])
+        self.assertEqual(self.order.status, 2)
+
+    def test_save_with_status_dates(self):
+        calc = self.create_calcs(1)[0]
+        calc.status = 1
+        calc.save()
+        calc.refresh_from_db()
+
+        self.assertIsNotNone(calc.date_started)
+        self.assertIsNone(calc.date_finished)
+
+
+class UnseenCalculationsTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+
+    def unseen(self):
+        self.profile.refresh_from_db()
+        return self.profile.unseen_calculations
+
+    def test_unseen_done(self):
+        order = CalculationOrder.objects.create(author=self.profile)
+        calc = Calculation.objects.create(order=order)
+        self.assertEqual(self.unseen(), 0)
+
+        calc.transition(1)
+        self.assertEqual(self.unseen(), 1)
+
+        calc.transition(2)
+        self.assertEqual(self.unseen(), 1)
+
+    def test_see(self):
+        order = CalculationOrder.objects.create(author=self.profile)
+        calc = Calculation.objects.create(order=order)
+        calc.transition(2)
+
+        order.see()
+        self.assertEqual(self.unseen(), 0)
+
+        # Seeing twice does not decrement the counter again
+        CalculationOrder.objects.get(pk=order.pk).see()
+        self.assertEqual(self.unseen(), 0)
+
+    def test_counter_never_negative(self):
+        self.profile.add_unseen(-1)
+        self.assertEqual(self.unseen(), 0)
+
+    def test_delete_unseen(self):
+        order = CalculationOrder.objects.create(author=self.profile)
+        calc = Calculation.objects.create(order=order)
+        calc.transition(2)
+        self.assertEqual(self.unseen(), 1)
+
+        order.delete()
+        self.assertEqual(self.unseen(), 0)
+
+    def test_reconcile(self):
+        order = CalculationOrder.objects.create(author=self.profile)
+        calc = Calculation.objects.create(order=order)
+        calc.transition(2)
+
+        Profile.objects.filter(pk=self.profile.pk).update(unseen_calculations=5)
+        self.assertEqual(Profile.reconcile_unseen(), 1)
+        self.assertEqual(self.unseen(), 1)
+        self.assertEqual(Profile.reconcile_unseen(), 0)
+
+
+class ProjectCountersTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+
+        self.proj = Project.objects.create(name="Test project", author=self.profile)
+        self.mol = Molecule.objects.create(name="Test molecule", project=self.proj)
+        self.ensemble = Ensemble.objects.create(parent_molecule=self.mol)
+        self.order = CalculationOrder.objects.create(author=self.profile, project=self.proj, ensemble=self.ensemble)
+
+    def test_bulk_add(self):
+        Calculation.bulk_add(self.order, [Calculation(order=self.order) for i in range(3)])
+
+        self.assertEqual(self.counters(self.proj), [3, 3, 0, 0])
+        self.assertEqual(self.counters(self.mol), [3, 3, 0, 0])
+
+    def counters(self, obj):
+        obj.refresh_from_db()
+        return [obj.num_calc, obj.num_calc_queued, obj.num_calc_running, obj.num_calc_completed]
+
+    def test_incremental(self):
+        calcs = [Calculation.objects.create(order=self.order) for i in range(3)]
+        self.assertEqual(self.counters(self.proj), [3, 3, 0, 0])
+        self.assertEqual(self.counters(self.mol), [3, 3, 0, 0])
+
+        calcs[0].transition(1)
+        calcs[1].transition(2)
+        calcs[2].transition(3)
+        self.assertEqual(self.counters(self.proj), [3, 0, 1, 2])
+        self.assertEqual(self.counters(self.mol), [3, 0, 1, 2])
+
+        calcs[2].delete()
+        self.assertEqual(self.counters(self.proj), [2, 0, 1, 1])
+
+    def test_structure_order(self):
+        s = Structure.objects.create(parent_ensemble=self.ensemble)
+        order = CalculationOrder.objects.create(author=self.profile, project=self.proj, structure=s)
+        Calculation.objects.create(order=order)
+
+        self.assertEqual(self.counters(self.mol), [1, 1, 0, 0])
+
+    def test_save_keeps_counters(self):
+        proj = Project.objects.get(pk=self.proj.pk)
+        Calculation.objects.create(order=self.order)
+
+        proj.name = "Renamed"
+        proj.save()
+        self.assertEqual(self.counters(proj), [1, 1, 0, 0])
+
+    def test_refresh(self):
+        calcs = [Calculation.objects.create(order=self.order) for i in range(2)]
+        Calculation.objects.filter(pk=calcs[0].pk).update(status=2)
+        Project.objects.filter(pk=self.proj.pk).update(num_calc=10)
+
+        call_command('refresh_cached_info')
+        self.assertEqual(self.counters(self.proj), [2, 1, 0, 1])
+        self.assertEqual(self.counters(self.mol), [2, 1, 0, 1])
+
+class EnsembleMapTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+
+        self.proj = Project.objects.create(name="Test project", author=self.profile)
+        self.mol = Molecule.objects.create(name="Test molecule", project=self.proj)
+        self.ensemble = Ensemble.objects.create(parent_molecule=self.mol)
+        self.opt = BasicStep.objects.get(name="Geometrical Optimisation")
+        self.sp = BasicStep.objects.get(name="Single-Point Energy")
+
+    def annotated_color(self, e):
+        return Ensemble.annotated_node_color(Ensemble.with_node_statuses(Ensemble.objects.filter(pk=e.pk)).get())
+
+    def assertSameColor(self, e, color):
+        self.assertEqual(e.get_node_color, color)
+        self.assertEqual(self.annotated_color(e), color)
+
+    def test_uploaded_ensemble(self):
+        self.assertSameColor(self.ensemble, STATUS_COLORS[2])
+
+    def test_result_ensemble_running(self):
+        e = Ensemble.objects.create(parent_molecule=self.mol, origin=self.ensemble)
+        order = CalculationOrder.objects.create(author=self.profile, project=self.proj, ensemble=self.ensemble, result_ensemble=e, step=self.opt)
+        calc = Calculation.objects.create(order=order)
+        calc.transition(1)
+
+        self.assertSameColor(e, STATUS_COLORS[1])
+
+    def test_result_ensemble_failed(self):
+        e = Ensemble.objects.create(parent_molecule=self.mol, origin=self.ensemble)
+        order = CalculationOrder.objects.create(author=self.profile, project=self.proj, ensemble=self.ensemble, result_ensemble=e, step=self.opt)
+        calc = Calculation.objects.create(order=order)
+        calc.transition(3)
+
+        self.assertSameColor(e, STATUS_COLORS[3])
+
+    def test_pending_step_on_ensemble(self):
+        e = Ensemble.objects.create(parent_molecule=self.mol, origin=self.ensemble)
+        order = CalculationOrder.objects.create(author=self.profile, project=self.proj, ensemble=self.ensemble, result_ensemble=e, step=self.opt)
+        Calculation.objects.create(order=order).transition(2)
+
+        order2 = CalculationOrder.objects.create(author=self.profile, project=self.proj, ensemble=e, step=self.sp)
+        Calculation.objects.create(order=order2)
+
+        self.assertSameColor(e, STATUS_COLORS[0])
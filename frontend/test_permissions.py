@@ -0,0 +1,92 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+
+from .models import *
+from .permissions import compute_related_profiles, PermissionResolver
+from django.core.management import call_command
+from django.test import TestCase
+
+
+class PermissionTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+
+        self.pi = self.create_profile("PI")
+        self.pi.is_PI = True
+        self.pi.save()
+        self.group = ResearchGroup.objects.create(name="Test group", PI=self.pi)
+
+        self.student = self.create_profile("Student")
+        self.student.member_of = self.group
+        self.student.save()
+
+        self.outsider = self.create_profile("Outsider")
+
+    def create_profile(self, username):
+        User.objects.create_user(username=username, password="test1234")
+        return Profile.objects.get(user__username=username)
+
+    def test_related_profiles_student(self):
+        self.assertEqual(compute_related_profiles(self.student.id), {self.student.id, self.pi.id})
+
+    def test_related_profiles_PI(self):
+        self.assertEqual(compute_related_profiles(self.pi.id), {self.student.id, self.pi.id})
+
+    def test_related_profiles_outsider(self):
+        self.assertEqual(compute_related_profiles(self.outsider.id), {self.outsider.id})
+
+    def test_related_profiles_PI_without_group(self):
+        self.outsider.is_PI = True
+        self.outsider.save()
+        self.assertEqual(compute_related_profiles(self.outsider.id), {self.outsider.id})
+
+    def test_view_project(self):
+        proj = Project.objects.create(author=self.student, name="Test")
+
+        self.assertTrue(PermissionResolver(self.student).can_view_project(proj))
+        self.assertTrue(PermissionResolver(self.pi).can_view_project(proj))
+        self.assertFalse(PermissionResolver(self.outsider).can_view_project(proj))
+
+    def test_view_private_project(self):
+        proj = Project.objects.create(author=self.pi, name="Test", private=True)
+        student = self.create_profile("Student 2")
+        student.member_of = self.group
+        student.save()
+
+        self.assertTrue(PermissionResolver(self.pi).can_view_project(proj))
+        self.assertFalse(PermissionResolver(student).can_view_project(proj))
+
+    def test_view_molecule(self):
+        proj = Project.objects.create(author=self.student, name="Test")
+        mol = Molecule.objects.create(name="Mol", project=proj)
+
+        self.assertTrue(PermissionResolver(self.pi).can_view_in_project(Molecule, mol))
+        self.assertFalse(PermissionResolver(self.outsider).can_view_in_project(Molecule, mol))
+
+    def test_group_change(self):
+        proj = Project.objects.create(author=self.student, name="Test")
+        self.assertFalse(PermissionResolver(self.outsider).can_view_project(proj))
+
+        self.outsider.member_of = self.group
+        self.outsider.save()
+
+        self.assertTrue(PermissionResolver(self.outsider).can_view_project(proj))
@@ -0,0 +1,151 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import math
+import datetime
+from unittest import mock
+
+from .models import *
+from .prediction import RuntimePredictor, basis_zeta, calc_features, fit
+from .cache import get_connection
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+
+class RuntimePredictionTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+        self.order = CalculationOrder.objects.create(author=self.profile)
+        self.params = Parameters.objects.create(charge=0, multiplicity=1, software="ORCA", theory_level="DFT", method="B3LYP", basis_set="Def2-SVP")
+        self.step = BasicStep.objects.get(name="Single-Point Energy")
+
+    def clear_keys(self):
+        connection = get_connection()
+        keys = list(connection.scan_iter("order_estimate_*"))
+        if len(keys) > 0:
+            connection.delete(*keys)
+
+    def get_calc(self, natoms, **kwargs):
+        xyz = "".join(["C 0.0 0.0 {:.1f}\n".format(i) for i in range(natoms)])
+        structure = Structure.objects.create(xyz_structure=xyz)
+        return Calculation.objects.create(order=self.order, parameters=self.params, step=self.step, structure=structure, **kwargs)
+
+    def get_model(self):
+        sizes = range(2, 12)
+        X = [calc_features(self.get_calc(n)) for n in sizes]
+        y = [math.log(3*n**3) for n in sizes]
+        return {'orca/sp/dft': fit(X, y)}
+
+    def test_basis_zeta(self):
+        self.assertEqual(basis_zeta(Parameters(software="ORCA", basis_set="Def2-SVP")), 2)
+        self.assertEqual(basis_zeta(Parameters(software="ORCA", basis_set="Def2-TZVP")), 3)
+        self.assertEqual(basis_zeta(Parameters(software="Gaussian", basis_set="6-311+G(d,p)")), 3)
+        self.assertEqual(basis_zeta(Parameters(software="xtb", basis_set="")), 1)
+
+    def test_features(self):
+        features = calc_features(self.get_calc(3))
+        self.assertAlmostEqual(features[1], math.log(3))
+        self.assertAlmostEqual(features[2], math.log(18))
+
+    def test_core_seconds(self):
+        predictor = RuntimePredictor(self.get_model())
+        self.assertAlmostEqual(predictor.core_seconds(self.get_calc(20))/(3*20**3), 1, places=2)
+
+    def test_runtime(self):
+        predictor = RuntimePredictor(self.get_model())
+        calc = self.get_calc(20, nproc=4)
+        self.assertAlmostEqual(predictor.runtime(calc)/(3*20**3/4), 1, places=2)
+
+    def test_unknown(self):
+        predictor = RuntimePredictor({})
+        self.assertIsNone(predictor.runtime(self.get_calc(20)))
+
+    def test_remaining(self):
+        predictor = RuntimePredictor(self.get_model())
+        calc = self.get_calc(20, nproc=4, status=1, date_started=timezone.now()-datetime.timedelta(seconds=3000))
+        self.assertAlmostEqual(predictor.remaining(calc), 3*20**3/4-3000, delta=10)
+
+    def test_fit_scaling(self):
+        sizes = range(2, 12)
+        cores = [1, 2, 4, 8]*3
+        X = [calc_features(self.get_calc(n)) for n in sizes]
+
+        # The cost doubles with 4 times more cores
+        y = [math.log(3*n**3*c**0.5) for n, c in zip(sizes, cores)]
+        self.assertAlmostEqual(fit(X, y, cores[:len(y)])['scaling'], 0.5, delta=0.05)
+
+    def test_fit_no_scaling(self):
+        sizes = range(2, 12)
+        X = [calc_features(self.get_calc(n)) for n in sizes]
+        y = [math.log(3*n**3) for n in sizes]
+        self.assertNotIn('scaling', fit(X, y, [4]*len(y)))
+
+    def test_remaining_done(self):
+        predictor = RuntimePredictor(self.get_model())
+        self.assertIsNone(predictor.remaining(self.get_calc(20, nproc=4, status=2)))
+
+    def test_order_estimate(self):
+        model = self.get_model()
+        order = CalculationOrder.objects.create(author=self.profile)
+        structure = Structure.objects.create(xyz_structure="".join(["C 0.0 0.0 {:.1f}\n".format(i) for i in range(20)]))
+        calc = Calculation.objects.create(order=order, parameters=self.params, step=self.step, structure=structure, nproc=4)
+
+        self.clear_keys()
+
+        with mock.patch('frontend.prediction.get_runtime_model', return_value=model):
+            with self.captureOnCommitCallbacks(execute=True):
+                calc.transition(1)
+
+        order.refresh_from_db()
+        self.assertAlmostEqual(order.eta, 3*20**3/4, delta=10)
+
+        with mock.patch('frontend.prediction.get_runtime_model', return_value=model):
+            with self.captureOnCommitCallbacks(execute=True):
+                calc.transition(2)
+
+        order.refresh_from_db()
+        self.assertIsNone(order.eta)
+
+    def test_order_estimate_throttled(self):
+        model = self.get_model()
+        order = CalculationOrder.objects.create(author=self.profile)
+        structure = Structure.objects.create(xyz_structure="".join(["C 0.0 0.0 {:.1f}\n".format(i) for i in range(20)]))
+        calcs = [Calculation.objects.create(order=order, parameters=self.params, step=self.step, structure=structure, nproc=4) for i in range(2)]
+
+        self.clear_keys()
+
+        with mock.patch('frontend.prediction.get_runtime_model', return_value=model):
+            with self.captureOnCommitCallbacks(execute=True):
+                calcs[0].transition(1)
+
+        order.refresh_from_db()
+        estimated_end = order.estimated_end
+        self.assertIsNotNone(estimated_end)
+
+        with mock.patch('frontend.prediction.get_runtime_model', return_value=model):
+            with self.captureOnCommitCallbacks(execute=True):
+                calcs[1].transition(1)
+
+        order.refresh_from_db()
+        self.assertEqual(order.estimated_end, estimated_end)
@@ -0,0 +1,120 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+
+import datetime
+
+from .models import *
+from .scheduler import estimate_resources, num_atoms, num_basis_functions
+from .routing import route_calculations, tier_of, INTERACTIVE, BATCH, HEAVY, QUEUES
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+
+class EstimateResourcesTests(TestCase):
+    def get_calc(self, software, theory_level, step, natoms, order=None, **kwargs):
+        xyz = "{}\n\n".format(natoms) + "".join(["C 0.0 0.0 {:.1f}\n".format(i) for i in range(natoms)])
+
+        params = Parameters(charge=0, multiplicity=1, software=software, theory_level=theory_level, **kwargs)
+        return Calculation(parameters=params, step=BasicStep(short_name=step), structure=Structure(xyz_structure=xyz), order=order)
+
+    def test_num_atoms(self):
+        self.assertEqual(num_atoms("2\n\nH 0 0 0\nH 0 0 1\n"), 2)
+        self.assertEqual(num_atoms("H 0 0 0\nH 0 0 1\n"), 2)
+
+    def test_small_xtb(self):
+        self.assertEqual(estimate_resources(self.get_calc("xtb", "", "sp", 10), 64, 1000), (1, 1000))
+
+    def test_large_dft(self):
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "DFT", "sp", 60), 64, 1000), (10, 10000))
+
+    def test_step_factor(self):
+        # Frequency calculations also need more memory
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "DFT", "freq", 60), 64, 1000), (20, 28000))
+
+    def test_basis_functions(self):
+        self.assertEqual(num_basis_functions(self.get_calc("ORCA", "DFT", "sp", 10, basis_set="Def2-SVP")), 150)
+        self.assertEqual(num_basis_functions(self.get_calc("ORCA", "DFT", "sp", 10, basis_set="Def2-TZVP")), 310)
+
+    def test_memory_basis_set(self):
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "DFT", "sp", 60, basis_set="Def2-TZVP"), 64, 1000), (10, 23000))
+
+    def test_efficiency_limit(self):
+        model = {'orca/sp/dft': {'scaling': 0.5}}
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "DFT", "sp", 60), 64, 1000, model), (4, 4000))
+
+    def test_perfect_scaling(self):
+        model = {'orca/sp/dft': {'scaling': 0}}
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "DFT", "sp", 60), 64, 1000, model), (10, 10000))
+
+    def test_user_override(self):
+        order = CalculationOrder.objects.create(nproc=2, mem=3000)
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "DFT", "sp", 60, order=order), 64, 1000), (2, 3000))
+
+    def test_user_override_limit(self):
+        order = CalculationOrder.objects.create(nproc=16, mem=50000)
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "DFT", "sp", 60, order=order), 8, 1000), (8, 8000))
+
+    def test_whole_node(self):
+        self.assertEqual(estimate_resources(self.get_calc("ORCA", "RI-MP2", "sp", 200), 8, 1000), (8, 8000))
+
+
+class RoutingTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+        self.order = CalculationOrder.objects.create(author=self.profile)
+
+    def get_calc(self, software, theory_level, step, natoms, **kwargs):
+        xyz = "{}\n\n".format(natoms) + "".join(["C 0.0 0.0 {:.1f}\n".format(i) for i in range(natoms)])
+
+        params = Parameters.objects.get_or_create_by_hash(charge=0, multiplicity=1, software=software, theory_level=theory_level, method="B3LYP", basis_set="Def2-SVP")
+        structure = Structure.objects.create(xyz_structure=xyz)
+        return Calculation.objects.create(order=self.order, parameters=params, step=BasicStep.objects.get(name=step), structure=structure, **kwargs)
+
+    def test_tiers(self):
+        self.assertEqual(tier_of(10), INTERACTIVE)
+        self.assertEqual(tier_of(1800), BATCH)
+        self.assertEqual(tier_of(24*3600), HEAVY)
+
+    def test_small_interactive(self):
+        calc = self.get_calc("xtb", "", "Geometrical Optimisation", 10)
+        self.assertEqual(route_calculations([calc]), QUEUES[INTERACTIVE])
+
+    def test_large_heavy(self):
+        calc = self.get_calc("ORCA", "DFT", "Frequency Calculation", 200)
+        self.assertEqual(route_calculations([calc]), QUEUES[HEAVY])
+
+    def test_large_order_batch(self):
+        calc = self.get_calc("xtb", "", "Geometrical Optimisation", 10)
+        self.assertEqual(route_calculations([calc]*10000), QUEUES[BATCH])
+
+    def test_historical_runtime(self):
+        now = timezone.now()
+        self.get_calc("ORCA", "DFT", "Single-Point Energy", 5, status=2, date_started=now-datetime.timedelta(hours=10), date_finished=now)
+
+        calc = self.get_calc("ORCA", "DFT", "Single-Point Energy", 5)
+        self.assertEqual(route_calculations([calc]), QUEUES[HEAVY])
+
+    def test_no_calculations(self):
+        self.assertEqual(route_calculations([]), QUEUES[INTERACTIVE])
@@ -0,0 +1,189 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+import io
+import os
+import zipfile
+import tempfile
+import time
+
+from unittest import mock
+
+from .storage import publish, promote, promote_logs, open_result, result_files, compress_directory, zip_result, SeekableWriter, SeekableReader
+from django.test import TestCase
+
+class StorageTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.workdir = os.path.join(self.tmpdir.name, "scr")
+        self.res_dir = os.path.join(self.tmpdir.name, "results")
+        os.mkdir(self.workdir)
+        os.mkdir(self.res_dir)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def touch(self, name, content="log"):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'w') as out:
+            out.write(content)
+        return path
+
+    def read(self, name):
+        with open_result(os.path.join(self.res_dir, name)) as f:
+            return f.read()
+
+    def test_publish(self):
+        content = "cube\n"*1000
+        src = self.touch("in-HOMO.cube", content)
+        publish(src, os.path.join(self.res_dir, "in-HOMO.cube"))
+
+        self.assertTrue(os.path.isfile(src))
+        self.assertEqual(self.read("in-HOMO.cube"), content)
+        self.assertEqual(os.listdir(self.res_dir), ["in-HOMO.cube.zst"])
+
+    def test_publish_small(self):
+        src = self.touch("IR.csv", "spectrum")
+        publish(src, os.path.join(self.res_dir, "IR.csv"))
+
+        self.assertEqual(self.read("IR.csv"), "spectrum")
+        self.assertEqual(os.listdir(self.res_dir), ["IR.csv"])
+
+    def test_promote_rename(self):
+        src = self.touch("calc.out")
+        inode = os.stat(src).st_ino
+
+        self.assertTrue(promote(src, os.path.join(self.res_dir, "calc.out")))
+        self.assertFalse(os.path.isfile(src))
+        self.assertEqual(os.stat(os.path.join(self.res_dir, "calc.out")).st_ino, inode)
+
+    def test_promote_copy(self):
+        content = "SCF ITERATION\n"*1000
+        src = self.touch("calc.out", content)
+
+        with mock.patch('frontend.storage.same_filesystem', return_value=False):
+            self.assertFalse(promote(src, os.path.join(self.res_dir, "calc.out")))
+
+        self.assertFalse(os.path.isfile(src))
+        self.assertEqual(self.read("calc.out"), content)
+        self.assertEqual(os.listdir(self.res_dir), ["calc.out.zst"])
+
+    def test_promote_logs(self):
+        self.touch("calc.out", "out")
+        self.touch("xtbopt.log", "trajectory")
+        self.touch("calc.gbw")
+
+        num_files, size, renamed, duration = promote_logs(self.workdir, self.res_dir)
+
+        self.assertEqual((num_files, size, renamed), (2, 13, 2))
+        self.assertEqual(self.read("xtbopt.out"), "trajectory")
+        self.assertEqual(os.listdir(self.workdir), ["calc.gbw"])
+
+    def test_promote_logs_keep(self):
+        self.touch("calc.out", "out")
+        self.touch("xtbopt.log", "trajectory")
+
+        num_files, size, renamed, duration = promote_logs(self.workdir, self.res_dir, ['xtbopt.log'])
+
+        self.assertEqual((num_files, size, renamed), (2, 13, 1))
+        self.assertEqual(self.read("xtbopt.out"), "trajectory")
+        self.assertEqual(os.listdir(self.workdir), ["xtbopt.log"])
+
+    def test_promote_logs_linked(self):
+        self.touch("calc.out")
+        link = os.path.join(self.tmpdir.name, "link")
+        os.symlink(self.workdir, link)
+
+        num_files, size, renamed, duration = promote_logs(link, self.res_dir)
+
+        self.assertEqual(renamed, 0)
+        self.assertEqual(self.read("calc.out"), "log")
+        self.assertTrue(os.path.isfile(os.path.join(self.workdir, "calc.out")))
+
+    def test_seekable(self):
+        data = b''.join(b"line %d\n" % i for i in range(1000))
+        buf = io.BytesIO()
+        writer = SeekableWriter(buf, frame_size=100)
+        writer.write(data)
+        writer.close()
+
+        path = os.path.join(self.res_dir, "calc.out.zst")
+        with open(path, 'wb') as out:
+            out.write(buf.getvalue())
+
+        with SeekableReader(path) as f:
+            self.assertGreater(len(f.frames), 1)
+
+        with open_result(os.path.join(self.res_dir, "calc.out"), 'rb') as f:
+            self.assertEqual(f.read(), data)
+            f.seek(1234)
+            self.assertEqual(f.read(500), data[1234:1734])
+            f.seek(-10, io.SEEK_END)
+            self.assertEqual(f.read(), data[-10:])
+
+    def test_open_result_plain(self):
+        with open(os.path.join(self.res_dir, "IR.csv"), 'w') as out:
+            out.write("spectrum")
+
+        self.assertEqual(self.read("IR.csv"), "spectrum")
+
+    def test_compress_directory(self):
+        content = "SCF ITERATION\n"*1000
+        with open(os.path.join(self.res_dir, "calc.out"), 'w') as out:
+            out.write(content)
+        with open(os.path.join(self.res_dir, "freq_0.xyz"), 'w') as out:
+            out.write("small")
+
+        num_files, size, compressed_size = compress_directory(self.res_dir)
+
+        self.assertEqual((num_files, size), (1, len(content)))
+        self.assertLess(compressed_size, size)
+        self.assertEqual(sorted(os.listdir(self.res_dir)), ["calc.out.zst", "freq_0.xyz"])
+        self.assertEqual(self.read("calc.out"), content)
+        self.assertEqual(compress_directory(self.res_dir)[0], 0)
+
+    def test_compress_directory_recent(self):
+        path = os.path.join(self.res_dir, "calc.out")
+        with open(path, 'w') as out:
+            out.write("SCF ITERATION\n"*1000)
+
+        self.assertEqual(compress_directory(self.res_dir, 3600)[0], 0)
+
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+        self.assertEqual(compress_directory(self.res_dir, 3600)[0], 1)
+
+    def test_result_files(self):
+        publish(self.touch("calc.out"), os.path.join(self.res_dir, "calc.out"))
+        with open(os.path.join(self.res_dir, "calc2.out"), 'w') as out:
+            out.write("log")
+
+        self.assertEqual(sorted(result_files(self.res_dir, "*.out")), [os.path.join(self.res_dir, "calc.out"), os.path.join(self.res_dir, "calc2.out")])
+
+    def test_zip_result(self):
+        path = os.path.join(self.res_dir, "calc.out")
+        publish(self.touch("calc.out"), path)
+
+        mem = io.BytesIO()
+        with zipfile.ZipFile(mem, 'w', zipfile.ZIP_DEFLATED) as zip:
+            zip_result(zip, path, "1_calc.out")
+
+        with zipfile.ZipFile(mem) as zip:
+            self.assertEqual(zip.read("1_calc.out"), b"log")
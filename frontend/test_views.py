@@ -20,6 +20,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import time
 import os
+import json
+import numpy as np
 from shutil import copyfile, rmtree
 
 from .models import *
@@ -138,6 +140,21 @@ class LaunchTests(TestCase):
         response = self.client.post("/submit_calculation/", data=params, follow=True)
         self.assertContains(response, "Error while submitting your calculation")
 
+    def test_submit_workflow_invalid_stage(self):
+        params = basic_params.copy()
+        params['workflow'] = json.dumps([
+                {'calc_type': 'Single-Point Energy', 'calc_software': 'xtb', 'calc_theory_level': '', 'calc_solvent': 'Vacuum'},
+                {'calc_type': 'No such step', 'calc_software': 'xtb', 'calc_theory_level': '', 'calc_solvent': 'Vacuum'},
+            ])
+        num_params = Parameters.objects.count()
+
+        response = self.client.post("/submit_calculation/", data=params, follow=True)
+        self.assertContains(response, "Error while submitting your calculation")
+
+        # Nothing is left behind by the stages which were valid
+        self.assertEqual(Parameters.objects.count(), num_params)
+        self.assertFalse(Project.objects.filter(name="Test").exists())
+
     def test_submit_empty_resource(self):
         params = basic_params.copy()
         params['calc_resource'] = ''
@@ -1012,3 +1029,164 @@ class MiscTests(TestCase):
         related = self.client.get("/get_related_calculations/{}".format(e2.pk))
         print(related.content)
 '''
+
+class ListJsonTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        self.username = "Tester"
+        self.password = "test1234"
+
+        u = User.objects.create_user(username=self.username, password=self.password)
+        self.profile = Profile.objects.get(user__username=self.username)
+        self.client = Client()
+        self.client.force_login(u)
+
+        self.proj = Project.objects.create(name="Test project", author=self.profile)
+        self.orders = []
+        for i in range(5):
+            o = CalculationOrder.objects.create(author=self.profile, project=self.proj, date=timezone.now())
+            Calculation.objects.create(order=o)
+            self.orders.append(o)
+
+    def get_list(self, **kwargs):
+        params = {
+                'user': self.username,
+                'project': 'All projects',
+                'type': 'All steps',
+                'status': 'All statuses',
+                'mode': 'All orders',
+                }
+        params.update(kwargs)
+        response = self.client.get("/list_json/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_keyset_pages(self):
+        data = self.get_list(limit=3)
+        self.assertEqual([o['id'] for o in data['orders']], [o.id for o in self.orders[::-1][:3]])
+        self.assertEqual(data['next'], {'before': self.orders[2].id})
+
+        data = self.get_list(limit=3, before=data['next']['before'])
+        self.assertEqual([o['id'] for o in data['orders']], [self.orders[1].id, self.orders[0].id])
+        self.assertIsNone(data['next'])
+
+    def test_counters(self):
+        self.orders[0].calculation_set.first().transition(2)
+        data = self.get_list(status='Done')
+
+        self.assertEqual(len(data['orders']), 1)
+        self.assertEqual(data['orders'][0]['done'], 1)
+        self.assertEqual(data['orders'][0]['queued'], 0)
+        self.assertTrue(data['orders'][0]['new_status'])
+
+    def test_updated_since(self):
+        since = timezone.now()
+        self.orders[3].calculation_set.first().transition(1)
+
+        data = self.get_list(updated_since=since.isoformat())
+        self.assertEqual([o['id'] for o in data['orders']], [self.orders[3].id])
+        self.assertEqual(data['orders'][0]['status'], 1)
+
+    def test_updated_since_naive(self):
+        since = timezone.localtime(timezone.now())
+        self.orders[3].calculation_set.first().transition(1)
+
+        data = self.get_list(updated_since=timezone.make_naive(since).isoformat())
+        self.assertEqual([o['id'] for o in data['orders']], [self.orders[3].id])
+
+    def test_updated_since_filtered_out(self):
+        since = timezone.now()
+        CalculationOrder.objects.filter(pk=self.orders[1].id).update(hidden=True, last_update=timezone.now())
+        self.orders[2].calculation_set.first().transition(1)
+
+        data = self.get_list(updated_since=since.isoformat(), mode='Workspace', status='Queued')
+        self.assertEqual(data['orders'], [])
+        self.assertEqual(sorted(data['removed']), [self.orders[1].id, self.orders[2].id])
+
+    def test_updated_since_deleted(self):
+        since = timezone.now()
+        order_id = self.orders[4].id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.orders[4].calculation_set.first().delete()
+
+        data = self.get_list(updated_since=since.isoformat())
+        self.assertIn(order_id, data['removed'])
+
+    def test_other_user(self):
+        User.objects.create_user(username="Other", password="test1234")
+        response = self.client.get("/list_json/", {
+                'user': 'Other',
+                'project': 'All projects',
+                'type': 'All steps',
+                'status': 'All statuses',
+                'mode': 'All orders',
+                })
+        self.assertEqual(response.status_code, 403)
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        u = User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+        self.client = Client()
+        self.client.force_login(u)
+
+        self.proj = Project.objects.create(name="Test project", author=self.profile)
+        self.mol = Molecule.objects.create(name="Test molecule", project=self.proj)
+        self.ensemble = Ensemble.objects.create(name="Test ensemble", parent_molecule=self.mol)
+        self.params = Parameters.objects.create(charge=0, multiplicity=1)
+        self.structures = []
+        for i in range(3):
+            s = Structure.objects.create(parent_ensemble=self.ensemble, number=i+1)
+            Property.objects.create(parent_structure=s, parameters=self.params, energy=-10.0-0.001*i)
+            self.structures.append(s)
+
+    def get_table(self):
+        response = self.client.post("/conformer_table/", data={'ensemble_id': self.ensemble.id, 'param_id': self.params.id})
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8')
+
+    def test_conformer_table(self):
+        table = self.get_table()
+        self.assertEqual(table.count("<tr"), 3)
+        self.assertEqual(self.get_table(), table)
+
+    def test_conformer_table_new_structure(self):
+        self.get_table()
+
+        s = Structure.objects.create(parent_ensemble=self.ensemble, number=4)
+        Property.objects.create(parent_structure=s, parameters=self.params, energy=-9.0)
+
+        self.assertEqual(self.get_table().count("<tr"), 4)
+
+    def test_conformer_table_units(self):
+        table = self.get_table()
+
+        self.profile.pref_units = 2
+        self.profile.save()
+
+        self.assertNotEqual(self.get_table(), table)
+
+    def test_ensemble_table_rename(self):
+        response = self.client.get("/ensemble_table_body/{}".format(self.mol.id))
+        self.assertIn("Test ensemble", response.content.decode('utf-8'))
+
+        self.ensemble.name = "Renamed ensemble"
+        self.ensemble.save()
+
+        response = self.client.get("/ensemble_table_body/{}".format(self.mol.id))
+        self.assertIn("Renamed ensemble", response.content.decode('utf-8'))
+
+class ExpSpectrumTests(TestCase):
+    def test_normalize(self):
+        self.assertEqual(list(views.normalize_spectrum(np.array([1.0, 4.0, 2.0]))), [0.25, 1.0, 0.5])
+
+    def test_normalize_flat(self):
+        self.assertEqual(list(views.normalize_spectrum(np.zeros(3))), [0.0, 0.0, 0.0])
+
+    def test_broadened_empty_window(self):
+        self.assertEqual(len(views.broadened_spectrum(np.array([]), [1.0])), 0)
+
+    def test_broadened_far_shifts(self):
+        pred = views.broadened_spectrum(np.linspace(0, 1, 5), [100.0])
+        self.assertFalse(np.isnan(pred).any())
@@ -0,0 +1,117 @@
+'''
+This file of part of CalcUS.
+
+Copyright (C) 2020-2022 Raphaël Robidas
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+
+
+
+from .models import *
+from .tasks import advance, calculation_outputs
+from django.core.management import call_command
+from django.test import TestCase
+
+
+class WorkflowTests(TestCase):
+    def setUp(self):
+        call_command('init_static_obj')
+        User.objects.create_user(username="Tester", password="test1234")
+        self.profile = Profile.objects.get(user__username="Tester")
+
+        self.proj = Project.objects.create(name="Test project", author=self.profile)
+        self.mol = Molecule.objects.create(name="Test molecule", project=self.proj)
+        self.ensemble = Ensemble.objects.create(name="Test ensemble", parent_molecule=self.mol)
+        self.result = Ensemble.objects.create(name="Result", parent_molecule=self.mol, origin=self.ensemble)
+
+        self.opt_params = Parameters.objects.create(charge=0, multiplicity=1, software="xtb")
+        self.sp_params = Parameters.objects.create(charge=0, multiplicity=1, software="ORCA", theory_level="DFT", method="B3LYP", basis_set="Def2-SVP")
+
+        opt = BasicStep.objects.get(short_name="opt")
+        self.order = CalculationOrder.objects.create(name="Opt", author=self.profile, project=self.proj, step=opt, parameters=self.opt_params, ensemble=self.ensemble, result_ensemble=self.result)
+
+        self.calcs = []
+        for i in range(3):
+            s = Structure.objects.create(parent_ensemble=self.ensemble, number=i+1)
+            self.calcs.append(Calculation.objects.create(order=self.order, structure=s, step=opt, parameters=self.opt_params, result_ensemble=self.result))
+
+        self.workflow = Workflow.objects.create(author=self.profile, project=self.proj)
+        self.root = WorkflowStage.objects.create(workflow=self.workflow, step=opt, parameters=self.opt_params, order=self.order)
+
+    def add_stage(self, filter=None):
+        return WorkflowStage.objects.create(workflow=self.workflow, parent=self.root, step=BasicStep.objects.get(short_name="sp"), parameters=self.sp_params, filter=filter)
+
+    def finish(self, ind, energy=-1.0):
+        calc = self.calcs[ind]
+        s = Structure.objects.create(parent_ensemble=self.result, number=calc.structure.number)
+        Property.objects.create(parent_structure=s, parameters=self.opt_params, energy=energy, geom=True)
+        calc.transition(2)
+        return s
+
+    def test_outputs(self):
+        s = self.finish(1)
+        self.finish(2)
+
+        self.assertEqual(calculation_outputs(self.calcs[1]), [s])
+        self.assertEqual(calculation_outputs(self.calcs[0]), [])
+
+    def test_streaming(self):
+        stage = self.add_stage()
+        s = self.finish(0)
+
+        new = advance(self.calcs[0])
+        self.assertEqual(len(new), 1)
+
+        order, calcs = new[0]
+        self.assertEqual(len(calcs), 1)
+        self.assertEqual(calcs[0].structure, s)
+        self.assertEqual(order.ensemble, self.result)
+
+        stage.refresh_from_db()
+        self.assertEqual(stage.order, order)
+
+    def test_streaming_no_duplicates(self):
+        self.add_stage()
+        self.finish(0)
+
+        advance(self.calcs[0])
+        order, calcs = advance(self.calcs[0])[0]
+
+        self.assertEqual(calcs, [])
+        self.assertEqual(order.calculation_set.count(), 1)
+
+    def test_error_not_streamed(self):
+        self.add_stage()
+        self.calcs[0].transition(3, error_message="Failed")
+
+        self.assertEqual(advance(self.calcs[0]), [])
+
+    def test_filter_waits_for_parent(self):
+        f = Filter.objects.create(type="By Relative Energy", parameters=self.opt_params, value="10")
+        self.add_stage(filter=f)
+
+        self.finish(0, energy=-1.0)
+        self.assertEqual(advance(self.calcs[0]), [])
+
+        self.finish(1, energy=-0.99)
+        self.assertEqual(advance(self.calcs[1]), [])
+
+        best = self.finish(2, energy=-1.001)
+        order, calcs = advance(self.calcs[2])[0]
+
+        # Within 10 kJ/mol of the lowest energy
+        self.assertEqual(sorted([c.structure.number for c in calcs]), [1, 3])
+        self.assertIn(best, [c.structure for c in calcs])
@@ -33,6 +33,8 @@ urlpatterns = [
     path('home/', views.home, name='home'),
 
     path('list/', views.IndexView.as_view(), name='list'),
+    path('list_json/', views.list_json, name='list_json'),
+    path('events/', views.events, name='events'),
     path('calculations/', views.calculations, name='calculations'),
 
     path('cancel_calc/', views.cancel_calc, name='cancel_calc'),
@@ -104,6 +106,7 @@ urlpatterns = [
 
     path('calculationorder/<int:pk>', views.calculationorder, name='calculationorder'),
     path('calculation/<int:pk>', views.calculation, name='calculation'),
+    path('calculation_eta/<int:pk>', views.calculation_eta, name='calculation_eta'),
     path('link_order/<int:pk>', views.link_order, name='link_order'),
 
     #Group management
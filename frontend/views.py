@@ -26,8 +26,13 @@ import bleach
 import math
 import time
 import zipfile
+import tempfile
+import hashlib
+import json
+import redis
+import threading
 from os.path import basename
-from io import BytesIO
+from io import BytesIO, StringIO
 import basis_set_exchange
 import numpy as np
 import ccinput
@@ -37,29 +42,42 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, HttpResponseRedirect
+from django.template.loader import render_to_string
+from django.middleware.csrf import get_token
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.views import generic
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.core.files.storage import FileSystemStorage
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.auth import login, update_session_auth_hash
 from django.utils.datastructures import MultiValueDictKeyError
-from django.db.models import Prefetch
+from django.db import transaction
+from django.db.models import Prefetch, F, Q, Case, When, Value, IntegerField
 from django.contrib import messages
 from django.contrib.auth.forms import PasswordChangeForm
 
 from .forms import UserCreateForm
-from .models import Calculation, Profile, Project, ClusterAccess, Example, PIRequest, ResearchGroup, Parameters, Structure, Ensemble, BasicStep, CalculationOrder, Molecule, Property, Filter, Preset, Recipe, Folder, CalculationFrame
-from .tasks import dispatcher, del_project, del_molecule, del_ensemble, del_order, BASICSTEP_TABLE, SPECIAL_FUNCTIONALS, cancel, run_calc, send_cluster_command
+from .models import Calculation, Profile, Project, ClusterAccess, Example, PIRequest, ResearchGroup, Parameters, Structure, Ensemble, BasicStep, CalculationOrder, Molecule, Property, Filter, Preset, Recipe, Folder, CalculationFrame, Workflow, WorkflowStage
+from .tasks import dispatcher, del_project, del_molecule, del_ensemble, del_order, BASICSTEP_TABLE, SPECIAL_FUNCTIONALS, cancel, send_cluster_command, submit_local_calcs
 from .decorators import superuser_required
 from .tasks import system, analyse_opt, generate_xyz_structure, gen_fingerprint, get_Gaussian_xyz
 from .constants import *
 from .libxyz import parse_xyz_from_text, equivalent_atoms
 from .environment_variables import *
 from .calculation_helper import get_xyz_from_Gaussian_input
-
-from shutil import copyfile, make_archive, rmtree
+from .events import subscribe, profile_channel, calculation_channel
+from .permissions import get_permissions
+from . import scheduler
+from . import fairshare
+from .routing import route_calculation
+from .prediction import RuntimePredictor
+from .checkpoints import clear_scratch, FREQUENCY_STEPS
+from .storage import open_result, result_exists, result_files, copy_result, zip_result
+from .cache import invalidate_related_profiles, get_ensemble_map, set_ensemble_map, get_fragment_version, get_fragment, set_fragment, get_cached_spectrum, set_cached_spectrum, get_deleted_orders
+
+from shutil import make_archive, rmtree
 from django.db.models.functions import Lower
 from django.conf import settings
 
@@ -71,6 +89,51 @@ import logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s]  %(module)s: %(message)s")
 logger = logging.getLogger(__name__)
 
+ORDER_RELATED_FIELDS = ['step', 'project', 'result_ensemble', 'ensemble__parent_molecule', 'structure__parent_ensemble__parent_molecule', 'start_calc__result_ensemble__parent_molecule']
+
+def get_target_profile(request):
+    target_username = clean(request.GET.get('user'))
+
+    try:
+        target_profile = User.objects.get(username=target_username).profile
+    except User.DoesNotExist:
+        return None
+
+    if not profile_intersection(request.user.profile, target_profile):
+        return None
+    return target_profile
+
+def get_orders(request, target_profile=None):
+    proj = clean(request.GET.get('project'))
+    type = clean(request.GET.get('type'))
+    status = clean(request.GET.get('status'))
+    mode = clean(request.GET.get('mode'))
+
+    if target_profile is None:
+        target_profile = get_target_profile(request)
+        if target_profile is None:
+            return None
+
+    if mode in ["Workspace", "Unseen only"]:
+        hits = target_profile.calculationorder_set.filter(hidden=False)
+    elif mode == "All orders":
+        hits = target_profile.calculationorder_set.all()
+    else:
+        return None
+
+    if proj != "All projects":
+        hits = hits.filter(project__name=proj)
+    if type != "All steps":
+        hits = hits.filter(step__name=type)
+    if status != "All statuses":
+        if status not in Calculation.CALC_STATUSES:
+            return None
+        hits = hits.filter(status=Calculation.CALC_STATUSES[status])
+    if mode == "Unseen only":
+        hits = hits.exclude(status=F('last_seen_status'))
+
+    return hits.select_related(*ORDER_RELATED_FIELDS)
+
 class IndexView(generic.ListView):
     template_name = 'frontend/dynamic/list.html'
     context_object_name = 'latest_frontend'
@@ -86,44 +149,106 @@ class IndexView(generic.ListView):
             page = 0
 
         self.request.session['previous_page'] = page
-        proj = clean(self.request.GET.get('project'))
-        type = clean(self.request.GET.get('type'))
-        status = clean(self.request.GET.get('status'))
-        target_username = clean(self.request.GET.get('user'))
-        mode = clean(self.request.GET.get('mode'))
 
-        try:
-            target_profile = User.objects.get(username=target_username).profile
-        except User.DoesNotExist:
+        hits = get_orders(self.request)
+        if hits is None:
             return []
 
-        if profile_intersection(self.request.user.profile, target_profile):
-            if mode in ["Workspace", "Unseen only"]:
-                hits = target_profile.calculationorder_set.filter(hidden=False)
-            elif mode == "All orders":
-                hits = target_profile.calculationorder_set.all()
-
-            if proj != "All projects":
-                hits = hits.filter(project__name=proj)
-            if type != "All steps":
-                hits = hits.filter(step__name=type)
-            if status != "All statuses":
-                new_hits = []
-                for hit in hits:
-                    if hit.status == Calculation.CALC_STATUSES[status]:
-                        new_hits.append(hit)
-                hits = new_hits
-            if mode == "Unseen only":
-                new_hits = []
-                for hit in hits:
-                    if hit.status != hit.last_seen_status:
-                        new_hits.append(hit)
-                hits = new_hits
-
-            res = sorted(hits, key=lambda d: (1 if d.new_status or d.status == 1 else 0, d.date), reverse=True)
-            return res
+        hits = hits.annotate(active=Case(When(~Q(status=F('last_seen_status')) | Q(status=1), then=Value(1)), default=Value(0), output_field=IntegerField()))
+        return hits.order_by('-active', '-date')
+
+LIST_JSON_MAX_ORDERS = 100
+
+def order_summary(o):
+    return {
+            'id': o.id,
+            'label': o.label,
+            'step': o.step.name if o.step else None,
+            'project': o.project.name if o.project else None,
+            'molecule': o.molecule_name,
+            'date': o.date.isoformat() if o.date else None,
+            'last_update': o.last_update.isoformat() if o.last_update else None,
+            'status': o.status,
+            'new_status': o.new_status,
+            'hidden': o.hidden,
+            'queued': o.num_queued,
+            'running': o.num_running,
+            'done': o.num_done,
+            'error': o.num_error,
+            'eta': o.eta,
+        }
+
+@login_required
+def list_json(request):
+    target_profile = get_target_profile(request)
+    if target_profile is None:
+        return HttpResponse(status=403)
+
+    hits = get_orders(request, target_profile)
+    if hits is None:
+        return HttpResponse(status=403)
+
+    try:
+        limit = min(int(request.GET.get('limit', 20)), LIST_JSON_MAX_ORDERS)
+    except ValueError:
+        return HttpResponse(status=400)
+
+    # Orders committed slightly after this point might carry an earlier timestamp
+    server_time = timezone.now() - timezone.timedelta(seconds=5)
+
+    if 'updated_since' in request.GET:
+        try:
+            since = parse_datetime(clean(request.GET['updated_since']))
+        except ValueError:
+            return HttpResponse(status=400)
+        if since is None:
+            return HttpResponse(status=400)
+
+        # Timestamps without an offset are in the time zone of the server
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+
+        try:
+            after_id = int(request.GET.get('after_id', 0))
+        except ValueError:
+            return HttpResponse(status=400)
+
+        changed = Q(last_update__gt=since) | Q(last_update=since, id__gt=after_id)
+        hits = hits.filter(changed).order_by('last_update', 'id')
+
+        # Orders which were hidden, changed status or got deleted must leave the list of the client
+        removed = list(target_profile.calculationorder_set.filter(changed).exclude(pk__in=hits.values('pk')).values_list('id', flat=True)[:LIST_JSON_MAX_ORDERS])
+        removed += get_deleted_orders(target_profile.id, since.timestamp())
+    else:
+        removed = []
+
+        try:
+            before = int(request.GET.get('before', 0))
+        except ValueError:
+            return HttpResponse(status=400)
+
+        if before > 0:
+            hits = hits.filter(id__lt=before)
+        hits = hits.order_by('-id')
+
+    orders = list(hits[:limit+1])
+    more = len(orders) > limit
+    orders = orders[:limit]
+
+    next_page = None
+    if more:
+        last = orders[-1]
+        if 'updated_since' in request.GET:
+            next_page = {'updated_since': last.last_update.isoformat(), 'after_id': last.id}
         else:
-            return []
+            next_page = {'before': last.id}
+
+    return JsonResponse({
+            'orders': [order_summary(o) for o in orders],
+            'next': next_page,
+            'removed': removed,
+            'server_time': server_time.isoformat(),
+        })
 
 def home(request):
     return render(request, 'frontend/home.html')
@@ -419,8 +544,11 @@ def ensemble_table_body(request, pk):
     if not can_view_molecule(mol, request.user.profile):
         return redirect('/home/')
 
-    return render(request, 'frontend/dynamic/ensemble_table_body.html', {'profile': request.user.profile,
-        'molecule': mol})
+    profile = request.user.profile
+    is_author = mol.project is not None and mol.project.author_id == profile.id
+
+    return render_fragment(request, 'frontend/dynamic/ensemble_table_body.html', mol.id, ('ensemble_table_body', is_author),
+            lambda: {'profile': profile, 'molecule': mol})
 
 @login_required
 def ensemble(request, pk):
@@ -578,73 +706,93 @@ def get_shifts(request):
 
     return HttpResponse(response)
 
-@login_required
-def get_exp_spectrum(request):
-    t = time.time()
-    d = "/tmp/nmr_{}".format(t)
-    os.mkdir(d)
-    for ind, f in enumerate(request.FILES.getlist("file")):
-        in_file = f.read()#not cleaned
-        with open(os.path.join(d, f.name), 'wb') as out:
-            out.write(in_file)
+NMR_ZERO_FILL_SIZE = 32768
+NMR_PLOT_POINTS = 3000
+
+def normalize_spectrum(val):
+    # Empty windows and flat signals are left as they are instead of becoming NaN
+    if len(val) == 0 or np.max(val) <= 0:
+        return val
+    return normalize_spectrum(val)
 
-    dic, fid = ng.fileio.bruker.read(d)
+def process_exp_spectrum(files):
+    import nmrglue as ng
+
+    with tempfile.TemporaryDirectory(prefix="nmr_") as d:
+        for name, content in files:
+            with open(os.path.join(d, os.path.basename(name)), 'wb') as out:
+                out.write(content)
+
+        dic, fid = ng.fileio.bruker.read(d)
 
-    zero_fill_size = 32768
     fid = ng.bruker.remove_digital_filter(dic, fid)
-    fid = ng.proc_base.zf_size(fid, zero_fill_size) # <2>
-    fid = ng.proc_base.rev(fid) # <3>
+    fid = ng.proc_base.zf_size(fid, NMR_ZERO_FILL_SIZE)
+    fid = ng.proc_base.rev(fid)
     fid = ng.proc_base.fft(fid)
     fid = ng.proc_autophase.autops(fid, 'acme')
 
-    offset = (float(dic['acqus']['SW']) / 2.) - (float(dic['acqus']['O1']) / float(dic['acqus']['BF1']))
-    start = float(dic['acqus']['SW']) - offset
+    sw = float(dic['acqus']['SW'])
+    offset = (sw / 2.) - (float(dic['acqus']['O1']) / float(dic['acqus']['BF1']))
+    start = sw - offset
     end = -offset
-    step = float(dic['acqus']['SW']) / zero_fill_size
-
-    ppms = np.arange(start, end, -step)[:zero_fill_size]
-
-    fid = ng.proc_base.mult(fid, c=1./max(fid))
-    def plotspectra(ppms, data, start=None, stop=None):
-        if start: # <1>
-            dx = abs(ppms - start)
-            ixs = list(dx).index(min(dx))
-            ppms = ppms[ixs:]
-            data = data[:,ixs:]
-        if stop:
-            dx = abs(ppms - stop)
-            ixs = list(dx).index(min(dx))
-            ppms = ppms[:ixs]
-            data = data[:,:ixs]
-
-        return ppms, data
-
-    ppms, fid = plotspectra(ppms, np.array([fid]), start=10, stop=0)
+    step = sw / NMR_ZERO_FILL_SIZE
+
+    ppms = np.arange(start, end, -step)[:NMR_ZERO_FILL_SIZE]
+    signal = np.real(fid[:len(ppms)])
+
+    # The ppm axis is decreasing: search on its opposite to only keep the 10-0 ppm window
+    ind_start, ind_end = np.searchsorted(-ppms, [-10, 0])
+    ppms = ppms[ind_start:ind_end]
+    signal = signal[ind_start:ind_end]
+
+    stride = max(1, len(ppms)//NMR_PLOT_POINTS)
+    ppms = ppms[::stride]
+    signal = signal[::stride]
+
+    return ppms, normalize_spectrum(signal)
+
+def broadened_spectrum(ppms, shifts, sigma=0.001):
+    if len(shifts) == 0:
+        return np.zeros(len(ppms))
+
+    val = np.exp(-(ppms[:, np.newaxis] - np.array(shifts)[np.newaxis, :])**2/sigma).sum(axis=1)
+    return val/np.max(val)
+
+@login_required
+def get_exp_spectrum(request):
+    files = sorted([(f.name, f.read()) for f in request.FILES.getlist("file")])#not cleaned
+    if len(files) == 0:
+        return HttpResponse(status=204)
+
+    h = hashlib.sha256()
+    for name, content in files:
+        h.update(bytes(name, 'UTF-8'))
+        h.update(content)
+    digest = h.hexdigest()
+
+    payload = get_cached_spectrum(digest)
+    if payload is None:
+        ppms, signal = process_exp_spectrum(files)
+
+        mem = BytesIO()
+        np.save(mem, np.vstack((ppms, signal)))
+        set_cached_spectrum(digest, mem.getvalue())
+    else:
+        ppms, signal = np.load(BytesIO(payload))
+
+    if len(ppms) == 0:
+        return HttpResponse(status=204)
+
     shifts = _get_shifts(request)
+    out = StringIO()
     if shifts == '':
-        response = "PPM,Signal\n"
-        for x, y in zip(ppms[0::10], fid[0,0::10]):
-            response += "{},{}\n".format(-x, np.real(y))
-
-        return HttpResponse(response)
-    else:
-        sigma = 0.001
-        def plot_peaks(_x, PP):
-            val = 0
-            for w in PP:
-                dd = list(abs(ppms - w))
-                T = fid[0,dd.index(min(dd))]
-                val += np.exp(-(_x-w)**2/sigma)
-            val = val/max(val)
-            return val
-        _ppms = ppms[0::10]
-        _fid = fid[0,0::10]/max(fid[0,0::10])
+        np.savetxt(out, np.column_stack((-ppms, signal)), fmt="%.4f", delimiter=',', header="PPM,Signal", comments='')
+    else:
         l_shifts = [float(shifts[i][2]) for i in shifts if shifts[i][0] == 'H']
-        pred = plot_peaks(_ppms, l_shifts)
-        response = "PPM,Signal,Prediction\n"
-        for x, y, z in zip(_ppms, _fid, pred):
-            response += "{:.3f},{:.3f},{:.3f}\n".format(-x, np.real(y), z)
-        return HttpResponse(response)
+        pred = broadened_spectrum(ppms, l_shifts)
+        np.savetxt(out, np.column_stack((-ppms, signal, pred)), fmt="%.3f", delimiter=',', header="PPM,Signal,Prediction", comments='')
+
+    return HttpResponse(out.getvalue())
 
 @login_required
 def link_order(request, pk):
@@ -659,11 +807,7 @@ def link_order(request, pk):
         return HttpResponseRedirect("/calculations/")
 
     if profile == o.author:
-        if o.new_status:
-            o.last_seen_status = o.status
-            o.author.unseen_calculations = max(o.author.unseen_calculations-1, 0)
-            o.author.save()
-            o.save()
+        o.mark_seen()
 
     if o.result_ensemble:
         return HttpResponseRedirect("/ensemble/{}".format(o.result_ensemble.id))
@@ -675,6 +819,32 @@ def link_order(request, pk):
         else:
             return HttpResponseRedirect("/calculations/")
 
+FRAGMENT_CSRF_PLACEHOLDER = "__calcus_csrf_token__"
+
+def render_fragment(request, template, molecule_id, key, get_context):
+    '''
+        Renders a dynamic fragment, reusing the cached HTML if the data of the molecule did not change
+
+        The key must contain everything else which affects the rendered HTML.
+    '''
+    version = None
+    if molecule_id is not None:
+        version = get_fragment_version(molecule_id)
+
+    if version is None:
+        return render(request, template, get_context())
+
+    key = "_".join([str(i) for i in key])
+    html = get_fragment(molecule_id, version, key)
+    if html is None:
+        # The token is specific to the session, so it is inserted after the fact
+        context = get_context()
+        context['csrf_token'] = FRAGMENT_CSRF_PLACEHOLDER
+        html = render_to_string(template, context, request=request)
+        set_fragment(molecule_id, version, key, html)
+
+    return HttpResponse(html.replace(FRAGMENT_CSRF_PLACEHOLDER, get_token(request)))
+
 @login_required
 def details_ensemble(request):
     if request.method == 'POST':
@@ -696,13 +866,14 @@ def details_ensemble(request):
         if not can_view_ensemble(e, request.user.profile):
             return HttpResponse(status=403)
 
-        if e.has_nmr(p):
-            shifts = e.weighted_nmr_shifts(p)
-            return render(request, 'frontend/dynamic/details_ensemble.html', {'profile': request.user.profile,
-                'ensemble': e, 'parameters': p, 'shifts': shifts})
-        else:
-            return render(request, 'frontend/dynamic/details_ensemble.html', {'profile': request.user.profile,
-                'ensemble': e, 'parameters': p})
+        def get_context():
+            if e.has_nmr(p):
+                shifts = e.weighted_nmr_shifts(p)
+                return {'profile': request.user.profile, 'ensemble': e, 'parameters': p, 'shifts': shifts}
+            else:
+                return {'profile': request.user.profile, 'ensemble': e, 'parameters': p}
+
+        return render_fragment(request, 'frontend/dynamic/details_ensemble.html', e.parent_molecule_id, ('details_ensemble', e.id, p.id), get_context)
 
     return HttpResponse(status=403)
 
@@ -734,14 +905,12 @@ def details_structure(request):
         except Parameters.DoesNotExist:
             return HttpResponse(status=403)
 
-        for prop in s.properties.all():
-            if prop.parameters == p:
-                break
-        else:
+        prop = s.properties.filter(parameters__md5=p.md5).first()
+        if prop is None:
             return HttpResponse(status=404)
 
-        return render(request, 'frontend/dynamic/details_structure.html', {'profile': request.user.profile,
-            'structure': s, 'property': prop, 'ensemble': e})
+        return render_fragment(request, 'frontend/dynamic/details_structure.html', e.parent_molecule_id, ('details_structure', e.id, num, p.id),
+                lambda: {'profile': request.user.profile, 'structure': s, 'property': prop, 'ensemble': e})
 
     return HttpResponse(status=403)
 
@@ -782,35 +951,44 @@ def error(request, msg):
         'error_message': msg,
         })
 
-def parse_parameters(request):
+def parse_parameters(request, post=None, create=True):
+    '''
+        Validates the parameters of a calculation and returns them with the project and the step
+
+        With create=False, nothing is saved: the fields of the parameters are returned instead
+        of the parameters, and the project is None if it does not exist yet.
+    '''
     profile = request.user.profile
 
-    if 'calc_type' in request.POST.keys():
+    if post is None:
+        post = request.POST
+
+    if 'calc_type' in post.keys():
         try:
-            step = BasicStep.objects.get(name=clean(request.POST['calc_type']))
+            step = BasicStep.objects.get(name=clean(post['calc_type']))
         except BasicStep.DoesNotExist:
             return "No such procedure"
     else:
         return "No calculation type"
 
-    if 'calc_project' in request.POST.keys():
-        project = clean(request.POST['calc_project'])
+    if 'calc_project' in post.keys():
+        project = clean(post['calc_project'])
         if project.strip() == '':
             return "No calculation project"
     else:
         return "No calculation project"
 
-    if 'calc_charge' in request.POST.keys():
+    if 'calc_charge' in post.keys():
         try:
-            charge = int(clean(request.POST['calc_charge']).replace('+', ''))
+            charge = int(clean(post['calc_charge']).replace('+', ''))
         except ValueError:
             return "Invalid calculation charge"
     else:
         return "No calculation charge"
 
-    if 'calc_multiplicity' in request.POST.keys():
+    if 'calc_multiplicity' in post.keys():
         try:
-            mult = int(clean(request.POST['calc_multiplicity']))
+            mult = int(clean(post['calc_multiplicity']))
         except ValueError:
             return "Invalid multiplicity"
         if mult < 1:
@@ -818,20 +996,20 @@ def parse_parameters(request):
     else:
         return "No calculation multiplicity"
 
-    if 'calc_solvent' in request.POST.keys():
-        solvent = clean(request.POST['calc_solvent'])
+    if 'calc_solvent' in post.keys():
+        solvent = clean(post['calc_solvent'])
         if solvent.strip() == '':
             solvent = "Vacuum"
     else:
         solvent = "Vacuum"
 
     if solvent != "Vacuum":
-        if 'calc_solvation_model' in request.POST.keys():
-            solvation_model = clean(request.POST['calc_solvation_model'])
+        if 'calc_solvation_model' in post.keys():
+            solvation_model = clean(post['calc_solvation_model'])
             if solvation_model not in ['SMD', 'PCM', 'CPCM', 'GBSA', 'ALPB']:
                 return "Invalid solvation model"
-            if 'calc_solvation_radii' in request.POST.keys():
-                solvation_radii = clean(request.POST['calc_solvation_radii'])
+            if 'calc_solvation_radii' in post.keys():
+                solvation_radii = clean(post['calc_solvation_radii'])
             else:
                 return "No solvation radii"
         else:
@@ -840,8 +1018,8 @@ def parse_parameters(request):
         solvation_model = ""
         solvation_radii = ""
 
-    if 'calc_software' in request.POST.keys():
-        software = clean(request.POST['calc_software'])
+    if 'calc_software' in post.keys():
+        software = clean(post['calc_software'])
         if software.strip() == '':
             return "No software chosen"
         if software not in BASICSTEP_TABLE.keys():
@@ -849,19 +1027,19 @@ def parse_parameters(request):
     else:
         return "No software chosen"
 
-    if 'calc_df' in request.POST.keys():
-        df = clean(request.POST['calc_df'])
+    if 'calc_df' in post.keys():
+        df = clean(post['calc_df'])
     else:
         df = ''
 
-    if 'calc_custom_bs' in request.POST.keys():
-        bs = clean(request.POST['calc_custom_bs'])
+    if 'calc_custom_bs' in post.keys():
+        bs = clean(post['calc_custom_bs'])
     else:
         bs = ''
 
     if software == 'ORCA' or software == 'Gaussian':
-        if 'calc_theory_level' in request.POST.keys():
-            theory = clean(request.POST['calc_theory_level'])
+        if 'calc_theory_level' in post.keys():
+            theory = clean(post['calc_theory_level'])
             if theory.strip() == '':
                 return "No theory level chosen"
         else:
@@ -869,23 +1047,23 @@ def parse_parameters(request):
 
         if theory == "DFT":
             special_functional = False
-            if 'pbeh3c' in request.POST.keys() and software == "ORCA":
-                field_pbeh3c = clean(request.POST['pbeh3c'])
+            if 'pbeh3c' in post.keys() and software == "ORCA":
+                field_pbeh3c = clean(post['pbeh3c'])
                 if field_pbeh3c == "on":
                     special_functional = True
                     functional = "PBEh-3c"
                     basis_set = ""
 
             if not special_functional:
-                if 'calc_functional' in request.POST.keys():
-                    functional = clean(request.POST['calc_functional'])
+                if 'calc_functional' in post.keys():
+                    functional = clean(post['calc_functional'])
                     if functional.strip() == '':
                         return "No method"
                 else:
                     return "No method"
                 if functional not in SPECIAL_FUNCTIONALS:
-                    if 'calc_basis_set' in request.POST.keys():
-                        basis_set = clean(request.POST['calc_basis_set'])
+                    if 'calc_basis_set' in post.keys():
+                        basis_set = clean(post['calc_basis_set'])
                         if basis_set.strip() == '':
                             return "No basis set chosen"
                     else:
@@ -893,8 +1071,8 @@ def parse_parameters(request):
                 else:
                     basis_set = ""
         elif theory == "Semi-empirical":
-            if 'calc_se_method' in request.POST.keys():
-                functional = clean(request.POST['calc_se_method'])
+            if 'calc_se_method' in post.keys():
+                functional = clean(post['calc_se_method'])
                 if functional.strip() == '':
                     return "No semi-empirical method chosen"
                 basis_set = ''
@@ -902,8 +1080,8 @@ def parse_parameters(request):
                 return "No semi-empirical method chosen"
         elif theory == "HF":
             special_functional = False
-            if 'hf3c' in request.POST.keys() and software == "ORCA":
-                field_hf3c = clean(request.POST['hf3c'])
+            if 'hf3c' in post.keys() and software == "ORCA":
+                field_hf3c = clean(post['hf3c'])
                 if field_hf3c == "on":
                     special_functional = True
                     functional = "HF-3c"
@@ -911,8 +1089,8 @@ def parse_parameters(request):
 
             if not special_functional:
                 functional = "HF"
-                if 'calc_basis_set' in request.POST.keys():
-                    basis_set = clean(request.POST['calc_basis_set'])
+                if 'calc_basis_set' in post.keys():
+                    basis_set = clean(post['calc_basis_set'])
                     if basis_set.strip() == '':
                         return "No basis set chosen"
                 else:
@@ -922,8 +1100,8 @@ def parse_parameters(request):
                 return "RI-MP2 is only available for ORCA"
 
             functional = "RI-MP2"
-            if 'calc_basis_set' in request.POST.keys():
-                basis_set = clean(request.POST['calc_basis_set'])
+            if 'calc_basis_set' in post.keys():
+                basis_set = clean(post['calc_basis_set'])
                 if basis_set.strip() == '':
                     return "No basis set chosen"
             else:
@@ -937,8 +1115,8 @@ def parse_parameters(request):
             functional = "GFN2-xTB"
             basis_set = "min"
             if step.name == "Conformational Search":
-                if 'calc_conf_option' in request.POST.keys():
-                    conf_option = clean(request.POST['calc_conf_option'])
+                if 'calc_conf_option' in post.keys():
+                    conf_option = clean(post['calc_conf_option'])
                     if conf_option not in ['GFN2-xTB', 'GFN-FF', 'GFN2-xTB//GFN-FF']:
                         return "Error in the option for the conformational search"
                     functional = conf_option
@@ -952,18 +1130,21 @@ def parse_parameters(request):
     if step.name not in BASICSTEP_TABLE[software].keys():
         return "Invalid calculation type"
 
-    if 'calc_specifications' in request.POST.keys():
-        specifications = clean(request.POST['calc_specifications']).lower()
+    if 'calc_specifications' in post.keys():
+        specifications = clean(post['calc_specifications']).lower()
     else:
         specifications = ""
 
     if project == "New Project":
-        new_project_name = clean(request.POST['new_project_name'])
+        new_project_name = clean(post['new_project_name'])
         try:
             project_obj = Project.objects.get(name=new_project_name, author=profile)
         except Project.DoesNotExist:
-            project_obj = Project.objects.create(name=new_project_name, author=profile)
-            project_obj.save()
+            if create:
+                project_obj = Project.objects.create(name=new_project_name, author=profile)
+                project_obj.save()
+            else:
+                project_obj = None
         else:
             logger.info("Project with that name already exists")
     else:
@@ -977,8 +1158,11 @@ def parse_parameters(request):
         else:
             project_obj = project_set[0]
 
-    params = Parameters.objects.create(charge=charge, multiplicity=mult, solvent=solvent, method=functional, basis_set=basis_set, software=software, theory_level=theory, solvation_model=solvation_model, solvation_radii=solvation_radii, density_fitting=df, custom_basis_sets=bs, specifications=specifications)
-    params.save()
+    fields = dict(charge=charge, multiplicity=mult, solvent=solvent, method=functional, basis_set=basis_set, software=software, theory_level=theory, solvation_model=solvation_model, solvation_radii=solvation_radii, density_fitting=df, custom_basis_sets=bs, specifications=specifications)
+    if not create:
+        return fields, project_obj, step
+
+    params = Parameters.objects.get_or_create_by_hash(**fields)
 
     return params, project_obj, step
 
@@ -1022,10 +1206,9 @@ def set_project_default(request):
 def handle_file_upload(ff, params):
     s = Structure.objects.create()
 
-    _params = Parameters.objects.create(software="Unknown", method="Unknown", basis_set="", solvation_model="", charge=params.charge, multiplicity=1)
+    _params = Parameters.objects.get_or_create_by_hash(software="Unknown", method="Unknown", basis_set="", solvation_model="", charge=params.charge, multiplicity=1)
     p = Property.objects.create(parent_structure=s, parameters=_params, geom=True)
     p.save()
-    _params.save()
 
     drawing = False
     in_file = clean(ff.read().decode('utf-8'))
@@ -1068,17 +1251,123 @@ def process_filename(filename):
     else:
         return filename, 0
 
+# Steps which need more input than the structures of the previous stage
+WORKFLOW_EXCLUDED_STEPS = ["Constrained Optimisation", "Constrained Conformational Search", "Minimum Energy Path"]
+
+# Fields of the main form shared by all the stages of a workflow
+WORKFLOW_SHARED_FIELDS = ['calc_project', 'new_project_name', 'calc_charge', 'calc_multiplicity']
+
+def parse_workflow(request):
+    '''
+        Parses the next stages of a workflow
+
+        The stages are given as a JSON list with the same fields as the launch form, as well
+        as the index of their parent stage and of the stage whose parameters are used to filter.
+        The index 0 designates the calculation launched with the form. Nothing is saved, so that
+        a workflow rejected at a later stage leaves nothing behind (see save_workflow_parameters).
+    '''
+    try:
+        stages = json.loads(request.POST['workflow'])
+    except ValueError:
+        return "Invalid workflow"
+
+    if not isinstance(stages, list) or len(stages) == 0:
+        return "Invalid workflow"
+
+    specs = []
+    for ind, stage in enumerate(stages, 1):
+        if not isinstance(stage, dict):
+            return "Invalid workflow stage"
+
+        post = {k: str(v) for k, v in stage.items()}
+        for field in WORKFLOW_SHARED_FIELDS:
+            if field in request.POST.keys():
+                post[field] = request.POST[field]
+
+        ret = parse_parameters(request, post, create=False)
+        if isinstance(ret, str):
+            return "Workflow stage {}: {}".format(ind, ret)
+
+        stage_fields, project_obj, step = ret
+
+        if step.name in WORKFLOW_EXCLUDED_STEPS:
+            return "Workflow stage {}: this type of calculation cannot be used in workflows".format(ind)
+
+        try:
+            parent = int(clean(post.get('parent', str(ind-1))))
+        except ValueError:
+            return "Workflow stage {}: invalid parent stage".format(ind)
+
+        if parent < 0 or parent >= ind:
+            return "Workflow stage {}: invalid parent stage".format(ind)
+
+        name = clean(post.get('calc_name', ''))
+        if len(name) > 100:
+            return "Workflow stage {}: the chosen name is too long".format(ind)
+
+        filter_type = clean(post.get('calc_filter', 'None'))
+        stage_filter = None
+        if filter_type == "By Relative Energy" or filter_type == "By Boltzmann Weight":
+            try:
+                filter_value = float(clean(post.get('filter_value', '')))
+            except ValueError:
+                return "Workflow stage {}: invalid filter value".format(ind)
+
+            try:
+                filter_stage = int(clean(post.get('filter_parameters', '')))
+            except ValueError:
+                return "Workflow stage {}: invalid filter parameters".format(ind)
+
+            if filter_stage < 0 or filter_stage >= ind:
+                return "Workflow stage {}: invalid filter parameters".format(ind)
+
+            stage_filter = (filter_type, filter_value, filter_stage)
+        elif filter_type != "None":
+            return "Workflow stage {}: invalid filter type".format(ind)
+
+        specs.append({'name': name, 'step': step, 'parameters': stage_fields, 'parent': parent, 'filter': stage_filter})
+
+    return specs
+
+def save_workflow_parameters(specs, params):
+    '''
+        Gets or creates the parameters of the stages of a validated workflow
+    '''
+    all_params = [params]
+    for spec in specs:
+        spec['parameters'] = Parameters.objects.get_or_create_by_hash(**spec['parameters'])
+        all_params.append(spec['parameters'])
+
+    for spec in specs:
+        if spec['filter'] is not None:
+            filter_type, filter_value, filter_stage = spec['filter']
+            spec['filter'] = (filter_type, filter_value, all_params[filter_stage])
+    return specs
+
+def create_workflow(order, specs):
+    workflow = Workflow.objects.create(name=order.name, author=order.author, project=order.project, date=timezone.now())
+
+    stages = [WorkflowStage.objects.create(workflow=workflow, name=order.name, step=order.step, parameters=order.parameters, filter=order.filter, resource=order.resource, order=order)]
+    for spec in specs:
+        stage_filter = None
+        if spec['filter'] is not None:
+            filter_type, filter_value, filter_parameters = spec['filter']
+            stage_filter = Filter.objects.create(type=filter_type, parameters=filter_parameters, value=filter_value)
+
+        stages.append(WorkflowStage.objects.create(workflow=workflow, parent=stages[spec['parent']], name=spec['name'], step=spec['step'],
+                parameters=spec['parameters'], filter=stage_filter, resource=order.resource))
+    return workflow
+
 @login_required
 def submit_calculation(request):
-    ret = parse_parameters(request)
+    # Nothing is saved before the form and every stage of the workflow are validated
+    ret = parse_parameters(request, create=False)
 
     if isinstance(ret, str):
         return error(request, ret)
 
     profile = request.user.profile
 
-    params, project_obj, step = ret
-
     if 'calc_resource' in request.POST.keys():
         resource = clean(request.POST['calc_resource'])
         if resource.strip() == '':
@@ -1098,6 +1387,43 @@ def submit_calculation(request):
         if not profile.is_PI and profile.group == None and not request.user.is_superuser:
             return error(request, "You have no computing resource")
 
+    # Resources of each calculation, chosen automatically if left empty
+    nproc = 0
+    if request.POST.get('calc_nproc', '').strip() != '':
+        try:
+            nproc = int(clean(request.POST['calc_nproc']))
+        except ValueError:
+            return error(request, "Invalid number of cores")
+        if nproc < 1:
+            return error(request, "Invalid number of cores")
+
+    mem = 0
+    if request.POST.get('calc_mem', '').strip() != '':
+        try:
+            mem = int(clean(request.POST['calc_mem']))
+        except ValueError:
+            return error(request, "Invalid amount of memory")
+        if mem < 1:
+            return error(request, "Invalid amount of memory")
+
+    if resource != "Local" and (nproc > access.pal or mem > access.memory):
+        return error(request, "The cluster access does not have enough resources")
+
+    workflow = None
+    if 'workflow' in request.POST.keys():
+        workflow = parse_workflow(request)
+        if isinstance(workflow, str):
+            return error(request, workflow)
+
+    ret = parse_parameters(request)
+    if isinstance(ret, str):
+        return error(request, ret)
+
+    params, project_obj, step = ret
+
+    if workflow is not None:
+        workflow = save_workflow_parameters(workflow, params)
+
     orders = []
     drawing = True
 
@@ -1387,10 +1713,9 @@ def submit_calculation(request):
                 obj.ensemble = e
 
                 s = Structure.objects.create(parent_ensemble=e, number=1)
-                params = Parameters.objects.create(software="Open Babel", method="Forcefield", basis_set="", solvation_model="", charge=params.charge, multiplicity="1")
+                params = Parameters.objects.get_or_create_by_hash(software="Open Babel", method="Forcefield", basis_set="", solvation_model="", charge=params.charge, multiplicity=1)
                 p = Property.objects.create(parent_structure=s, parameters=params, geom=True)
                 p.save()
-                params.save()
 
                 mol = clean(request.POST['structure'])
                 s.mol_structure = mol
@@ -1473,8 +1798,13 @@ def submit_calculation(request):
         if resource != "Local":
             o.resource = access
 
+        o.nproc = nproc
+        o.mem = mem
         o.save()
 
+        if workflow is not None:
+            create_workflow(o, workflow)
+
     profile.save()
 
     if 'test' not in request.POST.keys():
@@ -1484,68 +1814,31 @@ def submit_calculation(request):
     return redirect("/calculations/")
 
 def can_view_project(proj, profile):
-    if proj.author == profile:
-        return True
-    else:
-        if not profile_intersection(proj.author, profile):
-            return False
-        if proj.private and not profile.is_PI:
-            return False
-        return True
+    return get_permissions(profile).can_view_project(proj)
 
 def can_view_molecule(mol, profile):
-    return can_view_project(mol.project, profile)
+    return get_permissions(profile).can_view_in_project(Molecule, mol)
 
 def can_view_ensemble(e, profile):
-    return can_view_molecule(e.parent_molecule, profile)
+    return get_permissions(profile).can_view_in_project(Ensemble, e)
 
 def can_view_structure(s, profile):
-    return can_view_ensemble(s.parent_ensemble, profile)
+    return get_permissions(profile).can_view_in_project(Structure, s)
 
 def can_view_parameters(p, profile):
-    prop = p.property_set.first()
-
-    if prop is not None:
-        return can_view_structure(prop.parent_structure, profile)
-
-    c = p.calculation_set.first()
-
-    if c is not None:
-        return can_view_calculation(c, profile)
+    return get_permissions(profile).can_view_parameters(p)
 
 def can_view_preset(p, profile):
-    return profile_intersection(p.author, profile)
+    return get_permissions(profile).intersects(p.author_id, profile.id)
 
 def can_view_order(order, profile):
-    if order.author == profile:
-        return True
-    elif profile_intersection(order.author, profile):
-        if order.project.private and not profile.is_PI:
-            return False
-        return True
+    return get_permissions(profile).can_view_order(order)
 
 def can_view_calculation(calc, profile):
-    return can_view_order(calc.order, profile)
+    return get_permissions(profile).can_view_calculation(calc)
 
 def profile_intersection(profile1, profile2):
-    if profile1 == profile2:
-        return True
-    if profile1.group != None:
-        if profile2 in profile1.group.members.all():
-            return True
-        if profile2 == profile1.group.PI:
-            return True
-    else:
-        return False
-
-    if profile2.group == None:
-        return False
-
-    if profile1.researchgroup_PI != None:
-        for group in profile1.researchgroup_PI:
-            if profile2 in group.members.all():
-                return True
-    return False
+    return get_permissions(profile2).intersects(profile1.id, profile2.id)
 
 @login_required
 def project_list(request):
@@ -1894,10 +2187,25 @@ def server_summary(request):
     users = Profile.objects.all()
     groups = ResearchGroup.objects.all()
     accesses = ClusterAccess.objects.all()
+
+    try:
+        nodes = scheduler.utilisation()
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not get the usage of the local resources: {}".format(str(e)))
+        nodes = []
+
+    try:
+        shares = fairshare.summary()
+    except redis.exceptions.RedisError as e:
+        logger.warning("Could not get the fair-share usage: {}".format(str(e)))
+        shares = []
+
     return render(request, 'frontend/server_summary.html', {
         'users': users,
         'groups': groups,
         'accesses': accesses,
+        'nodes': nodes,
+        'shares': shares,
         })
 
 @login_required
@@ -1933,6 +2241,7 @@ def add_user(request):
             return HttpResponse(status=403)
 
         group.members.add(user.profile)
+        invalidate_related_profiles()
 
         return HttpResponse(status=200)
 
@@ -1969,6 +2278,7 @@ def remove_user(request):
             return HttpResponse(status=403)
 
         group.members.remove(member)
+        invalidate_related_profiles()
 
         return HttpResponse(status=200)
 
@@ -2061,27 +2371,27 @@ def conformer_table_post(request):
         except Parameters.DoesNotExist:
             return HttpResponse(status=403)
 
-        full_summary, hashes = e.ensemble_summary
+        def get_context():
+            full_summary, hashes = e.ensemble_summary
 
-        if p.md5 in full_summary.keys():
-            summary = full_summary[p.md5]
+            if p.md5 in full_summary.keys():
+                summary = full_summary[p.md5]
 
-            fms = profile.pref_units_format_string
+                fms = profile.pref_units_format_string
 
-            rel_energies = [fms.format(i) for i in np.array(summary[5])*profile.unit_conversion_factor]
-            structures = [e.structure_set.get(pk=i) for i in summary[4]]
-            data = zip(structures, summary[2], rel_energies, summary[6])
-            data = sorted(data, key=lambda i: i[0].number)
+                rel_energies = [fms.format(i) for i in np.array(summary[5])*profile.unit_conversion_factor]
+                structures = e.structure_set.in_bulk(summary[4])
+                data = zip([structures[i] for i in summary[4]], summary[2], rel_energies, summary[6])
+                data = sorted(data, key=lambda i: i[0].number)
 
-        else:
-            blank = ['-' for i in range(e.structure_set.count())]
-            structures = e.structure_set.all()
-            data = zip(structures, blank, blank, blank)
-            data = sorted(data, key=lambda i: i[0].number)
-        return render(request, 'frontend/dynamic/conformer_table.html', {
-                'profile': request.user.profile,
-                'data': data,
-            })
+            else:
+                structures = e.structure_set.all()
+                blank = ['-' for i in range(len(structures))]
+                data = zip(structures, blank, blank, blank)
+                data = sorted(data, key=lambda i: i[0].number)
+            return {'profile': profile, 'data': data}
+
+        return render_fragment(request, 'frontend/dynamic/conformer_table.html', e.parent_molecule_id, ('conformer_table', e.id, p.id, profile.pref_units), get_context)
 
     else:
         return HttpResponse(status=403)
@@ -2097,14 +2407,75 @@ def uvvis(request, pk):
 
     spectrum_file = os.path.join(CALCUS_RESULTS_HOME, str(calc.id), "uvvis.csv")
 
-    if os.path.isfile(spectrum_file):
-        with open(spectrum_file, 'rb') as f:
+    if result_exists(spectrum_file):
+        with open_result(spectrum_file, 'rb') as f:
             response = HttpResponse(f, content_type='text/csv')
             response['Content-Disposition'] = 'attachment; filename={}.csv'.format(id)
             return response
     else:
         return HttpResponse(status=204)
 
+EVENTS_STREAM_DURATION = 300
+EVENTS_KEEPALIVE = 15
+# Each stream holds a thread of the worker, the rest must stay free for the regular requests
+EVENTS_MAX_STREAMS = int(os.environ.get('CALCUS_EVENTS_MAX_STREAMS', 4))
+
+events_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+class EventStream:
+    '''
+        Iterates over the events of the channels and releases the slot of the stream when closed.
+        The server closes the response even if the stream was never iterated over.
+    '''
+    def __init__(self, channels):
+        self.channels = channels
+        self.released = False
+
+    def __iter__(self):
+        pubsub = subscribe(self.channels)
+        start = time.time()
+        try:
+            yield "retry: 5000\n\n"
+            # The browser reconnects by itself, which frees the thread from time to time
+            while time.time() - start < EVENTS_STREAM_DURATION:
+                msg = pubsub.get_message(timeout=EVENTS_KEEPALIVE)
+                if msg is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "data: {}\n\n".format(msg['data'].decode('utf-8'))
+        finally:
+            pubsub.close()
+            self.close()
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            events_slots.release()
+
+@login_required
+def events(request):
+    profile = request.user.profile
+    channels = [profile_channel(profile.id)]
+
+    if 'calc' in request.GET:
+        try:
+            calc = Calculation.objects.get(pk=int(clean(request.GET['calc'])))
+        except (ValueError, Calculation.DoesNotExist):
+            return HttpResponse(status=404)
+
+        if not can_view_calculation(calc, profile):
+            return HttpResponse(status=403)
+        channels.append(calculation_channel(calc.id))
+
+    if not events_slots.acquire(blocking=False):
+        # EventSource does not reconnect after an error status, the page falls back to polling
+        return HttpResponse(status=503)
+
+    response = StreamingHttpResponse(EventStream(channels), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 def get_calc_data(request, pk):
     try:
@@ -2168,20 +2539,13 @@ def get_calc_data_remote(request, pk):
         except OSError:
             pass
 
+        # The cluster daemon publishes a 'remote_log' event once the log is downloaded
         send_cluster_command("load_log\n{}\n{}\n".format(calc.id, calc.order.resource.id))
-
-        ind = 0
-        while not os.path.isfile(os.path.join(CALCUS_SCR_HOME, str(calc.id), "calc.log")) and ind < 60:
-            time.sleep(1)
-            ind += 1
-
-        if not os.path.isfile(os.path.join(CALCUS_SCR_HOME, str(calc.id), "calc.log")):
-            return HttpResponse(status=404)
     else:
         logger.error("Not implemented")
         return HttpResponse(status=403)
 
-    return format_frames(calc, profile)
+    return HttpResponse(status=202)
 
 def get_calc_frame(request, cid, fid):
     try:
@@ -2224,8 +2588,8 @@ def get_cube(request):
             return HttpResponse(status=204)
         spectrum_file = os.path.join(CALCUS_RESULTS_HOME, str(id), cube_file)
 
-        if os.path.isfile(spectrum_file):
-            with open(spectrum_file, 'r') as f:
+        if result_exists(spectrum_file):
+            with open_result(spectrum_file) as f:
                 lines = f.readlines()
             return HttpResponse(''.join(lines))
         else:
@@ -2298,8 +2662,8 @@ def ir_spectrum(request, pk):
 
     spectrum_file = os.path.join(CALCUS_RESULTS_HOME, id, "IR.csv")
 
-    if os.path.isfile(spectrum_file):
-        with open(spectrum_file, 'rb') as f:
+    if result_exists(spectrum_file):
+        with open_result(spectrum_file, 'rb') as f:
             response = HttpResponse(f, content_type='text/csv')
             response['Content-Disposition'] = 'attachment; filename={}.csv'.format(id)
             return response
@@ -2323,8 +2687,8 @@ def vib_table(request, pk):
 
     vibs = []
 
-    if os.path.isfile(vib_file):
-        with open(vib_file) as f:
+    if result_exists(vib_file):
+        with open_result(vib_file) as f:
             lines = f.readlines()
 
         for line in lines:
@@ -2339,8 +2703,8 @@ def vib_table(request, pk):
                 vib = float(line[20:33].strip())
                 vibs.append(vib)
 
-    elif os.path.isfile(orca_file):
-        with open(orca_file) as f:
+    elif result_exists(orca_file):
+        with open_result(orca_file) as f:
             lines = f.readlines()
 
         for line in lines:
@@ -2703,8 +3067,8 @@ def get_vib_animation(request):
 
         num = int(clean(request.POST['num']))
         expected_file = os.path.join(CALCUS_RESULTS_HOME, str(id), "freq_{}.xyz".format(num))
-        if os.path.isfile(expected_file):
-            with open(expected_file) as f:
+        if result_exists(expected_file):
+            with open_result(expected_file) as f:
                 lines = f.readlines()
 
             return HttpResponse(''.join(lines))
@@ -2733,8 +3097,8 @@ def get_scan_animation(request):
             return HttpResponse(status=403)
 
         expected_file = os.path.join(CALCUS_RESULTS_HOME, id, "xtbscan.xyz")
-        if os.path.isfile(expected_file):
-            with open(expected_file) as f:
+        if result_exists(expected_file):
+            with open_result(expected_file) as f:
                 lines = f.readlines()
 
             inds = []
@@ -2777,20 +3141,20 @@ def download_log(request, pk):
     elif calc.status == 0:
         return HttpResponse(status=204)
 
-    logs = glob.glob(dir + '/*.out')
-    logs += glob.glob(dir + '/*.log')
+    logs = result_files(dir, '*.out')
+    logs += result_files(dir, '*.log')
 
     if len(logs) > 1:
         mem = BytesIO()
         with zipfile.ZipFile(mem, 'w', zipfile.ZIP_DEFLATED) as zip:
             for f in logs:
-                zip.write(f, "{}_".format(calc.id) + basename(f))
+                zip_result(zip, f, "{}_".format(calc.id) + basename(f))
 
         response = HttpResponse(mem.getvalue(), content_type='application/zip')
         response['Content-Disposition'] = 'attachment; filename="calc_{}.zip"'.format(calc.id)
         return response
     elif len(logs) == 1:
-        with open(logs[0]) as f:
+        with open_result(logs[0]) as f:
             lines = f.readlines()
             response = HttpResponse(''.join(lines), content_type='text/plain')
             response['Content-Disposition'] = 'attachment; filename="calc_{}.log"'.format(calc.id)
@@ -2820,8 +3184,8 @@ def download_all_logs(request, pk):
         elif calc.status == 0:
             return HttpResponse(status=204)
 
-        logs = glob.glob(dir + '/*.out')
-        logs += glob.glob(dir + '/*.log')
+        logs = result_files(dir, '*.out')
+        logs += result_files(dir, '*.log')
 
         order_logs[calc.id] = logs
 
@@ -2829,7 +3193,7 @@ def download_all_logs(request, pk):
     with zipfile.ZipFile(mem, 'w', zipfile.ZIP_DEFLATED) as zip:
         for c in order_logs.keys():
             for f in order_logs[c]:
-                zip.write(f, "{}_".format(c) + basename(f))
+                zip_result(zip, f, "{}_".format(c) + basename(f))
 
     response = HttpResponse(mem.getvalue(), content_type='application/zip')
     response['Content-Disposition'] = 'attachment; filename="order_{}.zip"'.format(pk)
@@ -2863,15 +3227,15 @@ def log(request, pk):
     elif calc.status == 0:
         return HttpResponse(status=204)
 
-    for out in glob.glob(dir + '/*.out'):
+    for out in result_files(dir, '*.out'):
         out_name = out.split('/')[-1]
-        with open(out) as f:
+        with open_result(out) as f:
             lines = f.readlines()
         response += LOG_HTML.format(out_name, ''.join(lines))
 
-    for log in glob.glob(dir + '/*.log'):
+    for log in result_files(dir, '*.log'):
         log_name = log.split('/')[-1]
-        with open(log) as f:
+        with open_result(log) as f:
             lines = f.readlines()
         response += LOG_HTML.format(log_name, ''.join(lines))
 
@@ -3413,7 +3777,7 @@ def download_project_logs(proj, profile, scope, details, folders):
                     if calc.status == 0:
                         continue
                     if details == "freq":
-                        if calc.step.name != "Frequency Calculation":
+                        if calc.step.short_name not in FREQUENCY_STEPS:
                             continue
                         log_name = e.name + '_' + calc.parameters.file_name + '_conf{}'.format(s.number)
                     elif details == "full":
@@ -3421,7 +3785,7 @@ def download_project_logs(proj, profile, scope, details, folders):
 
                     log_name = log_name.replace(' ', '_')
                     try:
-                        copyfile(os.path.join(CALCUS_RESULTS_HOME, str(calc.id), "calc.out"), os.path.join(e_dir, log_name + '.log'))
+                        copy_result(os.path.join(CALCUS_RESULTS_HOME, str(calc.id), "calc.out"), os.path.join(e_dir, log_name + '.log'))
                     except FileNotFoundError:
                         logger.warning("Calculation not found: {}".format(calc.id))
                     if calc.parameters.software == 'xtb':#xtb logs don't contain the structure
@@ -3598,7 +3962,7 @@ def download_folder(request, pk):
                 for c in o.calculation_set.all():
                     if c.status == 2:
                         name = clean_filename(prefix + c.parameters.file_name + "_" + c.step.short_name + "_conf" + str(c.structure.number) + ".log")
-                        zip.write(os.path.join(CALCUS_RESULTS_HOME, str(c.id), "calc.out"), os.path.join(path, clean_filename(folder.name), name))
+                        zip_result(zip, os.path.join(CALCUS_RESULTS_HOME, str(c.id), "calc.out"), os.path.join(path, clean_filename(folder.name), name))
 
         for f in subfolders:
             add_folder_data(zip, f, os.path.join(path, clean_filename(folder.name)))
@@ -3701,26 +4065,29 @@ def relaunch_calc(request):
     scr_dir = os.path.join(CALCUS_SCR_HOME, str(calc.id))
     res_dir = os.path.join(CALCUS_RESULTS_HOME, str(calc.id))
 
-    try:
-        rmtree(scr_dir)
-    except FileNotFoundError:
-        pass
+    # Local calculations only continue from their last checkpoint when asked to
+    if calc.local and request.POST.get('resume', '') == 'true':
+        clear_scratch(scr_dir, calc.parameters.software)
+    else:
+        try:
+            rmtree(scr_dir)
+        except FileNotFoundError:
+            pass
     try:
         rmtree(res_dir)
     except FileNotFoundError:
         pass
 
-    calc.status = 0
     calc.remote_id = 0
     calc.order.hidden = False
     calc.order.save()
     calc.save()
+    calc.transition(0)
 
     if calc.local:
-        t = run_calc.s(calc.id).set(queue='comp')
-        res = t.apply_async()
-        calc.task_id = res
+        calc.task_id = ''
         calc.save()
+        submit_local_calcs(calc.order.author_id, [calc], route_calculation(calc))
     else:
         send_cluster_command("launch\n{}\n{}\n".format(calc.id, calc.order.resource_id))
 
@@ -3753,8 +4120,7 @@ def refetch_calc(request):
     if calc.local:
         return HttpResponse(status=204)
 
-    calc.status = 1
-    calc.save()
+    calc.transition(1)
 
     send_cluster_command("launch\n{}\n{}\n".format(calc.id, calc.order.resource_id))
 
@@ -3770,31 +4136,25 @@ def ensemble_map(request, pk):
     profile = request.user.profile
     if not can_view_molecule(mol, profile):
         return redirect('/home/')
-    json = """{{
-                "nodes": [
-                        {}
-                        ],
-                "edges": [
-                        {}
-                    ]
-                }}"""
-    nodes = ""
-    for e in mol.ensemble_set.all():
-        if e.flagged:
-            border_text = """, "bcolor": "black", "bwidth": 2"""
-        else:
-            border_text = ""
-        nodes += """{{ "data": {{"id": "{}", "name": "{}", "href": "/ensemble/{}", "color": "{}"{}}} }},""".format(e.id, e.name, e.id, e.get_node_color, border_text)
-    nodes = nodes[:-1]
 
-    edges = ""
-    for e in mol.ensemble_set.all():
-        if e.origin != None:
-            edges += """{{ "data": {{"source": "{}", "target": "{}"}} }},""".format(e.origin.id, e.id)
-    edges = edges[:-1]
-    response = HttpResponse(json.format(nodes, edges), content_type='text/json')
+    payload = get_ensemble_map(mol.id)
+    if payload is None:
+        nodes = []
+        edges = []
+        for e in Ensemble.with_node_statuses(mol.ensemble_set.all()).order_by('id'):
+            data = {'id': str(e.id), 'name': e.name, 'href': "/ensemble/{}".format(e.id), 'color': Ensemble.annotated_node_color(e)}
+            if e.flagged:
+                data['bcolor'] = "black"
+                data['bwidth'] = 2
+            nodes.append({'data': data})
 
-    return HttpResponse(response)
+            if e.origin_id is not None:
+                edges.append({'data': {'source': str(e.origin_id), 'target': str(e.id)}})
+
+        payload = json.dumps({'nodes': nodes, 'edges': edges})
+        set_ensemble_map(mol.id, payload)
+
+    return HttpResponse(payload, content_type='text/json')
 
 @login_required
 def analyse(request, project_id):
@@ -3842,6 +4202,26 @@ def calculation(request, pk):
 
     return render(request, 'frontend/calculation.html', {'calc': calc})
 
+@login_required
+def calculation_eta(request, pk):
+    try:
+        calc = Calculation.objects.select_related('parameters', 'step', 'structure', 'order__resource').get(pk=pk)
+    except Calculation.DoesNotExist:
+        return HttpResponse(status=404)
+
+    profile = request.user.profile
+    if not can_view_calculation(calc, profile):
+        return HttpResponse(status=404)
+
+    predictor = RuntimePredictor()
+    return JsonResponse({
+            'id': calc.id,
+            'status': calc.status,
+            'core_seconds': predictor.core_seconds(calc),
+            'runtime': predictor.runtime(calc),
+            'remaining': predictor.remaining(calc),
+        })
+
 @login_required
 def see(request, pk):
     try:
@@ -3861,32 +4241,26 @@ def see(request, pk):
 def see_all(request):
     profile = request.user.profile
 
-    calcs = CalculationOrder.objects.filter(author=profile, hidden=False)
+    CalculationOrder.objects.filter(author=profile, hidden=False).exclude(last_seen_status=F('status')).update(last_seen_status=F('status'), last_update=timezone.now())
 
-    for c in calcs:
-        if c.new_status:
-            c.see()
-
-    # This should be true if everything works.
-    # If a glitch happens and the counter is off, this will reset it.
-    profile.unseen_calculations = 0
-    profile.save()
+    unseen = CalculationOrder.objects.filter(author=profile).exclude(last_seen_status=F('status')).count()
+    Profile.objects.filter(pk=profile.pk).update(unseen_calculations=unseen)
 
     return HttpResponse(status=200)
 
+def hide_orders(orders, profile):
+    with transaction.atomic():
+        num_seen = orders.exclude(last_seen_status=F('status')).update(last_seen_status=F('status'))
+        orders.update(hidden=True, last_update=timezone.now())
+
+    if num_seen > 0:
+        profile.add_unseen(-num_seen)
+
 @login_required
 def clean_all_successful(request):
     profile = request.user.profile
 
-    to_update = []
-    calcs = CalculationOrder.objects.filter(author=profile, hidden=False)
-    for c in calcs:
-        if c.status == 2:
-            c.hidden = True
-            c.see()
-            to_update.append(c)
-
-    CalculationOrder.objects.bulk_update(to_update, ['hidden', 'last_seen_status'])
+    hide_orders(CalculationOrder.objects.filter(author=profile, hidden=False, status=2), profile)
 
     return HttpResponse(status=200)
 
@@ -3894,15 +4268,7 @@ def clean_all_successful(request):
 def clean_all_completed(request):
     profile = request.user.profile
 
-    to_update = []
-    calcs = CalculationOrder.objects.filter(author=profile, hidden=False)
-    for c in calcs:
-        if c.status in [2, 3]:
-            c.hidden = True
-            c.see()
-            to_update.append(c)
-
-    CalculationOrder.objects.bulk_update(to_update, ['hidden', 'last_seen_status'])
+    hide_orders(CalculationOrder.objects.filter(author=profile, hidden=False, status__in=[2, 3]), profile)
 
     return HttpResponse(status=200)
 
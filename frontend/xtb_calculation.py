@@ -259,6 +259,7 @@ class XtbCalculation:
             self.cmd_arguments += "--{} ".format(method)
         if opt_level != "normal":
             self.cmd_arguments = self.cmd_arguments.replace('--opt ', '--opt {} '.format(opt_level))
+            self.cmd_arguments = self.cmd_arguments.replace('--ohess ', '--ohess {} '.format(opt_level))
 
         if self.calc.step.name in ['Conformational Search', 'Constrained Conformational Search']:
             self.cmd_arguments += "--rthr {} --ewin {} ".format(rthr, ewin)
@@ -267,9 +268,7 @@ class XtbCalculation:
 
 
     def raise_error(self, msg):
-        self.calc.status = 3
-        self.calc.error_message = msg
-        self.calc.save()
+        self.calc.transition(3, error_message=msg)
         raise Exception(msg)
 
     def handle_command(self):
@@ -289,6 +288,10 @@ class XtbCalculation:
         elif self.calc.step.name == "Frequency Calculation":
             self.cmd_arguments += "--hess "
             self.program = "xtb"
+        elif self.calc.step.name == "Optimisation and Frequency Calculation":
+            self.specifications = "--opt tight "
+            self.cmd_arguments += "--ohess "
+            self.program = "xtb"
         elif self.calc.step.name == "Single-Point Energy":
             self.program = "xtb"
 
@@ -1,3 +1,18 @@
 #!/bin/sh
 sleep 5
-celery -A calcus worker -Q comp --concurrency=1
+# The jobs reserve their cores through the local scheduler, so one worker process per core can be waiting or running.
+# Each tier of calculations has its own workers, so that quick jobs are never stuck behind long ones.
+celery -A calcus worker -Q comp_heavy -n heavy@%h --concurrency=${HEAVY_WORKERS:-1} --prefetch-multiplier=1 -O fair &
+PIDS="$!"
+celery -A calcus worker -Q comp_batch -n batch@%h --concurrency=${BATCH_WORKERS:-${NUM_CPU:-1}} --prefetch-multiplier=1 -O fair &
+PIDS="$PIDS $!"
+celery -A calcus worker -Q comp -n interactive@%h --concurrency=${NUM_CPU:-1} --prefetch-multiplier=1 -O fair &
+PIDS="$PIDS $!"
+
+# The shell is the supervised process: every worker must get the signal to release its reservations
+trap 'kill -TERM $PIDS 2>/dev/null' TERM
+trap 'kill -INT $PIDS 2>/dev/null' INT
+
+wait
+# A trapped signal interrupts wait, the workers still need to finish their shutdown
+wait
@@ -1,10 +1,14 @@
 #!/bin/sh
 
 python scripts/wait_for_postgres.py
+python manage.py merge_duplicate_parameters
 python manage.py makemigrations
 python manage.py makemigrations frontend
 python manage.py migrate
 python manage.py init_static_obj
+python manage.py merge_duplicate_parameters
+python manage.py refresh_cached_info
 python manage.py check_su
 
-gunicorn calcus.wsgi:application --bind 0.0.0.0:8000 --access-logfile=- --error-logfile=- --reload
+# Event streams are capped per worker (CALCUS_EVENTS_MAX_STREAMS), more workers serve more of them
+gunicorn calcus.wsgi:application --bind 0.0.0.0:8000 --workers ${CALCUS_WEB_WORKERS:-4} --threads 16 --access-logfile=- --error-logfile=- --reload